@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+from ondemand_vehsim import simulate_day_batch, simulate_night_batch
+from ondemand_utils import stacked_chg_time_tables
+
+
+class VehicleFleet:
+    # Explicit fleet of individual vehicles, held as a struct of arrays: one compactly typed array per
+    # attribute and per state variable, with one entry per vehicle. Attributes start out as those of the
+    # vehicle's driver permutation, but each vehicle's can be changed independently. State (SOC and the
+    # cumulative results since the fleet was built) is advanced for all vehicles at once by step_days.
+    # Cumulative state is float64 so that it does not lose precision over long simulations
+    attribute_types = {'cbsa_id': np.int32, 'permutation': np.int32, 'home_chg': np.int8, 'shift_h': np.float32,
+                       'veh_kwh': np.float32, 'avg_speed_mph': np.float32, 'whmi': np.float32,
+                       'seek_charge_kwh': np.float32, 'plug_occupied_time': np.float32}
+    state_types = {'soc': np.float64, 'days': np.int32, 'dcfc_events': np.int32, 'miles': np.float64,
+                   'dcfc_kwh': np.float64, 'dcfc_plug_h': np.float64, 'l2_kwh': np.float64}
+
+    # Vehicles stepped together, bounding the temporary (float64) arrays of step_days
+    step_chunk_size = 262144
+
+    def __init__(self, columns):
+        for cur_col in self.attribute_types.keys():
+            setattr(self, cur_col, np.asarray(columns[cur_col], dtype=self.attribute_types[cur_col]))
+        for cur_col in self.state_types.keys():
+            setattr(self, cur_col, np.asarray(columns[cur_col], dtype=self.state_types[cur_col]))
+
+    @classmethod
+    def from_permutations(cls, cbsa_permutations, vehicle_counts, initial_soc):
+        # Fleet of vehicle_counts[i] vehicles of each driver permutation (row i of a simulated permutation
+        # table, of one or more CBSAs), in permutation order, all starting at initial_soc
+        vehicle_counts = np.asarray(vehicle_counts)
+        if np.any(vehicle_counts % 1 != 0):
+            raise ValueError('An explicit vehicle fleet needs whole vehicle counts, e.g. from monte_carlo fleet sizing')
+        vehicle_counts = vehicle_counts.astype(np.int64)
+        num_vehs = int(vehicle_counts.sum())
+
+        permutation_columns = {'cbsa_id': 'cbsa_id', 'home_chg': 'home_chg', 'shift_h': 'shift_h',
+                               'veh_kwh': 'veh_kwh', 'avg_speed_mph': 'avg_speed_mph', 'whmi': 'cbsa_whmi',
+                               'seek_charge_kwh': 'seek_charge_kwh', 'plug_occupied_time': 'plug_occupied_time'}
+        # Permutation values are cast before they are repeated, so no full-size float64 copies are made
+        columns = {cur_col: np.repeat(cbsa_permutations[permutation_columns[cur_col]].values.astype(
+                       cls.attribute_types[cur_col]), vehicle_counts)
+                   for cur_col in permutation_columns.keys()}
+        columns['permutation'] = np.repeat(np.arange(len(cbsa_permutations), dtype=np.int32), vehicle_counts)
+        columns['soc'] = np.full(num_vehs, initial_soc, dtype=np.float64)
+        for cur_col in ['days', 'dcfc_events', 'miles', 'dcfc_kwh', 'dcfc_plug_h', 'l2_kwh']:
+            columns[cur_col] = np.zeros(num_vehs, dtype=cls.state_types[cur_col])
+
+        return cls(columns)
+
+    @classmethod
+    def concat(cls, fleets):
+
+        return cls({cur_col: np.concatenate([getattr(fleet, cur_col) for fleet in fleets])
+                    for cur_col in list(cls.attribute_types.keys()) + list(cls.state_types.keys())})
+
+    def __len__(self):
+
+        return self.soc.size
+
+    def nbytes(self):
+
+        return sum(getattr(self, cur_col).nbytes
+                   for cur_col in list(self.attribute_types.keys()) + list(self.state_types.keys()))
+
+    def step_days(self, num_days, global_inputs):
+        # Advances every vehicle by num_days days (a shift and the night after it) with the batched
+        # vehicle simulation. Every day is simulated, there is no steady-state extrapolation. With dcfc_top_up,
+        # each vehicle's DCFC stops are timed from the charge time table of its own battery size
+        for chunk_start in range(0, len(self), self.step_chunk_size):
+            chunk = slice(chunk_start, min(chunk_start + self.step_chunk_size, len(self)))
+            home_chg = self.home_chg[chunk]
+            shift_h, veh_kwh, avg_speed_mph, whmi, seek_charge_kwh, plug_occupied_time = [
+                getattr(self, cur_col)[chunk].astype(np.float64) for cur_col in
+                ['shift_h', 'veh_kwh', 'avg_speed_mph', 'whmi', 'seek_charge_kwh', 'plug_occupied_time']]
+            dcfc_soc_high = np.full(veh_kwh.size, global_inputs['soc_high'])
+            chg_tables, chg_table_ix = stacked_chg_time_tables(veh_kwh, global_inputs)
+
+            veh_soc = self.soc[chunk]
+            dcfc_events = np.zeros(veh_kwh.size, dtype=np.int64)
+            miles = np.zeros(veh_kwh.size)
+            dcfc_kwh = np.zeros(veh_kwh.size)
+            dcfc_plug_h = np.zeros(veh_kwh.size)
+            l2_kwh = np.zeros(veh_kwh.size)
+
+            for day in range(num_days):
+                day_dcfc_events = np.zeros(veh_kwh.size, dtype=np.int64)
+                veh_soc, day_dcfc_events, shift_spillover, shift_mi, day_dcfc_kwh, day_dcfc_plug_h = \
+                    simulate_day_batch(veh_soc,
+                                       day_dcfc_events,
+                                       shift_h,
+                                       veh_kwh,
+                                       avg_speed_mph,
+                                       whmi,
+                                       seek_charge_kwh,
+                                       plug_occupied_time,
+                                       dcfc_soc_high,
+                                       chg_tables,
+                                       chg_table_ix,
+                                       global_inputs['plug_in_mins'] / 60.0)
+                veh_soc, night_l2_kwh = simulate_night_batch(veh_soc,
+                                                             home_chg,
+                                                             shift_h,
+                                                             shift_spillover,
+                                                             veh_kwh,
+                                                             global_inputs['l2_max_kw'])
+                dcfc_events = dcfc_events + day_dcfc_events
+                miles = miles + shift_mi
+                dcfc_kwh = dcfc_kwh + day_dcfc_kwh
+                dcfc_plug_h = dcfc_plug_h + day_dcfc_plug_h
+                l2_kwh = l2_kwh + night_l2_kwh
+
+            self.soc[chunk] = veh_soc
+            self.days[chunk] = self.days[chunk] + num_days
+            self.dcfc_events[chunk] = self.dcfc_events[chunk] + dcfc_events
+            self.miles[chunk] = self.miles[chunk] + miles
+            self.dcfc_kwh[chunk] = self.dcfc_kwh[chunk] + dcfc_kwh
+            self.dcfc_plug_h[chunk] = self.dcfc_plug_h[chunk] + dcfc_plug_h
+            self.l2_kwh[chunk] = self.l2_kwh[chunk] + l2_kwh
+
+        return
+
+    def summarize_by_cbsa(self):
+        # Per CBSA fleet totals per day, averaged over the days each vehicle has been stepped, in the
+        # units of population_results.csv (fleet_miles are the miles the fleet drove)
+        days = np.maximum(self.days, 1)
+        home_chg = self.home_chg == 1
+        veh_totals = pd.DataFrame({'cbsa_id': self.cbsa_id,
+                                   'num_vehs': 1,
+                                   'num_dcfc_events': self.dcfc_events / days,
+                                   'cbsa_dcfc_plug_time': self.dcfc_plug_h / days,
+                                   'fleet_miles': self.miles / days,
+                                   'cbsa_dcfc_kwh_w_hc': np.where(home_chg, self.dcfc_kwh, 0) / days,
+                                   'cbsa_dcfc_kwh_wo_hc': np.where(home_chg, 0, self.dcfc_kwh) / days,
+                                   'cbsa_l2_kwh': self.l2_kwh / days})
+
+        return veh_totals.groupby('cbsa_id', sort=False).sum().reset_index()
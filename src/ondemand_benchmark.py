@@ -0,0 +1,400 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import warnings
+import tracemalloc
+import numpy as np
+import pandas as pd
+from ondemand_vehsim import simulate_day, simulate_n_days, simulate_n_days_batch
+from ondemand_utils import ChargeCurve, calc_chg_time, calc_chg_time_table, daily_variation_factors
+from ondemand_cache import get_code_version
+from ondemand_queue import simulate_plug_queue, size_plugs_for_wait
+from ondemand_agents import VehicleFleet
+from ondemand_fleetsim import import_scenario_vars, import_cbsa_inputs, retrieve_cbsa_inputs, \
+    define_variable_frequencies, build_driver_permutations, simulate_permutation_table, \
+    sample_populations_to_reach_vmt, cbsa_random_state, simulate_scenario
+
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+benchmark_scenario = os.path.join(src_dir, '..', 'scenarios', 'bau_baseline.yaml')
+baseline_path = os.path.join(src_dir, '..', 'benchmarks', 'baseline.json')
+
+# CBSAs of increasing TNC VMT used by the sampling benchmarks
+sample_cbsa_ids = {'abilene': 10180, 'des_moines': 19780, 'denver': 19740, 'new_york': 35620}
+
+synthetic_cbsa_counts = [10, 100, 1000]
+
+
+# Fast benchmarks are called in loops of at least this duration (s), so that timer resolution and noise
+# do not dominate their per-call time
+min_loop_time = 0.2
+
+# Benchmarks slower than the baseline are timed again up to this many times, keeping their best time, so that
+# a slow spell of the machine during the main run is not reported as a regression
+recheck_rounds = 2
+
+# A baseline is recorded from this many runs of every benchmark, keeping each benchmark's median run, so that it
+# reflects the machine's usual speed rather than its fastest spell
+baseline_rounds = 3
+
+
+def time_benchmark(benchmark_fn, repeats):
+    # Best time per call (s) over repeats loops, then the peak memory (MB) traced during one more call.
+    # spread is how much slower the median loop was than the best one (a fraction), the run's timing noise
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for cur_call in range(calls):
+            benchmark_fn()
+        loop_time = time.perf_counter() - start
+        if loop_time >= min_loop_time:
+            break
+        calls = calls * 10
+
+    times = [loop_time / calls]
+    for cur_repeat in range(repeats - 1):
+        start = time.perf_counter()
+        for cur_call in range(calls):
+            benchmark_fn()
+        times.extend([(time.perf_counter() - start) / calls])
+
+    tracemalloc.start()
+    benchmark_fn()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'spread': float(np.median(times) / min(times) - 1),
+            'peak_mb': peak_bytes / 1024**2, 'calls': calls, 'repeats': repeats}
+
+
+def build_synthetic_cbsa_table(cbsa_table, cbsa_ids, num_rows, seed=0):
+    # Synthetic CBSA table of num_rows rows, resampled from the real CBSAs and numbered 1..num_rows
+    rng = np.random.default_rng(seed)
+    synthetic_table = cbsa_table.loc[rng.choice(cbsa_ids, size=num_rows, replace=True)].copy()
+    synthetic_table.index = pd.Index(np.arange(1, num_rows + 1), name=cbsa_table.index.name)
+
+    return synthetic_table, synthetic_table.index.tolist()
+
+
+def vehsim_benchmarks(global_inputs):
+    # simulate_day, and simulate_n_days (per vehicle and batched) across sim_days. Cycle detection is
+    # disabled so that every day is simulated
+    veh_kwh = 75
+    seek_charge_kwh = global_inputs['soc_low'] * veh_kwh
+    chg_time_h = (global_inputs['soc_high'] - global_inputs['soc_low']) * veh_kwh / global_inputs['dcfc_max_kw']
+    benchmarks = []
+
+    def run_simulate_day():
+        simulate_day(1, 0, 10, veh_kwh, 25, 300, seek_charge_kwh, chg_time_h, 0, global_inputs['soc_high'])
+
+    benchmarks.extend([('simulate_day', run_simulate_day, 9)])
+
+    for sim_days in [30, 150, 365]:
+
+        def run_simulate_n_days(sim_days=sim_days):
+            simulate_n_days(veh_kwh, 1, 0, 10, 25, sim_days, seek_charge_kwh,
+                            chg_time_h, global_inputs['l2_max_kw'], 300, global_inputs['soc_high'])
+
+        def run_simulate_n_days_batch(sim_days=sim_days):
+            simulate_n_days_batch(veh_kwh, 1, np.repeat([0, 1], 1000), np.tile([2, 4, 6.5, 10], 500), 25, sim_days,
+                                  seek_charge_kwh, chg_time_h, global_inputs['l2_max_kw'], 300, global_inputs['soc_high'])
+
+        benchmarks.extend([('simulate_n_days_%sd' % sim_days, run_simulate_n_days, 7),
+                           ('simulate_n_days_batch_2000veh_%sd' % sim_days, run_simulate_n_days_batch, 7)])
+
+    # DCFC top-ups, timed from a charge time table
+    chg_tables = calc_chg_time_table(veh_kwh, global_inputs['dcfc_max_kw'], global_inputs['dcfc_max_kw'], 1)[np.newaxis]
+    plug_in_h = global_inputs['plug_in_mins'] / 60.0
+
+    def run_simulate_n_days_batch_top_up():
+        simulate_n_days_batch(veh_kwh, 1, np.repeat([0, 1], 1000), np.tile([2, 4, 6.5, 10], 500), 25, 30,
+                              seek_charge_kwh, chg_time_h, global_inputs['l2_max_kw'], 300, global_inputs['soc_high'],
+                              chg_tables=chg_tables, plug_in_h=plug_in_h)
+
+    benchmarks.extend([('simulate_n_days_batch_2000veh_top_up_30d', run_simulate_n_days_batch_top_up, 7)])
+
+    # Day-to-day variation, drawn up front for every vehicle and day (no cycle extrapolation)
+    variation_permutations = {'home_chg': np.repeat([0, 1], 1000), 'shift_h': np.tile([2, 4, 6.5, 10], 500),
+                              'cbsa_whmi': 300 + np.arange(2000) / 2000}
+    variation_inputs = dict(global_inputs, daily_variation={'shift_h': 0.2, 'speed': 0.1, 'whmi': 0.05}, sim_days=30)
+
+    def run_simulate_n_days_batch_variation():
+        daily_factors = daily_variation_factors(np.arange(2000), variation_inputs, np.random.default_rng(0))
+        simulate_n_days_batch(veh_kwh, 1, variation_permutations['home_chg'], variation_permutations['shift_h'], 25, 30,
+                              seek_charge_kwh, chg_time_h, global_inputs['l2_max_kw'],
+                              variation_permutations['cbsa_whmi'], global_inputs['soc_high'],
+                              daily_factors=daily_factors)
+
+    benchmarks.extend([('simulate_n_days_batch_2000veh_variation_30d', run_simulate_n_days_batch_variation, 7)])
+
+    return benchmarks
+
+
+def charge_time_benchmarks(global_inputs):
+    # calc_chg_time on a fresh charge curve cache and on a warm one, and permutation tables with and without taper
+    charge_curve = ChargeCurve()
+    cbsa_inputs = {'avg_speed_mph': 25, 'cbsa_tnc_vmt': 0, 'cbsa_hc_access': 50, 'hc_access_share': 0.5, 'cbsa_whmi': 300}
+    benchmarks = []
+
+    def run_charge_time_uncached():
+        charge_curve.chg_time_cache.clear()
+        charge_curve.charge_time(75, global_inputs['veh_max_kw'], global_inputs['dcfc_max_kw'],
+                                 global_inputs['soc_low'], global_inputs['soc_high'])
+
+    def run_calc_chg_time_cached():
+        calc_chg_time(75, global_inputs['veh_max_kw'], global_inputs['dcfc_max_kw'],
+                      global_inputs['soc_low'], global_inputs['soc_high'])
+
+    benchmarks.extend([('charge_time_uncached', run_charge_time_uncached, 9),
+                       ('calc_chg_time_cached', run_calc_chg_time_cached, 9)])
+
+    for charge_taper in [0, 1]:
+        taper_inputs = dict(global_inputs, charge_taper=charge_taper)
+
+        def run_build_driver_permutations(taper_inputs=taper_inputs):
+            build_driver_permutations(define_variable_frequencies(cbsa_inputs), taper_inputs, cbsa_inputs)
+
+        benchmarks.extend([('build_driver_permutations_taper%s' % charge_taper, run_build_driver_permutations, 7)])
+
+    return benchmarks
+
+
+def sampling_benchmarks(global_inputs, cbsa_table):
+    # Permutations, vehicle simulation and fleet sampling of single CBSAs, from small to the largest TNC VMT
+    benchmarks = []
+
+    for cbsa_name in sample_cbsa_ids.keys():
+        cur_cbsa_id = sample_cbsa_ids[cbsa_name]
+        cbsa_inputs = retrieve_cbsa_inputs(global_inputs, cbsa_table, cur_cbsa_id)
+
+        def run_simulate_permutations(cbsa_inputs=cbsa_inputs):
+            cbsa_permutations = build_driver_permutations(define_variable_frequencies(cbsa_inputs),
+                                                          global_inputs,
+                                                          cbsa_inputs)
+            return simulate_permutation_table(cbsa_permutations, global_inputs)
+
+        cbsa_permutation_results = run_simulate_permutations()
+
+        def run_sample_populations(cbsa_inputs=cbsa_inputs,
+                                   cbsa_permutation_results=cbsa_permutation_results,
+                                   cur_cbsa_id=cur_cbsa_id):
+            sample_populations_to_reach_vmt(cbsa_permutation_results,
+                                            cbsa_inputs['cbsa_tnc_vmt'],
+                                            cbsa_random_state(global_inputs, cur_cbsa_id))
+
+        benchmarks.extend([('simulate_permutations_%s' % cbsa_name, run_simulate_permutations, 7),
+                           ('sample_populations_%s_%svmt' % (cbsa_name, int(cbsa_inputs['cbsa_tnc_vmt'])),
+                            run_sample_populations, 7)])
+
+    # Sampled driver profiles from continuous distributions, whose cost grows with driver_samples
+    cbsa_inputs = retrieve_cbsa_inputs(global_inputs, cbsa_table, sample_cbsa_ids['denver'])
+    for driver_samples in [128, 1024]:
+        sampled_inputs = dict(global_inputs, driver_samples=driver_samples,
+                              driver_distributions={'shift_h': {'dist': 'lognormal', 'mean': 6, 'sd': 3, 'min': 1, 'max': 14},
+                                                    'veh_kwh': {'dist': 'uniform', 'low': 50, 'high': 100},
+                                                    'speed_factor': {'dist': 'normal', 'mean': 1, 'sd': 0.15, 'min': 0.5}})
+
+        def run_simulate_sampled_drivers(sampled_inputs=sampled_inputs):
+            cbsa_permutations = build_driver_permutations(define_variable_frequencies(cbsa_inputs),
+                                                          sampled_inputs,
+                                                          cbsa_inputs)
+            return simulate_permutation_table(cbsa_permutations, sampled_inputs)
+
+        benchmarks.extend([('simulate_sampled_drivers_%s' % driver_samples, run_simulate_sampled_drivers, 7)])
+
+    return benchmarks
+
+
+def vehicle_fleet_benchmarks(global_inputs, cbsa_table):
+    # Building an explicit fleet of 1,000,000 vehicles from Denver's permutations, and stepping it through a day
+    cur_cbsa_id = sample_cbsa_ids['denver']
+    cbsa_inputs = retrieve_cbsa_inputs(global_inputs, cbsa_table, cur_cbsa_id)
+    cbsa_permutations = build_driver_permutations(define_variable_frequencies(cbsa_inputs), global_inputs, cbsa_inputs)
+    cbsa_permutations['cbsa_id'] = cur_cbsa_id
+    cbsa_permutations = simulate_permutation_table(cbsa_permutations, global_inputs)
+    vehicle_counts = np.random.default_rng(0).multinomial(1000000, cbsa_permutations.sample_weight.values /
+                                                          cbsa_permutations.sample_weight.values.sum())
+
+    def run_build_vehicle_fleet():
+        return VehicleFleet.from_permutations(cbsa_permutations, vehicle_counts, global_inputs['initial_soc'])
+
+    vehicle_fleet = run_build_vehicle_fleet()
+
+    def run_step_vehicle_fleet():
+        vehicle_fleet.step_days(1, global_inputs)
+
+    return [('vehicle_fleet_build_1m_veh', run_build_vehicle_fleet, 7),
+            ('vehicle_fleet_step_1m_veh_1d', run_step_vehicle_fleet, 7)]
+
+
+def queue_benchmarks():
+    # Charging queue simulation of a synthetic stream of 100,000 DCFC sessions over 3 days (200,000
+    # events): at a fixed number of plugs, and the full search for the plugs meeting a 5 minute mean wait
+    rng = np.random.default_rng(0)
+    arrivals = np.sort(rng.random(100000) * 72)
+    plug_times = 0.3 + rng.exponential(0.2, arrivals.size)
+
+    def run_simulate_plug_queue():
+        simulate_plug_queue(arrivals, plug_times, 800)
+
+    def run_size_plugs_for_wait():
+        size_plugs_for_wait(arrivals, plug_times, 24, 5 / 60.0)
+
+    return [('queue_simulate_200k_events', run_simulate_plug_queue, 7),
+            ('queue_size_plugs_100k_sessions', run_size_plugs_for_wait, 7)]
+
+
+def end_to_end_benchmarks(global_inputs, cbsa_table, cbsa_ids):
+    # Full scenarios (without file output) on synthetic CBSA tables
+    benchmarks = []
+
+    for num_rows in synthetic_cbsa_counts:
+        synthetic_table, synthetic_ids = build_synthetic_cbsa_table(cbsa_table, cbsa_ids, num_rows)
+
+        def run_scenario(synthetic_table=synthetic_table, synthetic_ids=synthetic_ids):
+            simulate_scenario(global_inputs, synthetic_table, synthetic_ids)
+
+        benchmarks.extend([('end_to_end_%s_cbsas' % num_rows, run_scenario, 3)])
+
+    return benchmarks
+
+
+def run_benchmarks(name_filter=None, show_progress=False, baseline=None, threshold=0.25, rounds=1):
+    # Times every benchmark (whose name contains name_filter), rounds times over, keeping the median round of
+    # each. With a baseline, the benchmarks that compare_to_baseline finds slower are rechecked (see
+    # recheck_rounds)
+    global_inputs = import_scenario_vars(benchmark_scenario)
+    cbsa_table, cbsa_ids, input_report = import_cbsa_inputs()
+
+    benchmarks = vehsim_benchmarks(global_inputs) + \
+        charge_time_benchmarks(global_inputs) + \
+        sampling_benchmarks(global_inputs, cbsa_table) + \
+        vehicle_fleet_benchmarks(global_inputs, cbsa_table) + \
+        queue_benchmarks() + \
+        end_to_end_benchmarks(global_inputs, cbsa_table, cbsa_ids)
+
+    benchmarks = [(benchmark_name, benchmark_fn, repeats) for benchmark_name, benchmark_fn, repeats in benchmarks
+                  if name_filter is None or name_filter in benchmark_name]
+
+    round_results = dict([(benchmark_name, []) for benchmark_name, benchmark_fn, repeats in benchmarks])
+    for cur_round in range(rounds):
+        for benchmark_name, benchmark_fn, repeats in benchmarks:
+            round_results[benchmark_name].append(time_benchmark(benchmark_fn, repeats))
+            if show_progress:
+                print('%-45s %12.3e s %10.2f MB' % (benchmark_name,
+                                                     round_results[benchmark_name][-1]['seconds'],
+                                                     round_results[benchmark_name][-1]['peak_mb']))
+
+    results = {}
+    for benchmark_name in round_results.keys():
+        results[benchmark_name] = sorted(round_results[benchmark_name],
+                                         key=lambda cur_results: cur_results['seconds'])[(rounds - 1) // 2]
+
+    run_results = {'code_version': get_code_version(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'pandas': pd.__version__,
+                   'machine': platform.platform(),
+                   'benchmarks': results}
+
+    if baseline is None:
+        return run_results
+
+    for cur_round in range(recheck_rounds):
+        slow_names = set([regression['benchmark'] for regression in compare_to_baseline(run_results, baseline, threshold)
+                          if regression['metric'] == 'seconds'])
+        if len(slow_names) == 0:
+            break
+
+        for benchmark_name, benchmark_fn, repeats in benchmarks:
+            if benchmark_name not in slow_names:
+                continue
+
+            recheck_results = time_benchmark(benchmark_fn, repeats)
+            if recheck_results['seconds'] < results[benchmark_name]['seconds']:
+                results[benchmark_name] = recheck_results
+            if show_progress:
+                print('%-45s %12.3e s (recheck %s)' % (benchmark_name, results[benchmark_name]['seconds'],
+                                                       cur_round + 1))
+
+    return run_results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    # Benchmarks whose time or peak memory grew by more than threshold (a fraction) over the baseline. A
+    # benchmark whose timings were noisier than threshold, in this run or the baseline's, must also have
+    # slowed down by more than that spread
+    regressions = []
+    for benchmark_name in results['benchmarks'].keys():
+        if benchmark_name not in baseline['benchmarks']:
+            continue
+
+        for metric in ['seconds', 'peak_mb']:
+            cur_value = results['benchmarks'][benchmark_name][metric]
+            baseline_value = baseline['benchmarks'][benchmark_name][metric]
+            cur_threshold = threshold
+            if metric == 'seconds':
+                cur_threshold = max(threshold, results['benchmarks'][benchmark_name].get('spread', 0),
+                                    baseline['benchmarks'][benchmark_name].get('spread', 0))
+            if baseline_value > 0 and cur_value > baseline_value * (1 + cur_threshold):
+                regressions.extend([{'benchmark': benchmark_name,
+                                     'metric': metric,
+                                     'baseline': baseline_value,
+                                     'current': cur_value,
+                                     'ratio': cur_value / baseline_value}])
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description='EVI-OnDemand benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json', help='.json file the results are written to')
+    parser.add_argument('--baseline', default=baseline_path, help='.json results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fractional increase in time or peak memory reported as a regression')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this string')
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as stream:
+            baseline = json.load(stream)
+
+    results = run_benchmarks(args.filter, show_progress=True, baseline=baseline, threshold=args.threshold,
+                             rounds=baseline_rounds if args.save_baseline else 1)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    print('\nResults written to %s' % args.output)
+
+    if args.save_baseline:
+        if not os.path.exists(os.path.dirname(args.baseline)):
+            os.makedirs(os.path.dirname(args.baseline))
+        with open(args.baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        print('Baseline written to %s' % args.baseline)
+
+    elif baseline is not None:
+        if baseline['machine'] != results['machine']:
+            print('Note: the baseline was recorded on %s, timings may not be comparable' % baseline['machine'])
+
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        print('Compared to %s (threshold %s%%): %s regressions' % (args.baseline, int(args.threshold * 100),
+                                                                   len(regressions)))
+        for regression in regressions:
+            print('  %s %s: %.4g -> %.4g (x%.2f)' % (regression['benchmark'], regression['metric'],
+                                                     regression['baseline'], regression['current'],
+                                                     regression['ratio']))
+
+        if len(regressions) > 0:
+            sys.exit(1)
+
+    else:
+        print('No baseline found at %s' % args.baseline)
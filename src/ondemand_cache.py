@@ -0,0 +1,120 @@
+import os
+import json
+import pickle
+import hashlib
+from ondemand_utils import power_curve_path
+
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Files whose contents define the model version: a change to any of them invalidates cached results
+model_files = [os.path.join(src_dir, 'ondemand_fleetsim.py'),
+               os.path.join(src_dir, 'ondemand_vehsim.py'),
+               os.path.join(src_dir, 'ondemand_utils.py'),
+               os.path.join(src_dir, 'ondemand_loads.py'),
+               os.path.join(src_dir, 'ondemand_queue.py'),
+               os.path.join(src_dir, 'ondemand_drivers.py'),
+               power_curve_path]
+
+code_version = None
+
+
+def get_code_version():
+    global code_version
+    if code_version is None:
+        version_hash = hashlib.sha256()
+        for model_file in model_files:
+            with open(model_file, 'rb') as source:
+                version_hash.update(source.read())
+        code_version = version_hash.hexdigest()
+
+    return code_version
+
+
+def hash_inputs(*inputs):
+    # Content address of a set of (JSON-serializable) inputs
+    input_str = json.dumps(inputs, sort_keys=True, default=repr)
+
+    return hashlib.sha256(input_str.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    # On-disk cache of pickled results, one file per (stage, key). When the cache grows past max_bytes,
+    # the least recently used entries are evicted. Hits and misses are counted per stage.
+
+    def __init__(self, cache_dir, max_bytes=1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = {}
+        self.misses = {}
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # file name: [last used, size in bytes]
+        self.entries = {}
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith('.pkl'):
+                file_stat = os.stat(os.path.join(cache_dir, file_name))
+                self.entries[file_name] = [file_stat.st_mtime, file_stat.st_size]
+        self.total_bytes = sum([entry[1] for entry in self.entries.values()])
+
+    def get(self, stage, key):
+        file_name = '%s-%s.pkl' % (stage, key)
+        cache_path = os.path.join(self.cache_dir, file_name)
+
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                value = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+            return None
+
+        os.utime(cache_path)
+        if file_name in self.entries:
+            self.entries[file_name][0] = os.stat(cache_path).st_mtime
+        self.hits[stage] = self.hits.get(stage, 0) + 1
+
+        return value
+
+    def put(self, stage, key, value):
+        file_name = '%s-%s.pkl' % (stage, key)
+        cache_path = os.path.join(self.cache_dir, file_name)
+
+        # Written to a temporary file first so that readers (or a killed run) never see a partial entry
+        with open(cache_path + '.tmp', 'wb') as cache_file:
+            pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_path + '.tmp', cache_path)
+
+        file_stat = os.stat(cache_path)
+        if file_name in self.entries:
+            self.total_bytes = self.total_bytes - self.entries[file_name][1]
+        self.entries[file_name] = [file_stat.st_mtime, file_stat.st_size]
+        self.total_bytes = self.total_bytes + file_stat.st_size
+
+        self.evict()
+
+        return
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        for file_name in sorted(self.entries.keys(), key=lambda name: self.entries[name][0]):
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except OSError:
+                pass
+            self.total_bytes = self.total_bytes - self.entries.pop(file_name)[1]
+            if self.total_bytes <= self.max_bytes:
+                break
+
+        return
+
+    def report(self):
+        stages = list(dict.fromkeys(list(self.hits.keys()) + list(self.misses.keys())))
+
+        return {'stages': {stage: {'hits': self.hits.get(stage, 0),
+                                   'misses': self.misses.get(stage, 0)} for stage in stages},
+                'entries': len(self.entries),
+                'size_mb': round(self.total_bytes / 1024**2, 2)}
@@ -0,0 +1,216 @@
+import sys
+import time
+import argparse
+import tempfile
+import warnings
+import yaml
+import numpy as np
+import pandas as pd
+from ondemand_cache import ResultCache
+from ondemand_fleetsim import import_scenario_vars, directory_handling, import_cbsa_inputs, print_input_report, \
+    run_scenario, summarize_scenario, apply_scenario_defaults, size_charging_plugs
+
+
+# National outputs a calibration can target (see summarize_scenario)
+calibration_metrics = ['num_plugs', 'num_vehs', 'plugs_per_1000_vehs']
+
+# Range searched for each parameter; other numeric scenario variables are searched over positive values
+parameter_bounds = {'tnc_share': (0.0, 1.0), 'utilization_perc': (0.0, 1.0), 'dcfc_max_kw': (0.0, None)}
+
+# Parameters that only change plug sizing: the scenario is run once and its fleets are resized for each value
+sizing_parameters = ['utilization_perc']
+
+# Factor by which the search range is widened while bracketing the target
+bracket_factor = 2.0
+
+
+def calibrate_parameter(base_inputs,
+                        parameter,
+                        target_metric,
+                        target,
+                        data,
+                        rel_tol=1e-3,
+                        max_evals=20,
+                        workers=1,
+                        result_cache=None,
+                        show_progress=False):
+    # Value of parameter at which the scenario's target_metric reaches target (within rel_tol of it). The
+    # metric is assumed to change monotonically with the parameter. Starting from the scenario's own value,
+    # the range is widened by bracket_factor until the target is bracketed, and the root is then found by
+    # regula falsi with the Illinois modification (bisection-like worst case, superlinear on smooth metrics).
+    # Every evaluation runs the full scenario in memory, sharing one simulation cache: only permutations
+    # whose simulate_n_days inputs the parameter changes are re-simulated, and with a result_cache fleets
+    # are only re-sampled if the parameter changes their inputs. For sizing_parameters the scenario is only
+    # run once, and every evaluation resizes the plugs of its population results.
+    # Returns the best value found, whether it met the tolerance, and a table of all evaluations.
+    # Without a result_cache, a temporary one is used for the duration of the calibration
+    if target_metric not in calibration_metrics:
+        raise ValueError('target_metric must be one of %s, got %s' % (calibration_metrics, target_metric))
+
+    if result_cache is None:
+        with tempfile.TemporaryDirectory() as temp_cache_dir:
+            return calibrate_parameter(base_inputs, parameter, target_metric, target, data, rel_tol, max_evals, workers,
+                                       ResultCache(temp_cache_dir), show_progress)
+
+    low_bound, high_bound = parameter_bounds.get(parameter, (0.0, None))
+    tolerance = rel_tol * abs(target)
+    sim_cache = {}
+    evaluations = []
+    sized_population = []
+
+    def evaluate(value):
+        start = time.perf_counter()
+        cur_inputs = dict(base_inputs, **{parameter: float(value)})
+        if parameter in sizing_parameters and len(sized_population) > 0:
+            population = size_charging_plugs(sized_population[0], apply_scenario_defaults(dict(cur_inputs)))
+        else:
+            population = run_scenario(cur_inputs, data, workers=workers, sim_cache=sim_cache,
+                                      result_cache=result_cache)['population']
+            sized_population[:] = [population]
+        scenario_summary = summarize_scenario(population)
+        evaluations.append(dict([('evaluation', len(evaluations) + 1), (parameter, value)] +
+                                list(scenario_summary.items()) +
+                                [('error', scenario_summary[target_metric] - target),
+                                 ('seconds', time.perf_counter() - start)]))
+        if show_progress:
+            print('  %2s  %s = %-12.6g %s = %-12.6g (%.1f s)' % (len(evaluations), parameter, value, target_metric,
+                                                                 scenario_summary[target_metric],
+                                                                 evaluations[-1]['seconds']))
+
+        return scenario_summary[target_metric] - target
+
+    def clip(value):
+        if high_bound is not None:
+            value = min(value, high_bound)
+
+        return max(value, low_bound)
+
+    def calibration_result(converged):
+        evaluation_table = pd.DataFrame(evaluations)
+        best = evaluation_table.error.abs().idxmin()
+
+        return evaluation_table.loc[best, parameter], converged, evaluation_table
+
+    # Bracketing: a second point gives the direction in which the metric moves, then the range is widened
+    # in the direction of the target until the error changes sign
+    start_value = float(base_inputs[parameter])
+    if start_value <= low_bound or (high_bound is not None and start_value > high_bound):
+        raise ValueError('%s must start within (%s, %s], got %s' % (parameter, low_bound, high_bound, start_value))
+    start_error = evaluate(start_value)
+    if abs(start_error) <= tolerance:
+        return calibration_result(True)
+
+    step = 1.25
+    probe_value = clip(start_value * step) if clip(start_value * step) != start_value else start_value / step
+    probe_error = evaluate(probe_value)
+    while probe_error == start_error:
+        # The metric is flat here (e.g. whole plugs), look further away
+        next_value = clip(start_value * (probe_value / start_value) ** 2)
+        if next_value == probe_value or len(evaluations) >= max_evals:
+            raise ValueError('%s does not change with %s around %s' % (target_metric, parameter, start_value))
+        probe_value = next_value
+        probe_error = evaluate(probe_value)
+
+    # Direction in which the error moves towards zero
+    increasing = (probe_error - start_error) / (probe_value - start_value) > 0
+    go_up = (start_error < 0) == increasing
+    if (probe_value > start_value) == go_up:
+        low_value, low_error = probe_value, probe_error
+    else:
+        low_value, low_error = start_value, start_error
+    high_value, high_error = start_value, start_error
+
+    while np.sign(high_error) == np.sign(low_error) and abs(low_error) > tolerance:
+        if len(evaluations) >= max_evals:
+            return calibration_result(False)
+
+        next_value = clip(low_value * bracket_factor) if go_up else low_value / bracket_factor
+        if next_value == low_value:
+            raise ValueError('%s of %s cannot be reached with %s within [%s, %s]' %
+                             (target_metric, target, parameter, low_bound, high_bound))
+        high_value, high_error = low_value, low_error
+        low_value, low_error = next_value, evaluate(next_value)
+
+    if abs(low_error) <= tolerance:
+        return calibration_result(True)
+
+    # Root finding within the bracket [low_value, high_value]
+    last_side = 0
+    while len(evaluations) < max_evals:
+        next_value = (low_value * high_error - high_value * low_error) / (high_error - low_error)
+        next_error = evaluate(next_value)
+
+        if abs(next_error) <= tolerance:
+            return calibration_result(True)
+        if abs(high_value - low_value) <= 1e-9 * abs(next_value):
+            break
+
+        if np.sign(next_error) == np.sign(high_error):
+            high_value, high_error = next_value, next_error
+            if last_side == -1:
+                low_error = low_error / 2
+            last_side = -1
+        else:
+            low_value, low_error = next_value, next_error
+            if last_side == 1:
+                high_error = high_error / 2
+            last_side = 1
+
+    return calibration_result(False)
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description='EVI-OnDemand calibration: solve for the value of a scenario '
+                                                 'variable that reaches a target national output')
+    parser.add_argument('scenario', help='scenario .yaml file, its value of the parameter is the starting point')
+    parser.add_argument('--parameter', required=True, help='scenario variable to solve for, e.g. tnc_share, '
+                                                            'utilization_perc or dcfc_max_kw')
+    parser.add_argument('--target-metric', required=True, choices=calibration_metrics, help='national output to match')
+    parser.add_argument('--target', type=float, required=True, help='value of the target metric')
+    parser.add_argument('--rel-tol', type=float, default=1e-3, help='tolerance, as a fraction of the target')
+    parser.add_argument('--max-evals', type=int, default=20, help='most scenario evaluations before giving up')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to simulate CBSA fleets')
+    parser.add_argument('--cache-dir', help='directory of the per-CBSA result cache, by default a temporary one')
+    parser.add_argument('--cache-max-mb', type=float, default=1024, help='size above which the result cache evicts old entries')
+    args = parser.parse_args()
+
+    base_inputs = import_scenario_vars(args.scenario)
+    scenario = base_inputs['scenario_name']
+    if args.parameter not in base_inputs or not isinstance(base_inputs[args.parameter], (int, float)):
+        parser.error('%s is not a numeric variable of %s' % (args.parameter, args.scenario))
+
+    output_dir = directory_handling(base_inputs, '%s--calibrate_%s' % (scenario, args.parameter))
+
+    data = import_cbsa_inputs()
+    print_input_report(data[2])
+
+    with tempfile.TemporaryDirectory() as temp_cache_dir:
+        result_cache = ResultCache(args.cache_dir or temp_cache_dir, args.cache_max_mb * 1024**2)
+
+        print('\nSolving for the %s at which %s = %s:' % (args.parameter, args.target_metric, args.target))
+        try:
+            value, converged, evaluations = calibrate_parameter(base_inputs, args.parameter, args.target_metric,
+                                                                args.target, data, args.rel_tol, args.max_evals,
+                                                                args.workers, result_cache, show_progress=True)
+        except ValueError as calibration_error:
+            print('Calibration failed: %s' % calibration_error)
+            sys.exit(1)
+
+    evaluations.to_csv('%s/calibration_evaluations.csv' % output_dir, index=False)
+
+    calibrated_inputs = dict(base_inputs, **{args.parameter: float(value)})
+    calibrated_inputs['scenario_name'] = '%s--calibrated_%s' % (scenario, args.parameter)
+    with open('%s/%s_calibrated.yaml' % (output_dir, scenario), 'w') as outfile:
+        yaml.dump(calibrated_inputs, outfile, default_flow_style=False)
+
+    best = evaluations.loc[evaluations.error.abs().idxmin()]
+    print('\n%s %s = %s gives %s = %s (target %s) after %s evaluations' % (
+        'Calibrated:' if converged else 'Not converged within the tolerance, closest:',
+        args.parameter, value, args.target_metric, best[args.target_metric], args.target, len(evaluations)))
+    print('Calibrated scenario written to %s/%s_calibrated.yaml' % (output_dir, scenario))
+
+    if not converged:
+        sys.exit(1)
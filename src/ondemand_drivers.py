@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+
+
+# Driver attributes that can be given a distribution in driver_distributions, after home charging access
+# (which always comes from the CBSA). speed_factor scales the CBSA's median speed
+driver_attributes = ['shift_h', 'veh_kwh', 'speed_factor']
+
+# Bases of the Halton sequence, one per sampled dimension (home charging, then driver_attributes)
+halton_bases = [2, 3, 5, 7]
+
+distribution_types = ['uniform', 'normal', 'lognormal', 'triangular', 'empirical']
+
+
+def halton_points(num_points, num_dims):
+    # First num_points points of the Halton sequence in num_dims dimensions (radical inverse of the point
+    # index in each base). Index 0, the origin, is skipped so that every coordinate is strictly inside (0, 1)
+    index = np.arange(1, num_points + 1)
+    points = np.zeros((num_points, num_dims))
+    for cur_dim, cur_base in enumerate(halton_bases[:num_dims]):
+        remain = index.copy()
+        scale = 1.0 / cur_base
+        while np.any(remain > 0):
+            points[:, cur_dim] = points[:, cur_dim] + (remain % cur_base) * scale
+            remain = remain // cur_base
+            scale = scale / cur_base
+
+    return points
+
+
+def distribution_quantiles(spec, u):
+    # Values of a driver attribute distribution at probabilities u, by its inverse CDF. spec is a dict with
+    # 'dist' and its parameters; 'empirical' takes 'values', either a dict of value: relative weight or a
+    # list of observations (interpolated between). Optional 'min' and 'max' clip the values
+    dist = spec.get('dist')
+    if dist == 'uniform':
+        values = spec['low'] + u * (spec['high'] - spec['low'])
+    elif dist == 'normal':
+        values = np.array([NormalDist(spec['mean'], spec['sd']).inv_cdf(cur_u) for cur_u in u])
+    elif dist == 'lognormal':
+        # Parameterized by the mean and standard deviation of the values, not of their logarithm
+        sigma = np.sqrt(np.log(1 + (spec['sd'] / spec['mean'])**2))
+        mu = np.log(spec['mean']) - sigma**2 / 2
+        values = np.exp(np.array([NormalDist(mu, sigma).inv_cdf(cur_u) for cur_u in u]))
+    elif dist == 'triangular':
+        low, mode, high = spec['low'], spec['mode'], spec['high']
+        mode_prob = (mode - low) / (high - low)
+        values = np.where(u < mode_prob,
+                          low + np.sqrt(u * (high - low) * (mode - low)),
+                          high - np.sqrt((1 - u) * (high - low) * (high - mode)))
+    elif dist == 'empirical' and isinstance(spec['values'], dict):
+        category_values = np.array(sorted(spec['values'].keys()), dtype=float)
+        cum_weight = np.cumsum([spec['values'][cur_value] for cur_value in sorted(spec['values'].keys())])
+        cum_weight = cum_weight / cum_weight[-1]
+        values = category_values[np.minimum(np.searchsorted(cum_weight, u, side='right'), category_values.size - 1)]
+    elif dist == 'empirical':
+        values = np.quantile(np.asarray(spec['values'], dtype=float), u)
+    else:
+        raise ValueError('Unknown driver attribute distribution %s, expected one of %s' % (dist, distribution_types))
+
+    return np.clip(values, spec.get('min', -np.inf), spec.get('max', np.inf))
+
+
+def driver_distribution_specs(global_inputs):
+    # Distribution of each driver attribute: those of driver_distributions, otherwise the discrete
+    # shift_length_dist and veh_kwh_dict (with their exact weights) and no speed variation
+    specs = {'shift_h': {'dist': 'empirical', 'values': global_inputs['shift_length_dist']},
+             'veh_kwh': {'dist': 'empirical', 'values': global_inputs['veh_kwh_dict']},
+             'speed_factor': {'dist': 'uniform', 'low': 1.0, 'high': 1.0}}
+
+    unknown_attributes = [cur_attr for cur_attr in global_inputs['driver_distributions'].keys()
+                          if cur_attr not in driver_attributes]
+    if len(unknown_attributes) > 0:
+        raise ValueError('driver_distributions can only set %s, got %s' % (driver_attributes, unknown_attributes))
+    specs.update(global_inputs['driver_distributions'])
+
+    return specs
+
+
+def sample_driver_profiles(global_inputs, hc_share):
+    # driver_samples driver profiles from a low-discrepancy (Halton) sample of the driver attribute
+    # distributions, each standing for an equal share of the fleet. A share hc_share of them has home
+    # charging. The sample is deterministic, so every CBSA with the same inputs gets the same profiles
+    num_samples = global_inputs['driver_samples']
+    specs = driver_distribution_specs(global_inputs)
+    points = halton_points(num_samples, 1 + len(driver_attributes))
+
+    driver_profiles = pd.DataFrame({'home_chg': (points[:, 0] < hc_share).astype(int)})
+    for cur_dim, cur_attr in enumerate(driver_attributes):
+        driver_profiles[cur_attr] = distribution_quantiles(specs[cur_attr], points[:, cur_dim + 1])
+
+    for cur_attr in driver_attributes:
+        if np.any(driver_profiles[cur_attr] <= 0):
+            raise ValueError('Sampled %s must be positive, set a min for its distribution' % cur_attr)
+    if np.any(driver_profiles.shift_h >= 24):
+        raise ValueError('Sampled shift_h must be shorter than a day, set a max for its distribution')
+
+    return driver_profiles
@@ -1,36 +1,121 @@
 import pandas as pd
-import random
-from ondemand_vehsim import simulate_n_days
-from ondemand_utils import calc_chg_time
+import numpy as np
+from ondemand_vehsim import simulate_n_days, simulate_n_days_batch, SimTrace
+from ondemand_utils import calc_chg_time, data_dir, scenario_chg_time_table, stacked_chg_time_tables, \
+    daily_variation_keys, daily_variation_factors, row_daily_factors
+from ondemand_cache import ResultCache, hash_inputs, get_code_version
+from ondemand_output import ResultWriter, read_results, result_tables
+from ondemand_profile import RunProfiler, timed_call
+from ondemand_loads import cbsa_load_profile, summarize_load_profile
+from ondemand_queue import cbsa_queue_sizing
+from ondemand_agents import VehicleFleet
+from ondemand_drivers import sample_driver_profiles
 import os
+import glob
 from datetime import datetime
 import yaml
 import time
-from tqdm import tqdm, trange
+from tqdm import tqdm
 import warnings
 import sys
+import argparse
+import hashlib
+import copy
+import json
+import cProfile
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Column order of permutation_results.csv
+permutation_columns = ['home_chg', 'shift_h', 'veh_kwh', 'weight', 'dcfc_per_day', 'dcfc_per_day_var',
+                       'miles_per_day', 'chg_time_per_dcfc', 'seek_charge_kwh', 'l2_max_kw', 'sim_days', 'plug_in_mins',
+                       'plug_occupied_time', 'dcfc_kwh_per_day', 'l2_kwh_per_day', 'key',
+                       'cbsa_id', 'cbsa_whmi', 'avg_speed_mph', 'converged_day', 'sample_weight']
+
+# Everything simulate_n_days depends on: scenario variables, and columns of the permutation table
+simulation_input_keys = ['initial_soc', 'sim_days', 'l2_max_kw', 'soc_high', 'steady_state_tol', 'max_cycle_days',
+                         'dcfc_top_up', 'charge_taper', 'veh_max_kw', 'dcfc_max_kw', 'plug_in_mins', 'daily_variation',
+                         'random_seed']
+simulation_input_columns = ['veh_kwh', 'home_chg', 'shift_h', 'avg_speed_mph', 'seek_charge_kwh',
+                            'plug_occupied_time', 'cbsa_whmi']
+# With daily_variation, also the CBSA and the permutation's position in its table, which select its days
+variation_input_columns = ['cbsa_id', 'variation_ix']
+
+# Scenario variables consumed when building and simulating a CBSA's permutations, and when sampling its fleet
+permutation_input_keys = ['shift_length_dist', 'veh_kwh_dict', 'soc_low', 'soc_high', 'charge_taper', 'veh_max_kw',
+                          'dcfc_max_kw', 'plug_in_mins', 'l2_max_kw', 'driver_distributions', 'driver_samples'] + \
+    simulation_input_keys
+fleet_input_keys = ['random_seed', 'fleet_sizing', 'confidence_level', 'replicates',
+                    'load_profile', 'load_profile_bin_h', 'shift_start_dist',
+                    'queue_simulation', 'queue_target_wait_mins', 'queue_days']
+
+# Fleet totals of population_results.csv, in the order returned by sample_populations_to_reach_vmt
+fleet_total_columns = ['num_vehs', 'num_dcfc_events', 'cbsa_dcfc_hours', 'cbsa_dcfc_plug_time',
+                       'cbsa_dcfc_kwh_w_hc', 'cbsa_dcfc_kwh_wo_hc', 'cbsa_l2_kwh']
+
+# Fleet totals summed over CBSAs for each replicate, for the national replicate summary
+replicate_total_columns = fleet_total_columns + ['plugs']
+
+# Describes the CBSAs of a sharded run, written to its output directory
+shard_file = 'shard.json'
+
+# CBSA input files in data_dir, and the cache of their joined table
+cbsa_input_files = ['vmt_by_cbsa.csv', 'median_mph_by_cbsa.csv', 'whmi_by_cbsa.csv', 'overnight_chg_access_by_cbsa.csv']
+cbsa_table_cache = '.cbsa_inputs_cache.pkl'
+
+# Scenario variables without a default, that every scenario must set
+required_inputs = ['base_wh_mi', 'charge_taper', 'dcfc_max_kw', 'deadhead_perc', 'hc_scenario', 'initial_soc', 'l2_max_kw',
+                   'percentile_ambient_conditions', 'plug_in_mins', 'shift_length_dist', 'sim_days', 'soc_high',
+                   'soc_low', 'tnc_share', 'utilization_perc', 'veh_kwh_dict', 'vmt_override_flag']
+
+# Optional scenario variables, used when a scenario .yaml does not set them
+scenario_defaults = {
+    'steady_state_tol': 1e-9,  # SOC tolerance for detecting a repeating day/night cycle, null to disable
+    'max_cycle_days': 7,  # longest repeating cycle (days) looked for
+    'random_seed': 666,  # seed from which each CBSA's random stream is derived
+    'trace_cbsa_ids': [],  # CBSAs for which every permutation's SOC/time trace is written to traces/
+    'cbsa_batch_size': 64,  # CBSAs whose permutations are simulated together in one batch
+    'output_formats': ['parquet', 'csv'],  # written as each CBSA completes, parquet requires pyarrow
+    'fleet_sizing': 'monte_carlo',  # 'monte_carlo' samples drivers, 'analytic' computes expected fleet totals
+    'confidence_level': 0.95,  # of the confidence intervals reported by the analytic fleet sizing
+    'replicates': 0,  # independent Monte Carlo fleet draws per CBSA, summarized in population_results.csv
+    'replicate_percentiles': [5, 50, 95],  # percentiles of the replicate draws that are reported
+    'load_profile': None,  # charging load profile per CBSA: 'day' (average day), 'horizon' (all sim_days) or null
+    'load_profile_bin_h': 1.0,  # width of the load profile's time bins (h), must divide 24
+    'shift_start_dist': {cur_hour: 1 for cur_hour in range(24)},  # relative share of shifts starting at each hour
+    'plug_sizing': 'utilization',  # plugs from DCFC hours and utilization_perc, 'peak' simultaneous sessions or 'queue'
+    'queue_simulation': False,  # size each CBSA's plugs with a discrete-event simulation of its DCFC queue
+    'queue_target_wait_mins': 5,  # mean wait for a plug that the queue simulation sizes plugs for
+    'queue_days': 2,  # last days of the simulation over which the queue is measured, after a day of warm-up
+    'driver_distributions': None,  # continuous or empirical distributions of shift_h, veh_kwh and speed_factor
+    'driver_samples': 512,  # driver profiles sampled per CBSA when driver_distributions is set
+    'dcfc_top_up': False,  # DCFC stops charge only what the rest of the shift needs, timed from the charge curve
+    'daily_variation': None,  # coefficients of variation of random day-to-day shift_h, speed and whmi multipliers
+    'profile_memory': False,  # trace each stage's peak memory in run_profile.json (slower), instead of peak RSS
+    'cprofile': False}  # write cProfile statistics of the run to run_profile.prof
 
 
 def retrieve_cbsa_inputs(global_inputs,
-                         cbsa_mph,
-                         cbsa_vmt,
-                         cbsa_whmi_adjustments,
-                         cbsa_hc_access,
+                         cbsa_table,
                          cur_cbsa_id):
-    
-    avg_speed_mph = cbsa_mph[cbsa_mph.geoid == cur_cbsa_id].median_mph.values[0]
-    pop_cbsa_vmt = cbsa_vmt[cbsa_vmt.cbsa_id == cur_cbsa_id].cbsa_dvmt.values[0]
+
+    cbsa_row = cbsa_table.loc[cur_cbsa_id]
+
+    avg_speed_mph = cbsa_row['median_mph']
+    pop_cbsa_vmt = cbsa_row['cbsa_dvmt']
     cbsa_tnc_vmt = pop_cbsa_vmt * global_inputs['tnc_share'] * (1 + global_inputs['deadhead_perc'])
-    cbsa_hc_access = int(
-        100 * cbsa_hc_access[cbsa_hc_access.cbsa_id == cur_cbsa_id][global_inputs['hc_scenario']].values[0])
-    
+    cbsa_hc_access = int(100 * cbsa_row[global_inputs['hc_scenario']])
+    hc_access_share = float(cbsa_row[global_inputs['hc_scenario']])  # exact, for sampled driver profiles
+
     efficiency_label = str(global_inputs['percentile_ambient_conditions']) + '_perc_penalty'
-    cur_cbsa_whmi = cbsa_whmi_adjustments[cbsa_whmi_adjustments.geoid==cur_cbsa_id][efficiency_label].values[0] * global_inputs['base_wh_mi']
-        
+    cur_cbsa_whmi = cbsa_row[efficiency_label] * global_inputs['base_wh_mi']
+
     cbsa_inputs = {
         'avg_speed_mph': avg_speed_mph,
         'cbsa_tnc_vmt': cbsa_tnc_vmt,
         'cbsa_hc_access': cbsa_hc_access,
+        'hc_access_share': hc_access_share,
         'cbsa_whmi': cur_cbsa_whmi}
 
     return cbsa_inputs
@@ -77,23 +162,66 @@ def scale_values_per_100(variable_dict):
     return scaled_dict
 
 
-def simulate_driver_permutations(home_charging_access_dict,
-                                 global_inputs,
-                                 cbsa_inputs):
+def permutation_chg_time(veh_kwh, global_inputs):
+    # Time (h) of a DCFC charge from soc_low to soc_high
+    if global_inputs['charge_taper'] == 1:
+        dcfc_chg_time_h, chg_time_series, chg_power_series, chg_soc_series = calc_chg_time(veh_kwh,
+                                                                                       global_inputs['veh_max_kw'],
+                                                                                       global_inputs['dcfc_max_kw'],
+                                                                                       global_inputs['soc_low'],
+                                                                                       global_inputs['soc_high'])
+    else:
+        dcfc_chg_time_h = ((global_inputs['soc_high'] - global_inputs['soc_low']) * veh_kwh) / global_inputs['dcfc_max_kw']
+
+    return dcfc_chg_time_h
+
+
+def sample_driver_permutations(home_charging_access_dict,
+                               global_inputs,
+                               cbsa_inputs):
+    # Permutation table of driver_samples driver profiles drawn from the driver_distributions (see
+    # sample_driver_profiles), in place of the product of the discrete distributions. Every profile has
+    # the same sample weight, and the share with home charging is the CBSA's exact (not whole percent) share.
+    # There are no integer-percent weights, so the table has no weight column
+    driver_profiles = sample_driver_profiles(global_inputs, cbsa_inputs['hc_access_share'])
+    num_samples = len(driver_profiles)
+    veh_kwh = driver_profiles.veh_kwh.values
+    chg_time = np.array([permutation_chg_time(cur_veh_kwh, global_inputs) for cur_veh_kwh in veh_kwh])
+
+    cbsa_permutations = pd.DataFrame({'home_chg': driver_profiles.home_chg.values,
+                                      'shift_h': driver_profiles.shift_h.values,
+                                      'veh_kwh': veh_kwh,
+                                      'sample_weight': 1.0 / num_samples,
+                                      'chg_time_per_dcfc': chg_time,
+                                      'seek_charge_kwh': global_inputs['soc_low'] * veh_kwh,
+                                      'l2_max_kw': global_inputs['l2_max_kw'],
+                                      'sim_days': global_inputs['sim_days'],
+                                      'plug_in_mins': global_inputs['plug_in_mins'],
+                                      'plug_occupied_time': global_inputs['plug_in_mins']/60.0 + chg_time,
+                                      'cbsa_whmi': cbsa_inputs['cbsa_whmi'],
+                                      'avg_speed_mph': cbsa_inputs['avg_speed_mph'] * driver_profiles.speed_factor.values})
+    cbsa_permutations['key'] = ['sample_%s' % cur_ix for cur_ix in range(num_samples)]
+
+    return cbsa_permutations
+
+
+def build_driver_permutations(home_charging_access_dict,
+                              global_inputs,
+                              cbsa_inputs):
+    # One row per combination of home charging access, shift length and battery size, weighted by the
+    # product of their shares; or, with driver_distributions, a sample of driver profiles
+    if global_inputs['driver_distributions'] is not None:
+        return sample_driver_permutations(home_charging_access_dict, global_inputs, cbsa_inputs)
+
     home_chg_list = []
     shift_h_list = []
     veh_kwh_list = []
     comb_weight = []
-    comb_dcfc_per_day = []
-    comb_miles = []
+    comb_sample_weight = []
+    comb_chg_time = []
     comb_seek_charge_kwh = []
-    comb_l2_max_kw = []
-    comb_sim_days = []
-    comb_plug_in_time = []
     comb_plug_occupied_time = []
-    comb_dcfc_kwh_per_day = []
-    comb_l2_kwh_per_day = []
-    
+
     vehicle_shift_length_dict = scale_values_per_100(global_inputs['shift_length_dist'])
     vehicle_kwh_dict = scale_values_per_100(global_inputs['veh_kwh_dict'])
 
@@ -101,156 +229,962 @@ def simulate_driver_permutations(home_charging_access_dict,
         for cur_shift_time_h in vehicle_shift_length_dict.keys():
             for cur_veh_kwh in vehicle_kwh_dict.keys():
                 seek_charge_kwh = global_inputs['soc_low'] * cur_veh_kwh
-                
-                permutation_weight = (int(home_charging_access_dict[cur_home_chg] *
-                                          vehicle_shift_length_dict[cur_shift_time_h] *
-                                          vehicle_kwh_dict[cur_veh_kwh] / (100 * 100 * 100) * 100))
-                
-                if global_inputs['charge_taper'] == 1:
-                    dcfc_chg_time_h, chg_time_series, chg_power_series, chg_soc_series = calc_chg_time(cur_veh_kwh,
-                                                                                                   global_inputs[
-                                                                                                       'veh_max_kw'],
-                                                                                                   global_inputs[
-                                                                                                       'dcfc_max_kw'],
-                                                                                                   global_inputs[
-                                                                                                       'soc_low'],
-                                                                                                   global_inputs[
-                                                                                                       'soc_high'])
-                else:
-                    dcfc_chg_time_h = ((global_inputs['soc_high'] - global_inputs['soc_low']) * cur_veh_kwh) / global_inputs['dcfc_max_kw']
-                
-                total_recharge_time = dcfc_chg_time_h + global_inputs['plug_in_mins'] / 60.0 # Adding plug-in penalty
-                
-                veh_soc, time_absolute, dcfc_ct, total_mi, total_dcfc_kwh, total_l2_kwh = simulate_n_days(
-                    cur_veh_kwh,
-                    global_inputs['initial_soc'],
-                    cur_home_chg,
-                    cur_shift_time_h,
-                    cbsa_inputs['avg_speed_mph'],
-                    global_inputs['sim_days'],
-                    seek_charge_kwh,
-                    total_recharge_time,
-                    global_inputs['l2_max_kw'],
-                    cbsa_inputs['cbsa_whmi'],
-                    global_inputs['soc_high'])
-
-                permutation_dcfc_per_day = dcfc_ct / global_inputs['sim_days']
-                permutation_miles_per_day = total_mi / global_inputs['sim_days']
-                permutation_dcfc_kwh_per_day = total_dcfc_kwh / global_inputs['sim_days']
-                permutation_l2_kwh_per_day = total_l2_kwh / global_inputs['sim_days']
-                permutuation_l2_max_kw = global_inputs['l2_max_kw']
-                
+
+                # Share of the fleet with this permutation, and the same share as an integer percent
+                permutation_sample_weight = (home_charging_access_dict[cur_home_chg] *
+                                             vehicle_shift_length_dict[cur_shift_time_h] *
+                                             vehicle_kwh_dict[cur_veh_kwh] / (100 * 100 * 100))
+                permutation_weight = int(permutation_sample_weight * 100)
+
+                dcfc_chg_time_h = permutation_chg_time(cur_veh_kwh, global_inputs)
+
                 home_chg_list.extend([cur_home_chg])
                 shift_h_list.extend([cur_shift_time_h])
                 veh_kwh_list.extend([cur_veh_kwh])
                 comb_weight.extend([permutation_weight])
-                comb_dcfc_per_day.extend([permutation_dcfc_per_day])
-                comb_miles.extend([permutation_miles_per_day])
+                comb_sample_weight.extend([permutation_sample_weight])
+                comb_chg_time.extend([dcfc_chg_time_h])
                 comb_seek_charge_kwh.extend([seek_charge_kwh])
-                comb_l2_max_kw.extend([permutuation_l2_max_kw])
-                comb_sim_days.extend([global_inputs['sim_days']])
-                comb_plug_in_time.extend([global_inputs['plug_in_mins']])
                 comb_plug_occupied_time.extend([global_inputs['plug_in_mins']/60.0 + dcfc_chg_time_h])
-                comb_dcfc_kwh_per_day.extend([permutation_dcfc_kwh_per_day])
-                comb_l2_kwh_per_day.extend([permutation_l2_kwh_per_day])
-
-    cbsa_permutation_results = pd.DataFrame({'home_chg': home_chg_list,
-                                             'shift_h': shift_h_list,
-                                             'veh_kwh': veh_kwh_list,
-                                             'weight': comb_weight,
-                                             'dcfc_per_day': comb_dcfc_per_day,
-                                             'miles_per_day': comb_miles,
-                                             'chg_time_per_dcfc': dcfc_chg_time_h,
-                                             'seek_charge_kwh': comb_seek_charge_kwh,
-                                             'l2_max_kw': comb_l2_max_kw,
-                                             'sim_days': comb_sim_days,
-                                             'plug_in_mins': comb_plug_in_time,
-                                             'plug_occupied_time': comb_plug_occupied_time,
-                                             'dcfc_kwh_per_day': comb_dcfc_kwh_per_day,
-                                             'l2_kwh_per_day': comb_l2_kwh_per_day})
-
-    cbsa_permutation_results['key'] = cbsa_permutation_results.home_chg.astype(str) + "_" + \
-                                      cbsa_permutation_results.shift_h.astype(str) + "_" + \
-                                      cbsa_permutation_results.veh_kwh.astype(str)
+
+    cbsa_permutations = pd.DataFrame({'home_chg': home_chg_list,
+                                      'shift_h': shift_h_list,
+                                      'veh_kwh': veh_kwh_list,
+                                      'weight': comb_weight,
+                                      'sample_weight': comb_sample_weight,
+                                      'chg_time_per_dcfc': comb_chg_time,
+                                      'seek_charge_kwh': comb_seek_charge_kwh,
+                                      'l2_max_kw': global_inputs['l2_max_kw'],
+                                      'sim_days': global_inputs['sim_days'],
+                                      'plug_in_mins': global_inputs['plug_in_mins'],
+                                      'plug_occupied_time': comb_plug_occupied_time,
+                                      'cbsa_whmi': cbsa_inputs['cbsa_whmi'],
+                                      'avg_speed_mph': cbsa_inputs['avg_speed_mph']})
+
+    cbsa_permutations['key'] = cbsa_permutations.home_chg.astype(str) + "_" + \
+                               cbsa_permutations.shift_h.astype(str) + "_" + \
+                               cbsa_permutations.veh_kwh.astype(str)
+
+    return cbsa_permutations
+
+
+def simulate_permutation_table(permutations,
+                               global_inputs,
+                               sim_cache=None):
+    # Simulates every row of a permutation table (one CBSA, or many CBSAs stacked together) in a
+    # single call to the batched vehicle simulation. If a sim_cache dict is given, rows whose simulation
+    # inputs were already simulated (e.g. by an earlier scenario of a sweep) are taken from it.
+    input_columns = simulation_input_columns
+    if global_inputs['daily_variation'] is not None:
+        permutations = permutations.assign(variation_ix=permutations.groupby('cbsa_id', sort=False).cumcount().values)
+        input_columns = simulation_input_columns + variation_input_columns
+
+    if sim_cache is None:
+        sim_results = simulate_permutation_rows(permutations, global_inputs)
+
+    else:
+        global_key = (hash_inputs(*[global_inputs[cur_key] for cur_key in simulation_input_keys]),)
+        row_keys = [global_key + row_key for row_key in
+                    zip(*[permutations[col].values.tolist() for col in input_columns])]
+
+        new_keys = list(dict.fromkeys([row_key for row_key in row_keys if row_key not in sim_cache]))
+        if len(new_keys) > 0:
+            new_rows = pd.DataFrame([row_key[len(global_key):] for row_key in new_keys],
+                                    columns=input_columns)
+            new_results = simulate_permutation_rows(new_rows, global_inputs)
+            sim_cache.update(zip(new_keys, zip(*new_results)))
+
+        sim_results = [np.array(result) for result in zip(*[sim_cache[row_key] for row_key in row_keys])]
+
+    dcfc_ct, total_mi, total_dcfc_kwh, total_l2_kwh, converged_day, total_dcfc_plug_h, total_dcfc_ct_sq = sim_results
+
+    permutations = permutations.copy()
+    if global_inputs['dcfc_top_up']:
+        # Stops vary in length, so the charge and plug times become averages over the permutation's stops
+        plug_in_h = global_inputs['plug_in_mins'] / 60.0
+        charged = dcfc_ct > 0
+        permutations['plug_occupied_time'] = np.where(charged, total_dcfc_plug_h / np.maximum(dcfc_ct, 1),
+                                                      permutations.plug_occupied_time.values)
+        permutations['chg_time_per_dcfc'] = np.where(charged, permutations.plug_occupied_time.values - plug_in_h,
+                                                     permutations.chg_time_per_dcfc.values)
+    permutations['dcfc_per_day'] = dcfc_ct / global_inputs['sim_days']
+    if global_inputs['daily_variation'] is not None:
+        # Variance of a vehicle's number of DCFC events per day, over its simulated days
+        permutations['dcfc_per_day_var'] = np.maximum(total_dcfc_ct_sq / global_inputs['sim_days'] -
+                                                      permutations.dcfc_per_day.values**2, 0)
+    permutations['miles_per_day'] = total_mi / global_inputs['sim_days']
+    permutations['dcfc_kwh_per_day'] = total_dcfc_kwh / global_inputs['sim_days']
+    permutations['l2_kwh_per_day'] = total_l2_kwh / global_inputs['sim_days']
+    permutations['converged_day'] = converged_day
+
+    return permutations[[col for col in permutation_columns if col in permutations.columns]]
+
+
+def simulate_permutation_rows(permutations,
+                              global_inputs):
+    total_recharge_time = permutations.plug_occupied_time.values  # Adding plug-in penalty
+    chg_tables, chg_table_ix = stacked_chg_time_tables(permutations.veh_kwh.values, global_inputs)
+
+    # With daily variation, each CBSA's permutations take their days from the CBSA's stream, in one draw per CBSA
+    daily_factors = None
+    if global_inputs['daily_variation'] is not None:
+        daily_factors = [np.empty((global_inputs['sim_days'], len(permutations))) for cur_key in daily_variation_keys]
+        for cur_cbsa_id, cur_rows in permutations.groupby('cbsa_id', sort=False).indices.items():
+            cbsa_factors = cbsa_daily_factors(global_inputs, cur_cbsa_id, permutations.variation_ix.values[cur_rows])
+            for cur_factors, cur_cbsa_factors in zip(daily_factors, cbsa_factors):
+                cur_factors[:, cur_rows] = cur_cbsa_factors
+
+    return simulate_n_days_batch(
+        permutations.veh_kwh.values,
+        global_inputs['initial_soc'],
+        permutations.home_chg.values,
+        permutations.shift_h.values,
+        permutations.avg_speed_mph.values,
+        global_inputs['sim_days'],
+        permutations.seek_charge_kwh.values,
+        total_recharge_time,
+        global_inputs['l2_max_kw'],
+        permutations.cbsa_whmi.values,
+        global_inputs['soc_high'],
+        global_inputs['steady_state_tol'],
+        global_inputs['max_cycle_days'],
+        chg_tables,
+        chg_table_ix,
+        global_inputs['plug_in_mins'] / 60.0,
+        daily_factors)
+
+
+def simulate_driver_permutations(home_charging_access_dict,
+                                 global_inputs,
+                                 cbsa_inputs):
+
+    cbsa_permutations = build_driver_permutations(home_charging_access_dict,
+                                                  global_inputs,
+                                                  cbsa_inputs)
+
+    cbsa_permutation_results = simulate_permutation_table(cbsa_permutations, global_inputs)
+    total_recharge_time = cbsa_permutation_results.plug_occupied_time.values[-1]
 
     return cbsa_permutation_results, total_recharge_time
 
 
-def explode_driver_permutations(cbsa_permutations):
+def sample_permutation_counts(sample_weight,
+                              miles_per_day,
+                              cbsa_tnc_vmt,
+                              rng,
+                              max_batch=65536):
+    # Draws vehicles (permutation indices, with probability proportional to sample_weight) until the
+    # fleet's daily miles reach cbsa_tnc_vmt, and returns the number of vehicles drawn per permutation.
+    # Draws are made in batches of at most max_batch vehicles, so memory use does not grow with fleet size.
+    sample_weight = np.asarray(sample_weight, dtype=float)
+    miles_per_day = np.asarray(miles_per_day, dtype=float)
+    cum_weight = np.cumsum(sample_weight)
+    cum_weight = cum_weight / cum_weight[-1]
+    mean_miles = np.dot(sample_weight, miles_per_day) / sample_weight.sum()
+
+    counts = np.zeros(sample_weight.size, dtype=np.int64)
+    fleet_miles = 0.0
+
+    if cbsa_tnc_vmt > 0 and mean_miles <= 0:
+        raise ValueError('Sampled vehicles drive no miles, VMT target of %s cannot be reached' % cbsa_tnc_vmt)
 
-    permutation_list = []
-    home_chg_list = []
-    mile_list = []
-    dcfc_per_day_list = []
-    time_per_dcfc_list = []
-    tot_time_per_dcfc_list = []
-    tot_dcfc_kwh_list = []
-    tot_l2_kwh_list = []
-    
-    for ix, cur_row in cbsa_permutations.iterrows():
-        permutation_list.extend([cur_row.key]*cur_row.weight)
-        home_chg_list.extend([cur_row.home_chg]*cur_row.weight)
-        mile_list.extend([cur_row.miles_per_day]*cur_row.weight)
-        dcfc_per_day_list.extend([cur_row.dcfc_per_day]*cur_row.weight)
-        time_per_dcfc_list.extend([cur_row.chg_time_per_dcfc]*cur_row.weight)
-        tot_time_per_dcfc_list.extend([cur_row.plug_occupied_time]*cur_row.weight)
-        tot_dcfc_kwh_list.extend([cur_row.dcfc_kwh_per_day]*cur_row.weight)
-        tot_l2_kwh_list.extend([cur_row.l2_kwh_per_day]*cur_row.weight)
-        
-    return permutation_list, home_chg_list, mile_list, dcfc_per_day_list, time_per_dcfc_list, tot_time_per_dcfc_list, tot_dcfc_kwh_list, tot_l2_kwh_list
-
-
-def sample_populations_to_reach_vmt(permutation_list,
-                      home_chg_list,
-                      mile_list,
-                      dcfc_per_day_list,
-                      time_per_dcfc,
-                      tot_time_per_dcfc_list,
-                      cbsa_tnc_vmt,
-                      tot_dcfc_kwh_list,
-                      tot_l2_kwh_list):
-
-    fleet_miles = 0
-    fleet_dcfc_h = 0
-    ix = 0
-    sampled_permutations = []
-    sampled_miles = []
-    sampled_dcfc_ct = [] # Number of DCFC events per day
-    sampled_dcfc_h = [] # Hours of charging per DCFC event
-    sampled_tot_plug_time_h = [] # Hours of plug use per DCFC event
-    sampled_tot_dcfc_kwh_w_hc = []
-    sampled_tot_dcfc_kwh_wo_hc = []
-    sampled_tot_l2_kwh = []
-    
     while fleet_miles < cbsa_tnc_vmt:
+        batch_size = int(min(max_batch, np.ceil((cbsa_tnc_vmt - fleet_miles) / mean_miles) + 16))
+        sample_ix = np.searchsorted(cum_weight, rng.random(batch_size), side='right')
+        sample_ix = np.minimum(sample_ix, sample_weight.size - 1)
+        cum_miles = fleet_miles + np.cumsum(miles_per_day[sample_ix])
+
+        # First vehicle at which the fleet reaches the VMT target, if reached within this batch
+        crossover_ix = np.searchsorted(cum_miles, cbsa_tnc_vmt, side='left')
+        if crossover_ix < batch_size:
+            sample_ix = sample_ix[:crossover_ix + 1]
+
+        counts = counts + np.bincount(sample_ix, minlength=sample_weight.size)
+        fleet_miles = cum_miles[sample_ix.size - 1]
+
+    return counts
+
+
+def summarize_sampled_fleet(cbsa_permutations, counts):
+    # Fleet totals for a sampled fleet with counts[i] vehicles of permutation i
+    dcfc_events = counts * cbsa_permutations.dcfc_per_day.values
+    home_chg = cbsa_permutations.home_chg.values == 1
+    dcfc_kwh = counts * cbsa_permutations.dcfc_kwh_per_day.values
+
+    num_vehs = int(counts.sum())
+    num_dcfc_events = dcfc_events.sum()
+    tot_dcfc_hours = (dcfc_events * cbsa_permutations.chg_time_per_dcfc.values).sum()  # Hours of charging
+    tot_plug_time_h = (dcfc_events * cbsa_permutations.plug_occupied_time.values).sum()  # Hours of plug use
+    tot_dcfc_kwh_w_hc = dcfc_kwh[home_chg].sum()
+    tot_dcfc_kwh_wo_hc = dcfc_kwh[~home_chg].sum()
+    tot_l2_kwh = (counts * cbsa_permutations.l2_kwh_per_day.values).sum()
+
+    return num_vehs, num_dcfc_events, tot_dcfc_hours, tot_plug_time_h, tot_dcfc_kwh_w_hc, tot_dcfc_kwh_wo_hc, tot_l2_kwh
+
+
+def sample_populations_to_reach_vmt(cbsa_permutations,
+                                    cbsa_tnc_vmt,
+                                    rng):
+
+    counts = sample_permutation_counts(cbsa_permutations.sample_weight.values,
+                                       cbsa_permutations.miles_per_day.values,
+                                       cbsa_tnc_vmt,
+                                       rng)
+
+    return summarize_sampled_fleet(cbsa_permutations, counts)
+
+
+def permutation_fleet_totals(cbsa_permutations):
+    # Contribution of one vehicle of each permutation (columns) to each fleet total of fleet_total_columns (rows)
+    dcfc_events = cbsa_permutations.dcfc_per_day.values
+    home_chg = cbsa_permutations.home_chg.values == 1
+
+    return np.vstack([np.ones(len(cbsa_permutations)),
+                      dcfc_events,
+                      dcfc_events * cbsa_permutations.chg_time_per_dcfc.values,
+                      dcfc_events * cbsa_permutations.plug_occupied_time.values,
+                      cbsa_permutations.dcfc_kwh_per_day.values * home_chg,
+                      cbsa_permutations.dcfc_kwh_per_day.values * ~home_chg,
+                      cbsa_permutations.l2_kwh_per_day.values])
+
+
+def sample_replicate_counts(sample_weight,
+                            miles_per_day,
+                            cbsa_tnc_vmt,
+                            rng,
+                            replicates,
+                            tail_vehicles=64):
+    # Draws the fleets of sample_permutation_counts for many independent replicates at once, and returns the
+    # number of vehicles of each permutation in each replicate (replicates x permutations). Vehicles are iid,
+    # so while a fleet's miles are certain to stay below cbsa_tnc_vmt (k vehicles drive at most k times the
+    # longest daily miles) its next k vehicles are drawn in one multinomial draw. Only the last
+    # (< tail_vehicles at a time) vehicles before the target is reached are drawn one by one.
+    sample_prob = np.asarray(sample_weight, dtype=float) / np.sum(sample_weight)
+    miles_per_day = np.asarray(miles_per_day, dtype=float)
+    cum_prob = np.cumsum(sample_prob)
+    cum_prob = cum_prob / cum_prob[-1]
+    max_miles = miles_per_day.max()
+    num_permutations = sample_prob.size
+
+    counts = np.zeros((replicates, num_permutations), dtype=np.int64)
+    fleet_miles = np.zeros(replicates)
+
+    if cbsa_tnc_vmt <= 0:
+        return counts
+    if np.dot(sample_prob, miles_per_day) <= 0:
+        raise ValueError('Sampled vehicles drive no miles, VMT target of %s cannot be reached' % cbsa_tnc_vmt)
+
+    safe_vehs = np.ceil((cbsa_tnc_vmt - fleet_miles) / max_miles).astype(np.int64) - 1
+    while safe_vehs.max() >= tail_vehicles:
+        bulk_counts = rng.multinomial(np.maximum(safe_vehs, 0), sample_prob)
+        counts = counts + bulk_counts
+        fleet_miles = fleet_miles + bulk_counts @ miles_per_day
+        safe_vehs = np.ceil((cbsa_tnc_vmt - fleet_miles) / max_miles).astype(np.int64) - 1
+
+    active = np.flatnonzero(fleet_miles < cbsa_tnc_vmt)
+    while active.size > 0:
+        sample_ix = np.searchsorted(cum_prob, rng.random((active.size, tail_vehicles)), side='right')
+        sample_ix = np.minimum(sample_ix, num_permutations - 1)
+        cum_miles = fleet_miles[active, None] + np.cumsum(miles_per_day[sample_ix], axis=1)
+
+        # Vehicles up to and including the first at which the fleet reaches the VMT target
+        reached = cum_miles >= cbsa_tnc_vmt
+        last_ix = np.where(reached.any(axis=1), reached.argmax(axis=1), tail_vehicles - 1)
+        drawn = np.arange(tail_vehicles) <= last_ix[:, None]
+
+        row_ix = np.broadcast_to(np.arange(active.size)[:, None], sample_ix.shape)
+        counts[active] = counts[active] + np.bincount((row_ix * num_permutations + sample_ix)[drawn],
+                                                      minlength=active.size * num_permutations).reshape(active.size, -1)
+        fleet_miles[active] = cum_miles[np.arange(active.size), last_ix]
+        active = active[fleet_miles[active] < cbsa_tnc_vmt]
+
+    return counts
+
+
+def sample_fleet_replicates(cbsa_permutations,
+                            cbsa_tnc_vmt,
+                            rng,
+                            replicates):
+    # Fleet totals of independent Monte Carlo draws of a CBSA's fleet, one row per replicate
+    counts = sample_replicate_counts(cbsa_permutations.sample_weight.values,
+                                     cbsa_permutations.miles_per_day.values,
+                                     cbsa_tnc_vmt,
+                                     rng,
+                                     replicates)
+
+    replicate_results = pd.DataFrame(counts @ permutation_fleet_totals(cbsa_permutations).T,
+                                     columns=fleet_total_columns)
+    replicate_results['num_vehs'] = counts.sum(axis=1)
+    replicate_results.insert(0, 'replicate', np.arange(replicates))
+
+    return replicate_results
+
+
+def summarize_replicates(replicate_results, percentiles):
+    # Mean, standard deviation and percentiles over replicates of vehicles, plugs and DCFC and L2 kWh
+    replicate_totals = {'num_vehs': replicate_results.num_vehs.values,
+                        'plugs': replicate_results.plugs.values,
+                        'cbsa_dcfc_kwh': replicate_results.cbsa_dcfc_kwh_w_hc.values + replicate_results.cbsa_dcfc_kwh_wo_hc.values,
+                        'cbsa_l2_kwh': replicate_results.cbsa_l2_kwh.values}
+
+    replicate_summary = {}
+    for cur_total in replicate_totals.keys():
+        replicate_summary[cur_total + '_mean'] = replicate_totals[cur_total].mean()
+        replicate_summary[cur_total + '_std'] = replicate_totals[cur_total].std(ddof=1)
+        for cur_percentile in percentiles:
+            replicate_summary[cur_total + '_p%s' % cur_percentile] = np.percentile(replicate_totals[cur_total], cur_percentile)
+
+    return replicate_summary
+
+
+def expected_populations_to_reach_vmt(cbsa_permutations,
+                                      cbsa_tnc_vmt,
+                                      confidence_level=0.95):
+    # Expected fleet totals of sample_populations_to_reach_vmt, without sampling. Vehicles are drawn
+    # independently until their miles reach cbsa_tnc_vmt, so the fleet is a renewal process in miles:
+    # the expected number of vehicles is (VMT + expected overshoot of the last vehicle) / mean miles, and
+    # by Wald's identity each expected total is that times the mean per-vehicle value. The renewal-reward
+    # CLT gives each total's variance as VMT / mean miles * Var(x - mean x / mean miles * miles).
+    # Returns the expected totals and the (low, high) bounds of their confidence intervals, in the order of
+    # fleet_total_columns.
+    sample_prob = cbsa_permutations.sample_weight.values / cbsa_permutations.sample_weight.values.sum()
+    miles_per_day = cbsa_permutations.miles_per_day.values
+    veh_totals = permutation_fleet_totals(cbsa_permutations)
+
+    if cbsa_tnc_vmt <= 0:
+        zero_totals = np.zeros(veh_totals.shape[0])
+        return zero_totals, zero_totals, zero_totals
+
+    mean_miles = np.dot(sample_prob, miles_per_day)
+    if mean_miles <= 0:
+        raise ValueError('Sampled vehicles drive no miles, VMT target of %s cannot be reached' % cbsa_tnc_vmt)
+
+    expected_overshoot = np.dot(sample_prob, miles_per_day**2) / (2 * mean_miles)
+    expected_vehs = (cbsa_tnc_vmt + expected_overshoot) / mean_miles
+    mean_totals = veh_totals @ sample_prob
+    expected_totals = expected_vehs * mean_totals
+
+    ratio_residuals = veh_totals - np.outer(mean_totals / mean_miles, miles_per_day)
+    total_std = np.sqrt(cbsa_tnc_vmt / mean_miles * (ratio_residuals**2 @ sample_prob))
+    z = NormalDist().inv_cdf(0.5 + confidence_level / 2)
+
+    return expected_totals, expected_totals - z * total_std, expected_totals + z * total_std
+
+
+# Child random streams of each CBSA (see cbsa_random_state)
+replicate_stream = 0
+queue_stream = 1
+daily_variation_stream = 2
+
+
+def cbsa_random_state(global_inputs, cur_cbsa_id, child_stream=None):
+    # Independent random stream per CBSA, derived from the scenario seed and the CBSA id so that
+    # sampled fleets do not depend on the order (or process) in which CBSAs are run. Further draws
+    # (replicate_stream, queue_stream, daily_variation_stream) use child streams, so that they leave the main
+    # draw unchanged
+    seed_seq = np.random.SeedSequence([global_inputs['random_seed'], int(cur_cbsa_id)])
+    if child_stream is not None:
+        seed_seq = seed_seq.spawn(child_stream + 1)[child_stream]
+
+    return np.random.default_rng(seed_seq)
+
+
+def cbsa_daily_factors(global_inputs, cur_cbsa_id, stream_ix):
+    # Daily variation factors (see daily_variation_factors) of the permutations at positions stream_ix of a
+    # CBSA's permutation table, or None without daily variation
+    if global_inputs['daily_variation'] is None:
+        return None
+
+    return daily_variation_factors(stream_ix, global_inputs,
+                                   cbsa_random_state(global_inputs, cur_cbsa_id, daily_variation_stream))
+
+
+def calc_miles_to_electrify(global_inputs, cbsa_inputs, cur_cbsa_id):
+
+    # Fehr and Peers report gave VMT for 6 CBSAs, using those here if inputs allow for it, "overriding" globally assumed 1%
+    if global_inputs['vmt_override_flag'] == 1:
+        fehr_and_peers_values = {31080: 1.5/100.0, # la
+                            42660: 1.9/100.0, # seattle
+                            41860: 2.7/100.0, # sf
+                            47900: 1.9/100.0, # DC
+                            14460: 1.9/100.0, # boston
+                            16980: 2.1/100.0} # CHICAGO
+
+        if cur_cbsa_id in fehr_and_peers_values.keys():
+            miles_to_electrify = cbsa_inputs['cbsa_tnc_vmt'] / global_inputs['tnc_share'] * fehr_and_peers_values[cur_cbsa_id]
 
-        cur_sample_ix = random.randint(0, len(permutation_list)-1)
-        cur_permutation = permutation_list[cur_sample_ix]
-        cur_miles = mile_list[cur_sample_ix]
-        cur_dcfc_ct = dcfc_per_day_list[cur_sample_ix]
-        cur_dcfc_h = time_per_dcfc[cur_sample_ix] * cur_dcfc_ct
-        cur_tot_plug_time_h = tot_time_per_dcfc_list[cur_sample_ix] * cur_dcfc_ct
-        cur_l2_kwh_per_day = tot_l2_kwh_list[cur_sample_ix]
-        
-        if home_chg_list[cur_sample_ix]==1:
-            cur_dcfc_kwh_per_day_w_hc = tot_dcfc_kwh_list[cur_sample_ix]
-            cur_dcfc_kwh_per_day_wo_hc = 0
         else:
-            cur_dcfc_kwh_per_day_w_hc = 0
-            cur_dcfc_kwh_per_day_wo_hc = tot_dcfc_kwh_list[cur_sample_ix]
-        
-        sampled_permutations.extend([cur_permutation])
-        sampled_miles.extend([cur_miles])
-        sampled_dcfc_ct.extend([cur_dcfc_ct])
-        sampled_dcfc_h.extend([cur_dcfc_h])
-        sampled_tot_plug_time_h.extend([cur_tot_plug_time_h])
-        sampled_tot_dcfc_kwh_w_hc.extend([cur_dcfc_kwh_per_day_w_hc])
-        sampled_tot_dcfc_kwh_wo_hc.extend([cur_dcfc_kwh_per_day_wo_hc])
-        sampled_tot_l2_kwh.extend([cur_l2_kwh_per_day])
-        
-        fleet_miles = fleet_miles + cur_miles
+            miles_to_electrify = cbsa_inputs['cbsa_tnc_vmt']
+
+    else:
+        miles_to_electrify = cbsa_inputs['cbsa_tnc_vmt']
+
+    return miles_to_electrify
+
+
+def simulate_cbsa_fleet(cur_cbsa_id,
+                        cbsa_permutation_results,
+                        cbsa_inputs,
+                        global_inputs):
+
+    miles_to_electrify = calc_miles_to_electrify(global_inputs, cbsa_inputs, cur_cbsa_id)
+
+    if global_inputs['fleet_sizing'] == 'analytic':
+        expected_totals, totals_ci_low, totals_ci_high = expected_populations_to_reach_vmt(
+            cbsa_permutation_results,
+            miles_to_electrify,
+            global_inputs['confidence_level'])
+        num_vehs, num_dcfc_events, tot_dcfc_hours, tot_plug_time_h, tot_dcfc_kwh_w_hc, tot_dcfc_kwh_wo_hc, tot_l2_kwh = expected_totals
+
+    elif global_inputs['fleet_sizing'] == 'monte_carlo':
+        num_vehs, num_dcfc_events, tot_dcfc_hours, tot_plug_time_h, tot_dcfc_kwh_w_hc, tot_dcfc_kwh_wo_hc, tot_l2_kwh = sample_populations_to_reach_vmt(
+            cbsa_permutation_results,
+            miles_to_electrify,
+            cbsa_random_state(global_inputs, cur_cbsa_id))
+
+    else:
+        raise ValueError("fleet_sizing must be 'monte_carlo' or 'analytic', got %s" % global_inputs['fleet_sizing'])
+
+    fleet_results = {
+        'cbsa_id': [cur_cbsa_id],
+        'num_vehs': [num_vehs],
+        'num_dcfc_events': [num_dcfc_events],
+        'cbsa_dcfc_hours': [tot_dcfc_hours],
+        'cbsa_dcfc_plug_time': [tot_plug_time_h],
+        'cbsa_tnc_vmt': [miles_to_electrify],
+        'cbsa_hc_access': [cbsa_inputs['cbsa_hc_access']],
+        'cbsa_avg_speed': [cbsa_inputs['avg_speed_mph']],
+        'cbsa_whmi': [cbsa_inputs['cbsa_whmi']],
+        'cbsa_dcfc_kwh_w_hc': [tot_dcfc_kwh_w_hc],
+        'cbsa_dcfc_kwh_wo_hc': [tot_dcfc_kwh_wo_hc],
+        'cbsa_l2_kwh': [tot_l2_kwh]}
+
+    # Columns are collected before the one-row frame is built, which is far cheaper than adding them to it
+    if global_inputs['fleet_sizing'] == 'analytic':
+        for cur_col, cur_ci_low, cur_ci_high in zip(fleet_total_columns, totals_ci_low, totals_ci_high):
+            fleet_results[cur_col + '_ci_low'] = [cur_ci_low]
+            fleet_results[cur_col + '_ci_high'] = [cur_ci_high]
+
+    return pd.DataFrame(fleet_results)
+
+
+def fleet_composition(cur_cbsa_id,
+                      cbsa_permutation_results,
+                      cur_tnc_population_results,
+                      global_inputs):
+    # Number of vehicles of each permutation in the CBSA's fleet (of simulate_cbsa_fleet's population
+    # results): the main Monte Carlo draw (from a fresh copy of the same random stream), or with analytic
+    # fleet sizing the expected number of vehicles split by sampling probability
+    if global_inputs['fleet_sizing'] == 'analytic':
+        sample_prob = cbsa_permutation_results.sample_weight.values / cbsa_permutation_results.sample_weight.values.sum()
+        return cur_tnc_population_results.num_vehs.values[0] * sample_prob
+
+    return sample_permutation_counts(cbsa_permutation_results.sample_weight.values,
+                                     cbsa_permutation_results.miles_per_day.values,
+                                     cur_tnc_population_results.cbsa_tnc_vmt.values[0],
+                                     cbsa_random_state(global_inputs, cur_cbsa_id))
+
+
+def sample_cbsa_fleet(cur_cbsa_id,
+                      cbsa_permutation_results,
+                      cbsa_inputs,
+                      global_inputs):
+    # A CBSA's fleet results: its population results, with replicates (Monte Carlo fleet sizing only) the
+    # fleet totals of that many further independent draws, and with load_profile its charging load profile.
+    # Tables that are not produced are None. With queue_simulation, the plugs found by the charging queue
+    # simulation are added to the population results. The time (s) taken by each profiler stage other than
+    # the fleet sampling itself (replicates, load profile, queue) is returned in stage_seconds
+    stage_seconds = {}
+    cur_tnc_population_results = simulate_cbsa_fleet(cur_cbsa_id, cbsa_permutation_results, cbsa_inputs, global_inputs)
+    miles_to_electrify = cur_tnc_population_results.cbsa_tnc_vmt.values[0]
+
+    if global_inputs['replicates'] > 0 and global_inputs['fleet_sizing'] == 'monte_carlo':
+        replicate_start = time.perf_counter()
+        replicate_results = sample_fleet_replicates(cbsa_permutation_results,
+                                                    miles_to_electrify,
+                                                    cbsa_random_state(global_inputs, cur_cbsa_id, replicate_stream),
+                                                    global_inputs['replicates'])
+        replicate_results.insert(0, 'cbsa_id', cur_cbsa_id)
+        stage_seconds['sample_fleet_replicates'] = time.perf_counter() - replicate_start
+    else:
+        replicate_results = None
+
+    # The days of each permutation, re-simulated for the load profile and the queue simulation
+    daily_factors = None
+    if global_inputs['load_profile'] is not None or global_inputs['queue_simulation']:
+        daily_factors = cbsa_daily_factors(global_inputs, cur_cbsa_id, np.arange(len(cbsa_permutation_results)))
+
+    # Vehicles of each permutation, shared by the load profile, the DCFC event spread and the queue simulation
+    vehicle_counts = None
+    if (global_inputs['load_profile'] is not None or global_inputs['daily_variation'] is not None or
+            global_inputs['queue_simulation']):
+        vehicle_counts = fleet_composition(cur_cbsa_id, cbsa_permutation_results, cur_tnc_population_results,
+                                           global_inputs)
+
+    if global_inputs['load_profile'] is not None:
+        load_profile_start = time.perf_counter()
+        load_profile = cbsa_load_profile(cbsa_permutation_results,
+                                         vehicle_counts,
+                                         global_inputs,
+                                         daily_factors)
+        load_profile_summary = summarize_load_profile(load_profile)
+        for cur_col in load_profile_summary.keys():
+            cur_tnc_population_results[cur_col] = load_profile_summary[cur_col]
+        load_profile.insert(0, 'cbsa_id', cur_cbsa_id)
+        stage_seconds['cbsa_load_profile'] = time.perf_counter() - load_profile_start
+    else:
+        load_profile = None
+
+    if global_inputs['daily_variation'] is not None:
+        # Day-to-day spread of the fleet's DCFC events. All vehicles of a permutation drive the same days, so
+        # their events vary together, while different permutations draw their days independently
+        cur_tnc_population_results['num_dcfc_events_var'] = np.dot(vehicle_counts**2,
+                                                                   cbsa_permutation_results.dcfc_per_day_var.values)
+        cur_tnc_population_results['num_dcfc_events_std'] = np.sqrt(cur_tnc_population_results.num_dcfc_events_var)
+
+    if global_inputs['queue_simulation']:
+        queue_start = time.perf_counter()
+        queue_rng = cbsa_random_state(global_inputs, cur_cbsa_id, queue_stream)
+        queue_counts = vehicle_counts
+        if global_inputs['fleet_sizing'] == 'analytic':
+            # Expected counts are rounded to whole vehicles, up with probability equal to their fraction
+            queue_counts = np.floor(vehicle_counts + queue_rng.random(vehicle_counts.size))
+        queue_results = cbsa_queue_sizing(cbsa_permutation_results, queue_counts.astype(np.int64), global_inputs,
+                                          queue_rng, daily_factors)
+        for cur_col in queue_results.keys():
+            cur_tnc_population_results[cur_col] = queue_results[cur_col]
+        stage_seconds['simulate_charging_queue'] = time.perf_counter() - queue_start
+
+    return {'population': cur_tnc_population_results,
+            'replicates': replicate_results,
+            'load_profiles': load_profile,
+            'stage_seconds': stage_seconds}
+
+
+def simulate_cbsa_fleets(permutation_results,
+                         cbsa_inputs_by_id,
+                         global_inputs,
+                         executor=None):
+    # Yields each CBSA's fleet results (see sample_cbsa_fleet) and the time (s) taken to sample them, in
+    # the order of cbsa_inputs_by_id. With a process pool executor the CBSAs are spread over its workers; per-CBSA
+    # random streams keep the results identical to a sequential run
+    cbsa_ids = list(cbsa_inputs_by_id.keys())
+    cbsa_permutation_tables = dict(list(permutation_results.groupby('cbsa_id', sort=False)))
+    fleet_args = ([sample_cbsa_fleet] * len(cbsa_ids),
+                  cbsa_ids,
+                  [cbsa_permutation_tables[cur_cbsa_id] for cur_cbsa_id in cbsa_ids],
+                  [cbsa_inputs_by_id[cur_cbsa_id] for cur_cbsa_id in cbsa_ids],
+                  [global_inputs] * len(cbsa_ids))
+
+    if executor is not None:
+        for cbsa_fleet_results, sample_time in executor.map(timed_call, *fleet_args, chunksize=4):
+            yield cbsa_fleet_results, sample_time
+    else:
+        for cbsa_fleet_results, sample_time in map(timed_call, *fleet_args):
+            yield cbsa_fleet_results, sample_time
+
+
+def build_permutation_table(global_inputs,
+                            cbsa_table,
+                            cbsa_ids,
+                            profiler=None):
+    # Driver permutations of every CBSA, stacked into one (not yet simulated) table
+    if profiler is None:
+        profiler = RunProfiler()
+
+    cbsa_inputs_by_id = {}
+    cbsa_permutation_tables = []
+    for cur_cbsa_id in cbsa_ids:
+        with profiler.stage('retrieve_cbsa_inputs', [cur_cbsa_id]):
+            cbsa_inputs = retrieve_cbsa_inputs(global_inputs,
+                                               cbsa_table,
+                                               cur_cbsa_id)
+
+        with profiler.stage('build_driver_permutations', [cur_cbsa_id]):
+            home_charging_access_dict = define_variable_frequencies(cbsa_inputs)
+
+            cbsa_permutations = build_driver_permutations(home_charging_access_dict,
+                                                          global_inputs,
+                                                          cbsa_inputs)
+            cbsa_permutations['cbsa_id'] = cur_cbsa_id
 
-    return len(sampled_permutations), sum(sampled_dcfc_ct), sum(sampled_dcfc_h), sum(sampled_tot_plug_time_h), sum(sampled_tot_dcfc_kwh_w_hc), sum(sampled_tot_dcfc_kwh_wo_hc), sum(sampled_tot_l2_kwh)
+        cbsa_inputs_by_id[cur_cbsa_id] = cbsa_inputs
+        cbsa_permutation_tables.append(cbsa_permutations)
+
+    return cbsa_inputs_by_id, pd.concat(cbsa_permutation_tables, ignore_index=True)
+
+
+# Values of plug_sizing (see size_charging_plugs)
+plug_sizing_methods = ['utilization', 'peak', 'queue']
+
+
+def check_plug_sizing(global_inputs):
+    # Raises if plug_sizing is unknown, or sizes plugs from results the scenario does not produce
+    if global_inputs['plug_sizing'] not in plug_sizing_methods:
+        raise ValueError('plug_sizing must be one of %s, got %s' % (plug_sizing_methods, global_inputs['plug_sizing']))
+    if global_inputs['plug_sizing'] == 'peak' and global_inputs['load_profile'] is None:
+        raise ValueError('plug_sizing: peak sizes plugs from the load profile, set load_profile')
+    if global_inputs['plug_sizing'] == 'queue' and not global_inputs['queue_simulation']:
+        raise ValueError('plug_sizing: queue sizes plugs from the queue simulation, set queue_simulation: true')
+
+    return
+
+
+def size_charging_plugs(tnc_population_results, global_inputs):
+
+    tnc_population_results = tnc_population_results.copy()
+    hours_per_charger = 24 * global_inputs['utilization_perc']
+#     tnc_population_results['plugs'] = tnc_population_results.cbsa_dcfc_plug_time / hours_per_charger # This includes plugging in and out in utilization
+    tnc_population_results['plugs'] = tnc_population_results.cbsa_dcfc_hours / hours_per_charger # This includes plugging in and out in utilization
+    if global_inputs['plug_sizing'] == 'peak' and 'peak_dcfc_sessions' in tnc_population_results.columns:
+        # Enough plugs for the most simultaneous DCFC sessions of the load profile. The profile averages over
+        # days and within each bin, so this is a lower bound that leaves no margin for fluctuations
+        tnc_population_results['plugs'] = np.ceil(tnc_population_results.peak_dcfc_sessions)
+    elif global_inputs['plug_sizing'] == 'queue' and 'queue_plugs' in tnc_population_results.columns:
+        # Fewest plugs meeting the target wait in the charging queue simulation
+        tnc_population_results['plugs'] = tnc_population_results.queue_plugs.astype(float)
+    elif 'cbsa_dcfc_hours_ci_low' in tnc_population_results.columns:
+        tnc_population_results['plugs_ci_low'] = tnc_population_results.cbsa_dcfc_hours_ci_low / hours_per_charger
+        tnc_population_results['plugs_ci_high'] = tnc_population_results.cbsa_dcfc_hours_ci_high / hours_per_charger
+
+    return tnc_population_results
+
+
+def permutation_cache_key(global_inputs, cbsa_inputs, cur_cbsa_id):
+    # Content address of a CBSA's simulated permutation table. With daily variation the CBSA id selects the
+    # random stream of its days
+    return hash_inputs(get_code_version(),
+                       [global_inputs[cur_key] for cur_key in permutation_input_keys],
+                       float(cbsa_inputs['avg_speed_mph']),
+                       int(cbsa_inputs['cbsa_hc_access']),
+                       float(cbsa_inputs['hc_access_share']),
+                       float(cbsa_inputs['cbsa_whmi']),
+                       int(cur_cbsa_id) if global_inputs['daily_variation'] is not None else None)
+
+
+def fleet_cache_key(permutation_key, global_inputs, cbsa_inputs, cur_cbsa_id):
+    # Content address of a CBSA's sampled fleet. The CBSA id selects its random stream
+    return hash_inputs(permutation_key,
+                       [global_inputs[cur_key] for cur_key in fleet_input_keys],
+                       int(cur_cbsa_id),
+                       float(calc_miles_to_electrify(global_inputs, cbsa_inputs, cur_cbsa_id)))
+
+
+def iterate_scenario(global_inputs,
+                     cbsa_table,
+                     cbsa_ids,
+                     workers=1,
+                     sim_cache=None,
+                     result_cache=None,
+                     profiler=None):
+    # Yields (cbsa_id, cbsa_results) for every CBSA, in order. cbsa_results maps the tables of result_tables
+    # ('permutations', 'population', 'replicates', 'load_profiles') to the CBSA's results, or to None for
+    # tables the scenario does not produce.
+    # CBSAs are processed in chunks of cbsa_batch_size: a chunk's driver permutations are stacked and
+    # simulated in one batch, then its fleets are sampled, so memory use does not grow with the number of CBSAs.
+    # If a ResultCache is given, each CBSA's permutation table and sampled fleet are looked up by content
+    # address first, and only CBSAs whose inputs changed are simulated and sampled.
+    # Stage times are recorded in profiler, if one is given
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = None
+
+    try:
+        for chunk_start in range(0, len(cbsa_ids), global_inputs['cbsa_batch_size']):
+            chunk_ids = cbsa_ids[chunk_start:chunk_start + global_inputs['cbsa_batch_size']]
+            chunk_results = simulate_cbsa_chunk(global_inputs, cbsa_table, chunk_ids, executor, sim_cache, result_cache,
+                                                profiler)
+            for cur_cbsa_results in chunk_results:
+                yield cur_cbsa_results
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def simulation_shares(permutations, cbsa_ids):
+    # Each CBSA's share of the rows of a stacked permutation table
+    row_counts = permutations.cbsa_id.value_counts()
+
+    return [row_counts.get(cur_cbsa_id, 0) / len(permutations) for cur_cbsa_id in cbsa_ids]
+
+
+def simulate_cbsa_chunk(global_inputs,
+                        cbsa_table,
+                        cbsa_ids,
+                        executor=None,
+                        sim_cache=None,
+                        result_cache=None,
+                        profiler=None):
+    if profiler is None:
+        profiler = RunProfiler()
+
+    cbsa_inputs_by_id, permutations = build_permutation_table(global_inputs, cbsa_table, cbsa_ids, profiler)
+
+    if result_cache is None:
+        # The batched simulation time is attributed to CBSAs by their share of the permutation rows
+        with profiler.stage('simulate_driver_permutations', cbsa_ids, simulation_shares(permutations, cbsa_ids)):
+            permutation_results = simulate_permutation_table(permutations, global_inputs, sim_cache)
+        cached_fleets = {}
+
+    else:
+        permutation_keys = {}
+        cbsa_permutation_results = {}
+        for cur_cbsa_id in cbsa_ids:
+            permutation_keys[cur_cbsa_id] = permutation_cache_key(global_inputs, cbsa_inputs_by_id[cur_cbsa_id],
+                                                                  cur_cbsa_id)
+            cached_permutations = result_cache.get('permutations', permutation_keys[cur_cbsa_id])
+            if cached_permutations is not None:
+                cached_permutations['cbsa_id'] = cur_cbsa_id
+                cbsa_permutation_results[cur_cbsa_id] = cached_permutations
+
+        new_permutations = permutations[~permutations.cbsa_id.isin(list(cbsa_permutation_results.keys()))]
+        if len(new_permutations) > 0:
+            new_cbsa_ids = list(dict.fromkeys(new_permutations.cbsa_id.tolist()))
+            with profiler.stage('simulate_driver_permutations', new_cbsa_ids,
+                                simulation_shares(new_permutations, new_cbsa_ids)):
+                new_permutation_results = simulate_permutation_table(new_permutations, global_inputs, sim_cache)
+            for cur_cbsa_id, cur_permutation_results in new_permutation_results.groupby('cbsa_id', sort=False):
+                result_cache.put('permutations', permutation_keys[cur_cbsa_id], cur_permutation_results)
+                cbsa_permutation_results[cur_cbsa_id] = cur_permutation_results
+
+        permutation_results = pd.concat([cbsa_permutation_results[cur_cbsa_id] for cur_cbsa_id in cbsa_ids],
+                                        ignore_index=True)
+
+        fleet_keys = {}
+        cached_fleets = {}
+        for cur_cbsa_id in cbsa_ids:
+            fleet_keys[cur_cbsa_id] = fleet_cache_key(permutation_keys[cur_cbsa_id], global_inputs,
+                                                      cbsa_inputs_by_id[cur_cbsa_id], cur_cbsa_id)
+            cached_fleet = result_cache.get('fleet', fleet_keys[cur_cbsa_id])
+            if cached_fleet is not None:
+                cached_fleets[cur_cbsa_id] = cached_fleet
+
+    new_fleets = simulate_cbsa_fleets(permutation_results[~permutation_results.cbsa_id.isin(list(cached_fleets.keys()))],
+                                      {cur_cbsa_id: cbsa_inputs_by_id[cur_cbsa_id] for cur_cbsa_id in cbsa_ids
+                                       if cur_cbsa_id not in cached_fleets},
+                                      global_inputs,
+                                      executor)
+    cbsa_permutation_tables = dict(list(permutation_results.groupby('cbsa_id', sort=False)))
+
+    for cur_cbsa_id in cbsa_ids:
+        if cur_cbsa_id in cached_fleets:
+            cbsa_results = dict(cached_fleets[cur_cbsa_id])
+        else:
+            cbsa_results, sample_time = next(new_fleets)
+            # The fleet sampling stage only counts the time not taken by the other stages of sample_cbsa_fleet
+            stage_seconds = cbsa_results.pop('stage_seconds')
+            for cur_stage in stage_seconds.keys():
+                profiler.add(cur_stage, stage_seconds[cur_stage], [cur_cbsa_id],
+                             events=cbsa_results['population'].queue_events.values[0]
+                             if cur_stage == 'simulate_charging_queue' else None)
+            profiler.add('sample_populations_to_reach_vmt', sample_time - sum(stage_seconds.values()), [cur_cbsa_id])
+            if result_cache is not None:
+                result_cache.put('fleet', fleet_keys[cur_cbsa_id], cbsa_results)
+
+        cbsa_results['population'] = size_charging_plugs(cbsa_results['population'], global_inputs)
+
+        if cbsa_results['replicates'] is not None:
+            cbsa_results['replicates'] = size_charging_plugs(cbsa_results['replicates'], global_inputs)
+            replicate_summary = summarize_replicates(cbsa_results['replicates'], global_inputs['replicate_percentiles'])
+            for cur_col in replicate_summary.keys():
+                cbsa_results['population'][cur_col] = replicate_summary[cur_col]
+
+        cbsa_results['permutations'] = cbsa_permutation_tables[cur_cbsa_id]
+
+        yield cur_cbsa_id, cbsa_results
+
+    new_fleets.close()
+
+
+def simulate_scenario(global_inputs,
+                      cbsa_table,
+                      cbsa_ids,
+                      workers=1,
+                      sim_cache=None,
+                      show_progress=False,
+                      result_cache=None,
+                      profiler=None):
+    # Runs a scenario and collects all CBSAs' results in memory, as a dict of tables like the cbsa_results
+    # of iterate_scenario. Tables the scenario does not produce are None
+    check_plug_sizing(global_inputs)
+    scenario_results = {}
+
+    with tqdm(iterate_scenario(global_inputs, cbsa_table, cbsa_ids, workers, sim_cache, result_cache, profiler),
+              total=len(cbsa_ids), disable=not show_progress) as t:
+
+        for cur_t, (cur_cbsa_id, cbsa_results) in enumerate(t):
+
+            t.set_description('CBSA %i' % cur_t)
+
+            for table in cbsa_results.keys():
+                if cbsa_results[table] is not None:
+                    scenario_results.setdefault(table, []).append(cbsa_results[table])
+
+    return {table: pd.concat(scenario_results[table], ignore_index=True) if table in scenario_results else None
+            for table in result_tables.keys()}
+
+
+def run_scenario(inputs_dict,
+                 data=None,
+                 cbsa_ids=None,
+                 workers=1,
+                 sim_cache=None,
+                 result_cache=None,
+                 profiler=None):
+    # Programmatic entry point: runs the scenario defined by inputs_dict (the variables of a scenario .yaml,
+    # optional ones may be left out) and returns its results in memory, as the dict of tables of
+    # simulate_scenario. Nothing is written or printed. data are the CBSA inputs, as returned by
+    # import_cbsa_inputs, so that repeated calls do not reload them; a directory name loads them from there,
+    # and None from the repository's data directory. cbsa_ids limits the run to those CBSAs.
+    # Passing the same sim_cache dict to repeated calls reuses vehicle simulations whose inputs did not change
+    missing_inputs = [cur_key for cur_key in required_inputs if cur_key not in inputs_dict]
+    if len(missing_inputs) > 0:
+        raise ValueError('Scenario inputs are missing required variables: %s' % ', '.join(missing_inputs))
+    global_inputs = apply_scenario_defaults(copy.deepcopy(inputs_dict))
+
+    if data is None:
+        data = import_cbsa_inputs()
+    elif isinstance(data, str):
+        data = import_cbsa_inputs(data)
+    cbsa_table = data[0]
+    if cbsa_ids is None:
+        cbsa_ids = data[1]
+
+    return simulate_scenario(global_inputs, cbsa_table, cbsa_ids, workers, sim_cache, result_cache=result_cache,
+                             profiler=profiler)
+
+
+def build_vehicle_fleet(global_inputs,
+                        cbsa_table,
+                        cbsa_ids,
+                        workers=1,
+                        sim_cache=None,
+                        result_cache=None):
+    # Explicit fleet (see VehicleFleet) of the vehicles sampled in every CBSA, one entry per vehicle, ready
+    # to be stepped through days in bulk. Needs monte_carlo fleet sizing, which gives whole vehicle counts
+    cbsa_fleets = []
+    for cur_cbsa_id, cbsa_results in iterate_scenario(global_inputs, cbsa_table, cbsa_ids, workers, sim_cache,
+                                                      result_cache):
+        vehicle_counts = fleet_composition(cur_cbsa_id,
+                                           cbsa_results['permutations'],
+                                           cbsa_results['population'],
+                                           global_inputs)
+        cbsa_fleets.append(VehicleFleet.from_permutations(cbsa_results['permutations'], vehicle_counts,
+                                                          global_inputs['initial_soc']))
+
+    return VehicleFleet.concat(cbsa_fleets)
+
+
+def summarize_scenario(tnc_population_results):
+    # National headline numbers of a scenario
+    num_plugs = int(tnc_population_results.plugs.sum())
+    num_vehs = int(tnc_population_results.num_vehs.sum())
+
+    return {'num_plugs': num_plugs,
+            'num_vehs': num_vehs,
+            'plugs_per_1000_vehs': round(num_plugs*1000 / num_vehs, 2)}
+
+
+def shard_cbsa_ids(global_inputs, cbsa_table, cbsa_ids, shard, num_shards):
+    # CBSAs of shard (1 to num_shards) of a run split into num_shards parts. Sampling cost grows with a CBSA's
+    # TNC VMT, so CBSAs are dealt out largest VMT first, each to the shard with the least VMT so far. A shard
+    # keeps the order of cbsa_ids. Returns the shard's CBSA ids and the TNC VMT of every shard
+    cbsa_vmt = np.array([calc_miles_to_electrify(global_inputs,
+                                                 retrieve_cbsa_inputs(global_inputs, cbsa_table, cur_cbsa_id),
+                                                 cur_cbsa_id) for cur_cbsa_id in cbsa_ids])
+    shard_vmt = np.zeros(num_shards)
+    cbsa_shards = np.zeros(len(cbsa_ids), dtype=int)
+    for cur_ix in np.argsort(-cbsa_vmt, kind='stable'):
+        cbsa_shards[cur_ix] = np.argmin(shard_vmt)
+        shard_vmt[cbsa_shards[cur_ix]] = shard_vmt[cbsa_shards[cur_ix]] + cbsa_vmt[cur_ix]
+
+    return [cur_cbsa_id for cur_cbsa_id, cur_shard in zip(cbsa_ids, cbsa_shards) if cur_shard == shard - 1], shard_vmt
+
+
+def add_national_replicates(national_replicates, cbsa_replicates):
+    # Adds a CBSA's replicate results to the national totals of each replicate (None before the first CBSA).
+    # CBSAs must be added in the order of the run, so that the sums are the same in every run of a scenario
+    cbsa_replicates = cbsa_replicates.set_index('replicate')[replicate_total_columns]
+    if national_replicates is None:
+        return cbsa_replicates
+
+    return national_replicates + cbsa_replicates
+
+
+def summarize_national_replicates(replicate_results, percentiles):
+    # National totals of each replicate (CBSAs are drawn independently, so replicate i of every CBSA
+    # together is one national draw), summarized as in summarize_replicates
+    national_replicates = replicate_results.groupby('replicate').sum(numeric_only=True)
+
+    return summarize_replicates(national_replicates, percentiles)
+
+
+def validate_analytic_sizing(mc_population_results, analytic_population_results, confidence_level=0.95):
+    # Compares a Monte Carlo run with the analytic expected values of the same scenario. Per CBSA and
+    # fleet total: both values, the Monte Carlo value's z-score under the analytic CLT distribution, and
+    # whether it falls within the analytic confidence interval. If the analytic intervals are right,
+    # about confidence_level of the CBSAs are covered and the z-scores have mean 0 and std 1
+    z = NormalDist().inv_cdf(0.5 + confidence_level / 2)
+    mc_results = mc_population_results.set_index('cbsa_id')
+    analytic_results = analytic_population_results.set_index('cbsa_id').loc[mc_results.index]
+
+    validation_report = pd.DataFrame(index=mc_results.index)
+    validation_summary = []
+    for cur_col in fleet_total_columns + ['plugs']:
+        total_std = (analytic_results[cur_col + '_ci_high'] - analytic_results[cur_col + '_ci_low']) / (2 * z)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_score = (mc_results[cur_col] - analytic_results[cur_col]) / total_std
+        covered = (mc_results[cur_col] >= analytic_results[cur_col + '_ci_low']) & \
+                  (mc_results[cur_col] <= analytic_results[cur_col + '_ci_high'])
+
+        validation_report[cur_col + '_mc'] = mc_results[cur_col]
+        validation_report[cur_col + '_analytic'] = analytic_results[cur_col]
+        validation_report[cur_col + '_z'] = z_score
+        validation_report[cur_col + '_covered'] = covered
+
+        validation_summary.append({'total': cur_col,
+                                   'mc': mc_results[cur_col].sum(),
+                                   'analytic': analytic_results[cur_col].sum(),
+                                   'rel_diff': analytic_results[cur_col].sum() / mc_results[cur_col].sum() - 1,
+                                   'coverage': covered.mean(),
+                                   'z_mean': z_score.mean(),
+                                   'z_std': z_score.std()})
+
+    return validation_report.reset_index(), pd.DataFrame(validation_summary)
+
+
+def export_permutation_traces(permutation_results, global_inputs, trace_cbsa_ids, trace_dir):
+    # Re-simulates every permutation of the given CBSAs with SOC/time tracing, for all sim_days (no
+    # steady-state extrapolation), and writes one trace file per permutation
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+
+    trace_permutations = permutation_results[permutation_results.cbsa_id.isin(trace_cbsa_ids)]
+    cbsa_factors = dict([(cur_cbsa_id, cbsa_daily_factors(global_inputs, cur_cbsa_id, np.arange(len(cur_rows))))
+                         for cur_cbsa_id, cur_rows in trace_permutations.groupby('cbsa_id', sort=False)])
+    variation_ix = trace_permutations.groupby('cbsa_id', sort=False).cumcount().values
+    for cur_ix, (ix, cur_row) in enumerate(trace_permutations.iterrows()):
+        trace = SimTrace()
+        simulate_n_days(cur_row.veh_kwh,
+                        global_inputs['initial_soc'],
+                        cur_row.home_chg,
+                        cur_row.shift_h,
+                        cur_row.avg_speed_mph,
+                        global_inputs['sim_days'],
+                        cur_row.seek_charge_kwh,
+                        cur_row.plug_occupied_time,
+                        global_inputs['l2_max_kw'],
+                        cur_row.cbsa_whmi,
+                        global_inputs['soc_high'],
+                        trace=trace,
+                        chg_table=scenario_chg_time_table(cur_row.veh_kwh, global_inputs),
+                        plug_in_h=global_inputs['plug_in_mins'] / 60.0,
+                        daily_factors=row_daily_factors(cbsa_factors[cur_row.cbsa_id], variation_ix[cur_ix]))
+        trace.export(os.path.join(trace_dir, 'cbsa_%s_%s.csv' % (cur_row.cbsa_id, cur_row.key)))
+
+    return
 
 
 def import_scenario_vars(scenario):
@@ -258,10 +1192,45 @@ def import_scenario_vars(scenario):
     with open(scenario, 'r') as stream:
         input_dict = yaml.safe_load(stream)
 
+    return apply_scenario_defaults(input_dict)
+
+
+def apply_scenario_defaults(input_dict):
+
+    for cur_key in scenario_defaults.keys():
+        input_dict.setdefault(cur_key, copy.deepcopy(scenario_defaults[cur_key]))
+
+    input_dict['veh_max_kw'] = input_dict['dcfc_max_kw']
+
     return input_dict
 
 
-def write_scenario_trace(output_dir, scenario):
+def print_scenario_totals(scenario_summary):
+
+    print('Number of plugs: %s' % scenario_summary['num_plugs'])
+    print('Number of vehicles: %s' % scenario_summary['num_vehs'])
+    print('Plugs per 1000 vehs: %s' % scenario_summary['plugs_per_1000_vehs'])
+
+    return
+
+
+def write_national_replicate_summary(national_replicates, global_inputs, output_dir):
+    national_replicate_summary = summarize_replicates(national_replicates, global_inputs['replicate_percentiles'])
+    pd.DataFrame([national_replicate_summary]).to_csv('%s/national_replicate_summary.csv' % output_dir, index=False)
+
+    print('\nNational totals over %s replicates:' % len(national_replicates))
+    for cur_total in ['num_vehs', 'plugs', 'cbsa_dcfc_kwh', 'cbsa_l2_kwh']:
+        print('  %-14s mean %14.1f   std %12.1f   %s' % (
+            cur_total,
+            national_replicate_summary[cur_total + '_mean'],
+            national_replicate_summary[cur_total + '_std'],
+            '   '.join(['p%s %14.1f' % (cur_percentile, national_replicate_summary[cur_total + '_p%s' % cur_percentile])
+                        for cur_percentile in global_inputs['replicate_percentiles']])))
+
+    return
+
+
+def write_scenario_trace(output_dir, scenario, global_inputs):
     with open(output_dir + '/' + '%s_sim_inputs.yaml' % scenario, 'w') as outfile:
         yaml.dump(global_inputs, outfile, default_flow_style=False)
 
@@ -286,15 +1255,92 @@ def directory_handling(global_inputs, scenario):
     return output_dir
 
 
-def import_cbsa_inputs():
-    cbsa_vmt = pd.read_csv('../data/vmt_by_cbsa.csv')
-    cbsa_mph = pd.read_csv('../data/median_mph_by_cbsa.csv')
-    cbsa_whmi_adjustments = pd.read_csv('../data/whmi_by_cbsa.csv')
-    cbsa_hc_access = pd.read_csv('../data/overnight_chg_access_by_cbsa.csv')
+def read_cbsa_source(data_dir, file_name, id_col, value_cols, input_report):
+    # Reads one CBSA input file, keyed on an integer cbsa_id index. Rows with non-integer or duplicate
+    # ids are dropped and recorded in input_report
+    source = pd.read_csv(os.path.join(data_dir, file_name))
+    source_ids = source[id_col]
+
+    non_integer = source_ids.isna() | (source_ids % 1 != 0)
+    input_report['non_integer_ids'][file_name] = source_ids[non_integer].tolist()
+    source = source[~non_integer]
+
+    source = source.set_index(source[id_col].astype(int).rename('cbsa_id'))[value_cols]
+    duplicated = source.index.duplicated(keep='first')
+    input_report['duplicate_ids'][file_name] = sorted(set(source.index[duplicated]))
+
+    return source[~duplicated]
+
+
+def build_cbsa_table(data_dir):
+    # Joins the four CBSA input files into one table indexed by cbsa_id. The CBSAs simulated are those of
+    # vmt_by_cbsa.csv that have every input; the others are listed in input_report
+    input_report = {'non_integer_ids': {}, 'duplicate_ids': {}, 'missing_ids': {}}
+
+    cbsa_vmt = read_cbsa_source(data_dir, 'vmt_by_cbsa.csv', 'cbsa_id', ['cbsa_name', 'cbsa_dvmt'], input_report)
+    cbsa_sources = {
+        'median_mph_by_cbsa.csv': read_cbsa_source(data_dir, 'median_mph_by_cbsa.csv', 'geoid',
+                                                   ['median_mph'], input_report),
+        'whmi_by_cbsa.csv': read_cbsa_source(data_dir, 'whmi_by_cbsa.csv', 'geoid',
+                                             ['-1_perc_penalty', '75_perc_penalty', '85_perc_penalty',
+                                              '95_perc_penalty'], input_report),
+        'overnight_chg_access_by_cbsa.csv': read_cbsa_source(data_dir, 'overnight_chg_access_by_cbsa.csv', 'cbsa_id',
+                                                             ['scen_1_access', 'scen_2_access', 'scen_3_access',
+                                                              'scen_4_access', 'scen_5_access'], input_report)}
+
+    cbsa_table = cbsa_vmt
+    incomplete = cbsa_vmt.cbsa_dvmt.isna()
+    for file_name in cbsa_sources.keys():
+        cbsa_table = cbsa_table.join(cbsa_sources[file_name], how='left')
+        missing = cbsa_table[cbsa_sources[file_name].columns].isna().any(axis=1)
+        input_report['missing_ids'][file_name] = cbsa_table.index[missing].tolist()
+        incomplete = incomplete | missing
+
+    input_report['missing_ids']['vmt_by_cbsa.csv'] = cbsa_vmt.index[cbsa_vmt.cbsa_dvmt.isna()].tolist()
+    cbsa_ids = cbsa_table.index[~incomplete].tolist()
 
-    cbsa_ids = list(cbsa_vmt.cbsa_id.unique())
+    return cbsa_table, cbsa_ids, input_report
 
-    return cbsa_vmt, cbsa_mph, cbsa_whmi_adjustments, cbsa_hc_access, cbsa_ids
+
+def import_cbsa_inputs(data_dir=data_dir, use_cache=True):
+    # The joined CBSA table is cached in data_dir as a pickle, and rebuilt whenever the contents of
+    # any source file change
+    source_hash = hashlib.sha256()
+    for file_name in cbsa_input_files:
+        with open(os.path.join(data_dir, file_name), 'rb') as source:
+            source_hash.update(source.read())
+    source_hash = source_hash.hexdigest()
+
+    cache_path = os.path.join(data_dir, cbsa_table_cache)
+    if use_cache and os.path.exists(cache_path):
+        cached_inputs = pd.read_pickle(cache_path)
+        if cached_inputs['source_hash'] == source_hash:
+            return cached_inputs['cbsa_table'], cached_inputs['cbsa_ids'], cached_inputs['input_report']
+
+    cbsa_table, cbsa_ids, input_report = build_cbsa_table(data_dir)
+
+    if use_cache:
+        try:
+            pd.to_pickle({'source_hash': source_hash,
+                          'cbsa_table': cbsa_table,
+                          'cbsa_ids': cbsa_ids,
+                          'input_report': input_report}, cache_path + '.tmp')
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            pass  # read-only data directory, the table is rebuilt next run
+
+    return cbsa_table, cbsa_ids, input_report
+
+
+def print_input_report(input_report):
+
+    for issue in input_report.keys():
+        for file_name in input_report[issue].keys():
+            cbsa_ids = input_report[issue][file_name]
+            if len(cbsa_ids) > 0:
+                print("Warning: %s in %s (%s CBSAs): %s" % (issue.replace('_', ' '), file_name, len(cbsa_ids), cbsa_ids))
+
+    return
 
 
 def print_header(scenario, global_inputs):
@@ -317,106 +1363,195 @@ Variables:"""
 if __name__ == "__main__":
 
     warnings.filterwarnings("ignore")
-    random.seed(666)
-    scenario = sys.argv[1]
 
-    global_inputs = import_scenario_vars(scenario)
-    global_inputs['veh_max_kw'] = global_inputs['dcfc_max_kw']
-    
-    scenario = global_inputs['scenario_name']
-    
-    output_dir = directory_handling(global_inputs, scenario)
-
-    write_scenario_trace(output_dir, scenario)
+    parser = argparse.ArgumentParser(description='EVI-OnDemand: Infrastructure Projections for All-Electric Ridehailing Fleets')
+    parser.add_argument('scenario', nargs='?', help='scenario .yaml file')
+    parser.add_argument('--resume', help='output directory of an interrupted run to continue')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to simulate CBSA fleets')
+    parser.add_argument('--cache-dir', help='directory of the per-CBSA result cache, reused across runs')
+    parser.add_argument('--cache-max-mb', type=float, default=1024, help='size above which the result cache evicts old entries')
+    parser.add_argument('--validate-analytic', action='store_true',
+                        help='compare the analytic fleet sizing with Monte Carlo sampling, instead of a regular run')
+    cbsa_subset = parser.add_mutually_exclusive_group()
+    cbsa_subset.add_argument('--shard', help='run only shard k of N (k/N, e.g. 2/4), CBSAs split evenly by TNC VMT')
+    cbsa_subset.add_argument('--cbsa-ids', help='run only these CBSAs (comma separated ids)')
+    args = parser.parse_args()
+
+    if args.shard is not None:
+        try:
+            shard, num_shards = [int(cur_part) for cur_part in args.shard.split('/')]
+        except ValueError:
+            parser.error('--shard must be given as k/N, got %s' % args.shard)
+        if not 1 <= shard <= num_shards:
+            parser.error('--shard k/N needs 1 <= k <= N, got %s' % args.shard)
+    if args.resume is not None and (args.shard is not None or args.cbsa_ids is not None):
+        parser.error('a resumed run keeps the CBSAs it was started with, --shard and --cbsa-ids cannot be given')
+
+    if args.resume is not None:
+        # The scenario inputs are those saved with the interrupted run
+        output_dir = args.resume.rstrip('/')
+        scenario_traces = glob.glob(os.path.join(output_dir, '*_sim_inputs.yaml'))
+        if len(scenario_traces) != 1:
+            parser.error('%s does not contain exactly one *_sim_inputs.yaml file' % output_dir)
+
+        global_inputs = import_scenario_vars(scenario_traces[0])
+        scenario = global_inputs['scenario_name']
+
+    elif args.scenario is not None:
+        global_inputs = import_scenario_vars(args.scenario)
+        scenario = global_inputs['scenario_name']
+
+    else:
+        parser.error('either a scenario file or --resume is required')
+
+    try:
+        check_plug_sizing(global_inputs)
+    except ValueError as input_error:
+        parser.error(str(input_error))
+
+    if args.resume is None:
+        if args.shard is not None:
+            output_dir = directory_handling(global_inputs, '%s--shard%sof%s' % (scenario, shard, num_shards))
+        elif args.cbsa_ids is not None:
+            output_dir = directory_handling(global_inputs, '%s--cbsa_subset' % scenario)
+        else:
+            output_dir = directory_handling(global_inputs, scenario)
+        write_scenario_trace(output_dir, scenario, global_inputs)
 
     print_header(scenario, global_inputs)
 
-    cbsa_vmt, cbsa_mph, cbsa_whmi_adjustments, cbsa_hc_access, cbsa_ids =  import_cbsa_inputs()
+    profiler = RunProfiler(global_inputs['profile_memory'])
 
-    permutation_results = pd.DataFrame()
-    tnc_population_results = pd.DataFrame()
+    with profiler.stage('load_inputs'):
+        cbsa_table, cbsa_ids, input_report = import_cbsa_inputs()
+    print_input_report(input_report)
 
-    with trange(len(cbsa_ids)) as t:
+    run_key = hash_inputs(global_inputs, get_code_version())
 
-        ix = 0
-        for cur_t, cur_cbsa_id in zip(t, cbsa_ids):
+    # A shard (or explicit subset of CBSAs) records its CBSAs, and those of the full run, so that it can
+    # be resumed and merged with the other shards (see ondemand_merge.py)
+    shard_path = os.path.join(output_dir, shard_file)
+    if args.resume is not None and os.path.exists(shard_path):
+        with open(shard_path, 'r') as stream:
+            cbsa_ids = json.load(stream)['cbsa_ids']
+
+    elif args.shard is not None or args.cbsa_ids is not None:
+        if args.shard is not None:
+            run_ids, shard_vmt = shard_cbsa_ids(global_inputs, cbsa_table, cbsa_ids, shard, num_shards)
+            shard_info = {'shard': shard, 'num_shards': num_shards, 'shard_vmt': shard_vmt.tolist()}
+        else:
+            subset_ids = set([int(cur_cbsa_id) for cur_cbsa_id in args.cbsa_ids.split(',')])
+            unknown_ids = sorted(subset_ids - set(cbsa_ids))
+            if len(unknown_ids) > 0:
+                parser.error('--cbsa-ids includes CBSAs without complete inputs: %s' % unknown_ids)
+            run_ids = [cur_cbsa_id for cur_cbsa_id in cbsa_ids if cur_cbsa_id in subset_ids]
+            shard_info = {'shard': None, 'num_shards': None}
+
+        shard_info.update({'scenario': scenario, 'run_key': run_key, 'cbsa_ids': run_ids, 'all_cbsa_ids': cbsa_ids})
+        with open(shard_path, 'w') as outfile:
+            json.dump(shard_info, outfile)
+        print('Running %s of %s CBSAs\n' % (len(run_ids), len(cbsa_ids)))
+        cbsa_ids = run_ids
+
+    if args.cache_dir is not None:
+        result_cache = ResultCache(args.cache_dir, args.cache_max_mb * 1024**2)
+    else:
+        result_cache = None
+
+    if args.validate_analytic:
+        # Both fleet sizing modes share one set of vehicle simulations
+        sim_cache = {}
+        mc_population_results = simulate_scenario(dict(global_inputs, fleet_sizing='monte_carlo'), cbsa_table, cbsa_ids,
+                                                  args.workers, sim_cache, show_progress=True)['population']
+        analytic_population_results = simulate_scenario(dict(global_inputs, fleet_sizing='analytic'), cbsa_table,
+                                                        cbsa_ids, args.workers, sim_cache, show_progress=True)['population']
+
+        validation_report, validation_summary = validate_analytic_sizing(mc_population_results,
+                                                                         analytic_population_results,
+                                                                         global_inputs['confidence_level'])
+        validation_report.to_csv('%s/analytic_validation.csv' % output_dir, index=False)
+        validation_summary.to_csv('%s/analytic_validation_summary.csv' % output_dir, index=False)
+
+        print('\n\nAnalytic fleet sizing vs. Monte Carlo (%s%% confidence intervals):' % (global_inputs['confidence_level'] * 100))
+        print(validation_summary.to_string(index=False))
+        sys.exit(0)
+
+    result_writer = ResultWriter(output_dir, scenario, global_inputs['output_formats'],
+                                 run_key=run_key,
+                                 resume=args.resume is not None,
+                                 batch_size=global_inputs['cbsa_batch_size'])
+
+    # CBSAs are written in order, so the completed ones are always a prefix of cbsa_ids and the remaining
+    # CBSAs are appended exactly as they would have been in an uninterrupted run
+    completed_ids = set(result_writer.completed_ids())
+    remaining_ids = [cur_cbsa_id for cur_cbsa_id in cbsa_ids if cur_cbsa_id not in completed_ids]
+    if len(completed_ids) > 0:
+        print('Resuming %s: %s of %s CBSAs already completed\n' % (output_dir, len(completed_ids), len(cbsa_ids)))
+
+    # Results are written in chunks of cbsa_batch_size CBSAs as they complete; only the columns needed for the
+    # national totals are kept
+    tnc_population_results = [result_writer.completed_totals()]
+
+    # National totals of each replicate, summed over CBSAs (in order) as they complete
+    national_replicates = None
+    if global_inputs['replicates'] > 0 and len(completed_ids) > 0:
+        completed_replicates = dict(list(read_results(output_dir, 'replicates', scenario).groupby('cbsa_id')))
+        for cur_cbsa_id in result_writer.completed_ids():
+            national_replicates = add_national_replicates(national_replicates, completed_replicates[cur_cbsa_id])
+
+    if global_inputs['cprofile']:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
+    with tqdm(iterate_scenario(global_inputs, cbsa_table, remaining_ids, args.workers, result_cache=result_cache,
+                               profiler=profiler),
+              total=len(cbsa_ids), initial=len(completed_ids)) as t:
+
+        for cur_t, (cur_cbsa_id, cbsa_results) in enumerate(t, len(completed_ids)):
 
             t.set_description('CBSA %i' % cur_t)
 
-            cbsa_inputs = retrieve_cbsa_inputs(global_inputs,
-                                               cbsa_mph,
-                                               cbsa_vmt,
-                                               cbsa_whmi_adjustments,
-                                               cbsa_hc_access,
-                                               cur_cbsa_id)
+            with profiler.stage('accumulate_results', [cur_cbsa_id]):
+                cbsa_totals = {'num_vehs': float(cbsa_results['population']['num_vehs'].sum()),
+                               'plugs': float(cbsa_results['population']['plugs'].sum())}
+                tnc_population_results.append(pd.DataFrame([cbsa_totals]))
 
-            home_charging_access_dict = define_variable_frequencies(cbsa_inputs)
-            
-            cbsa_permutation_results, total_recharge_time = simulate_driver_permutations(home_charging_access_dict,
-                                                                    global_inputs,
-                                                                    cbsa_inputs)
-
-            cbsa_permutation_results['cbsa_id'] = cur_cbsa_id
-            cbsa_permutation_results['cbsa_whmi'] = cbsa_inputs['cbsa_whmi']
-            cbsa_permutation_results['avg_speed_mph'] = cbsa_inputs['avg_speed_mph']
-            
-            # Fehr and Peers report gave VMT for 6 CBSAs, using those here if inputs allow for it, "overriding" globally assumed 1%
-            if global_inputs['vmt_override_flag'] == 1:
-                fehr_and_peers_values = {31080: 1.5/100.0, # la
-                                    42660: 1.9/100.0, # seattle
-                                    41860: 2.7/100.0, # sf
-                                    47900: 1.9/100.0, # DC
-                                    14460: 1.9/100.0, # boston
-                                    16980: 2.1/100.0} # CHICAGO
-                
-                if cur_cbsa_id in fehr_and_peers_values.keys():
-                    miles_to_electrify = cbsa_inputs['cbsa_tnc_vmt'] / global_inputs['tnc_share'] * fehr_and_peers_values[cur_cbsa_id]
-
-                else:
-                    miles_to_electrify = cbsa_inputs['cbsa_tnc_vmt']
-            
-            else:
-                miles_to_electrify = cbsa_inputs['cbsa_tnc_vmt']
-
-            permutation_list, home_chg_list, mile_list, dcfc_per_day, time_per_dcfc, tot_time_per_dcfc_list, tot_dcfc_kwh_list, tot_l2_kwh_list = explode_driver_permutations(cbsa_permutation_results)
-
-            num_vehs, num_dcfc_events, tot_dcfc_hours, tot_plug_time_h, tot_dcfc_kwh_w_hc, tot_dcfc_kwh_wo_hc, tot_l2_kwh = sample_populations_to_reach_vmt(permutation_list, home_chg_list,
-                                                                        mile_list,
-                                                                        dcfc_per_day,
-                                                                        time_per_dcfc,
-                                                                        tot_time_per_dcfc_list,
-                                                                        miles_to_electrify,
-                                                                        tot_dcfc_kwh_list,
-                                                                        tot_l2_kwh_list)
-
-            permutation_results = permutation_results.append(cbsa_permutation_results)
-
-            cur_tnc_population_results = pd.DataFrame({
-                'cbsa_id': [cur_cbsa_id],
-                'num_vehs': [num_vehs],
-                'num_dcfc_events': [num_dcfc_events],
-                'cbsa_dcfc_hours': [tot_dcfc_hours],
-                'cbsa_dcfc_plug_time': [tot_plug_time_h],
-                'cbsa_tnc_vmt': [miles_to_electrify],
-                'cbsa_hc_access': [cbsa_inputs['cbsa_hc_access']],
-                'cbsa_avg_speed': [cbsa_inputs['avg_speed_mph']],
-                'cbsa_whmi': [cbsa_inputs['cbsa_whmi']],
-                'cbsa_dcfc_kwh_w_hc': [tot_dcfc_kwh_w_hc],
-                'cbsa_dcfc_kwh_wo_hc': [tot_dcfc_kwh_wo_hc],
-                'cbsa_l2_kwh': [tot_l2_kwh]})
-
-            tnc_population_results = tnc_population_results.append(cur_tnc_population_results)
-            ix = ix + 1
+                if cbsa_results['replicates'] is not None:
+                    national_replicates = add_national_replicates(national_replicates, cbsa_results['replicates'])
 
-    hours_per_charger = 24 * global_inputs['utilization_perc']
-#     tnc_population_results['plugs'] = tnc_population_results.cbsa_dcfc_plug_time / hours_per_charger # This includes plugging in and out in utilization
-    tnc_population_results['plugs'] = tnc_population_results.cbsa_dcfc_hours / hours_per_charger # This includes plugging in and out in utilization
+            with profiler.stage('write_results', [cur_cbsa_id]):
+                result_writer.write_cbsa(cur_cbsa_id, cbsa_results, cbsa_totals)
 
-    
-    permutation_results.to_csv('%s/permutation_results.csv' % output_dir, index=False)
-    tnc_population_results.to_csv('%s/population_results.csv' % output_dir, index=False)
+                if cur_cbsa_id in global_inputs['trace_cbsa_ids']:
+                    export_permutation_traces(cbsa_results['permutations'], global_inputs, [cur_cbsa_id],
+                                              '%s/traces' % output_dir)
+
+    with profiler.stage('write_results'):
+        result_writer.flush()
+
+    if global_inputs['cprofile']:
+        cprofiler.disable()
+        cprofiler.dump_stats('%s/run_profile.prof' % output_dir)
+
+    tnc_population_results = pd.concat(tnc_population_results, ignore_index=True)
+
+    scenario_summary = summarize_scenario(tnc_population_results)
 
     print('\n\nSimulation finished!')
-    print('Number of plugs: %s' % int(tnc_population_results.plugs.sum()))
-    print('Number of vehicles: %s' % int(tnc_population_results.num_vehs.sum()))
-    print('Plugs per 1000 vehs: %s' % round(int(tnc_population_results.plugs.sum())*1000 / tnc_population_results.num_vehs.sum(),2))
\ No newline at end of file
+    if os.path.exists(shard_path):
+        print('Totals of this shard only, merge all shards with ondemand_merge.py for the national totals')
+    print_scenario_totals(scenario_summary)
+
+    if national_replicates is not None:
+        write_national_replicate_summary(national_replicates, global_inputs, output_dir)
+
+    if result_cache is not None:
+        cache_report = result_cache.report()
+        for stage in cache_report['stages'].keys():
+            print('Result cache (%s): %s hits, %s misses' % (stage,
+                                                              cache_report['stages'][stage]['hits'],
+                                                              cache_report['stages'][stage]['misses']))
+        print('Result cache size: %s MB in %s entries' % (cache_report['size_mb'], cache_report['entries']))
+
+    profiler.write('%s/run_profile.json' % output_dir)
+    profiler.print_summary(cbsa_table['cbsa_name'].to_dict())
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from ondemand_vehsim import simulate_n_days, SimTrace
+from ondemand_utils import scenario_chg_time_table, row_daily_factors
+
+
+# Columns of a load profile, each the average over a time bin
+load_profile_columns = ['dcfc_sessions', 'dcfc_kw', 'l2_kw']
+
+
+def trace_charging_sessions(trace, veh_kwh, l2_max_kw):
+    # (start, end) times (h) of the DCFC and L2 sessions in a vehicle's SimTrace. A night starts at the last
+    # event of the shift before it (l2_end is recorded during the night), and L2 charges at a constant
+    # 90% of l2_max_kw for as long as it takes to add the night's energy
+    time_h = trace.time_h[:trace.size]
+    soc = trace.soc[:trace.size].astype(float)
+    event = trace.event[:trace.size]
+
+    dcfc_arrive = np.flatnonzero(event == SimTrace.event_names.index('dcfc_arrive'))
+    dcfc_start = time_h[dcfc_arrive]
+    dcfc_end = time_h[dcfc_arrive + 1]  # every arrival is followed by its departure
+
+    day_start = np.flatnonzero(event == SimTrace.event_names.index('day_start'))
+    night_start = day_start - 1 - (event[day_start - 1] == SimTrace.event_names.index('l2_end'))
+    l2_kwh = (soc[day_start] - soc[night_start]) * veh_kwh
+    l2_charged = l2_kwh > 0
+    l2_start = time_h[night_start][l2_charged]
+    l2_end = l2_start + l2_kwh[l2_charged] / (l2_max_kw * 0.9)
+
+    return dcfc_start, dcfc_end, l2_start, l2_end
+
+
+def simulate_permutation_sessions(cur_row, global_inputs, daily_factors=None):
+    # DCFC and L2 sessions of one vehicle of a permutation (a row of the permutation table), simulated with
+    # a SimTrace for all sim_days (no steady-state extrapolation), with the permutation's own daily factors
+    # (see row_daily_factors). Times are hours since its first shift start
+    trace = SimTrace()
+    simulate_n_days(cur_row.veh_kwh,
+                    global_inputs['initial_soc'],
+                    cur_row.home_chg,
+                    cur_row.shift_h,
+                    cur_row.avg_speed_mph,
+                    global_inputs['sim_days'],
+                    cur_row.seek_charge_kwh,
+                    cur_row.plug_occupied_time,
+                    global_inputs['l2_max_kw'],
+                    cur_row.cbsa_whmi,
+                    global_inputs['soc_high'],
+                    trace=trace,
+                    chg_table=scenario_chg_time_table(cur_row.veh_kwh, global_inputs),
+                    plug_in_h=global_inputs['plug_in_mins'] / 60.0,
+                    daily_factors=daily_factors)
+
+    return trace_charging_sessions(trace, cur_row.veh_kwh, global_inputs['l2_max_kw'])
+
+
+def bin_sessions(start_h, end_h, rate, bin_edges):
+    # Average over each bin of the summed rate of all sessions (rate from start_h to end_h). The integral
+    # G(t) = sum(rate * clip(t - start_h, 0, end_h - start_h)) is piecewise linear, so it is evaluated
+    # exactly at every bin edge from cumulative sums over the sorted session starts and ends
+    def ramp_integral(points, rates):
+        order = np.argsort(points)
+        cum_rate = np.concatenate([[0.0], np.cumsum(rates[order])])
+        cum_rate_time = np.concatenate([[0.0], np.cumsum(rates[order] * points[order])])
+        edge_ix = np.searchsorted(points[order], bin_edges, side='right')
+
+        return bin_edges * cum_rate[edge_ix] - cum_rate_time[edge_ix]
+
+    integral = ramp_integral(start_h, rate) - ramp_integral(end_h, rate)
+
+    return np.diff(integral) / np.diff(bin_edges)
+
+
+def cbsa_load_profile(cbsa_permutations, vehicle_counts, global_inputs, daily_factors=None):
+    # Charging load profile of a fleet with vehicle_counts[i] vehicles of permutation i. Each permutation is
+    # simulated once, for all sim_days, with its sessions offset by every shift start hour of
+    # shift_start_dist and weighted by its number of vehicles and the share of shifts starting then.
+    # Memory use depends on the number of permutations and days, not on the fleet size. daily_factors are
+    # those of the permutations (see daily_variation_factors), with daily variation.
+    # With load_profile 'horizon' the profile covers the whole simulation (hours since midnight of day 1,
+    # plus a day for late shift starts); with 'day' it is folded into the average day (clock hours).
+    shift_start_hours = np.array(list(global_inputs['shift_start_dist'].keys()), dtype=float)
+    shift_start_prob = np.array(list(global_inputs['shift_start_dist'].values()), dtype=float)
+    shift_start_prob = shift_start_prob / shift_start_prob.sum()
+
+    bin_h = global_inputs['load_profile_bin_h']
+    bins_per_day = 24 / bin_h
+    if abs(bins_per_day - round(bins_per_day)) > 1e-9:
+        raise ValueError('load_profile_bin_h must divide 24 hours evenly, got %s' % bin_h)
+    bins_per_day = int(round(bins_per_day))
+    bin_edges = np.linspace(0, global_inputs['sim_days'] * 24 + 24, (global_inputs['sim_days'] + 1) * bins_per_day + 1)
+    plug_in_h = global_inputs['plug_in_mins'] / 60.0
+
+    sessions = {cur_col: [[], [], []] for cur_col in load_profile_columns}  # starts, ends, rates
+    for cur_ix, (cur_row, cur_count) in enumerate(zip(cbsa_permutations.itertuples(), vehicle_counts)):
+        if cur_count <= 0:
+            continue
+
+        dcfc_start, dcfc_end, l2_start, l2_end = simulate_permutation_sessions(cur_row, global_inputs,
+                                                                               row_daily_factors(daily_factors, cur_ix))
+
+        # DCFC power is the session's energy spread evenly over the time after plugging in. Top-ups vary
+        # in energy and time, so they all draw the permutation's average power
+        if global_inputs['dcfc_top_up']:
+            dcfc_kw = cur_row.dcfc_kwh_per_day / cur_row.dcfc_per_day / cur_row.chg_time_per_dcfc \
+                if cur_row.dcfc_per_day > 0 else 0.0
+        else:
+            dcfc_kw = (cur_row.veh_kwh * global_inputs['soc_high'] - cur_row.seek_charge_kwh) / cur_row.chg_time_per_dcfc
+        veh_sessions = {'dcfc_sessions': (dcfc_start, dcfc_end, 1.0),
+                        'dcfc_kw': (dcfc_start + plug_in_h, dcfc_end, dcfc_kw),
+                        'l2_kw': (l2_start, l2_end, global_inputs['l2_max_kw'] * 0.9)}
+
+        for cur_col in load_profile_columns:
+            cur_start, cur_end, cur_rate = veh_sessions[cur_col]
+            sessions[cur_col][0].append(np.add.outer(shift_start_hours, cur_start).ravel())
+            sessions[cur_col][1].append(np.add.outer(shift_start_hours, cur_end).ravel())
+            sessions[cur_col][2].append(np.repeat(cur_count * shift_start_prob * cur_rate, cur_start.size))
+
+    load_profile = pd.DataFrame({'hour': bin_edges[:-1]})
+    for cur_col in load_profile_columns:
+        if len(sessions[cur_col][0]) > 0:
+            load_profile[cur_col] = bin_sessions(np.concatenate(sessions[cur_col][0]),
+                                                 np.concatenate(sessions[cur_col][1]),
+                                                 np.concatenate(sessions[cur_col][2]),
+                                                 bin_edges)
+        else:
+            load_profile[cur_col] = 0.0
+
+    if global_inputs['load_profile'] == 'day':
+        day_profile = load_profile[load_profile_columns].values.reshape(-1, bins_per_day, len(load_profile_columns))
+        load_profile = pd.DataFrame(day_profile.sum(axis=0) / global_inputs['sim_days'], columns=load_profile_columns)
+        load_profile.insert(0, 'hour', bin_edges[:bins_per_day])
+
+    return load_profile
+
+
+def summarize_load_profile(load_profile):
+    # Peak of each profile column, for peak-based sizing
+    return {'peak_' + cur_col: load_profile[cur_col].max() for cur_col in load_profile_columns}
@@ -0,0 +1,161 @@
+import os
+import sys
+import glob
+import json
+import shutil
+import argparse
+import warnings
+import pandas as pd
+from ondemand_output import result_tables, manifest_file, read_results
+from ondemand_fleetsim import import_scenario_vars, directory_handling, shard_file, summarize_scenario, \
+    print_scenario_totals, add_national_replicates, write_national_replicate_summary
+
+
+def read_shard(shard_dir):
+    # The shard description and progress manifest of a shard's output directory, and its scenario inputs file
+    with open(os.path.join(shard_dir, shard_file), 'r') as stream:
+        shard_info = json.load(stream)
+    with open(os.path.join(shard_dir, manifest_file), 'r') as stream:
+        manifest = json.load(stream)
+
+    scenario_traces = glob.glob(os.path.join(shard_dir, '*_sim_inputs.yaml'))
+    if len(scenario_traces) != 1:
+        raise ValueError('%s does not contain exactly one *_sim_inputs.yaml file' % shard_dir)
+
+    return shard_info, manifest, scenario_traces[0]
+
+
+def split_csv_by_cbsa(csv_path, manifest, table):
+    # Header and per-CBSA rows (as bytes) of a table's CSV, located by the bytes each CBSA added to it as
+    # recorded in the manifest (the first CBSA's include the header). CBSAs that wrote no rows to the table
+    # get an empty block
+    with open(csv_path, 'rb') as csv_file:
+        csv_bytes = csv_file.read()
+    header = csv_bytes[:csv_bytes.index(b'\n') + 1]
+
+    cbsa_rows = {}
+    cur_end = 0
+    for cur_cbsa, cur_deltas in zip(manifest['completed'], manifest['cbsa_csv_deltas']):
+        cur_start = cur_end
+        cur_end += cur_deltas.get(table, 0)
+        cbsa_rows[cur_cbsa['cbsa_id']] = csv_bytes[max(cur_start, len(header)):max(cur_end, len(header))]
+
+    return header, cbsa_rows
+
+
+def merge_shards(shard_dirs, output_dir):
+    # Combines the output directories of the shards of one run into output_dir, with the same files a
+    # single run of all CBSAs writes: result CSVs in the run's CBSA order, parquet partitions, traces and
+    # a progress manifest. The shards must come from the same scenario inputs and model code, be complete
+    # and together cover every CBSA of the run exactly once. Returns the manifest of the merged run
+    shards = [read_shard(shard_dir) for shard_dir in shard_dirs]
+    shard_info, manifest, scenario_trace = shards[0]
+
+    for cur_dir, (cur_info, cur_manifest, cur_trace) in zip(shard_dirs, shards):
+        if cur_info['run_key'] != shard_info['run_key'] or cur_info['all_cbsa_ids'] != shard_info['all_cbsa_ids']:
+            raise ValueError('%s was run with different scenario inputs, model code or CBSA inputs than %s' %
+                             (cur_dir, shard_dirs[0]))
+        completed_ids = [cur_cbsa['cbsa_id'] for cur_cbsa in cur_manifest['completed']]
+        if completed_ids != cur_info['cbsa_ids']:
+            raise ValueError('%s has completed %s of its %s CBSAs, resume it before merging' %
+                             (cur_dir, len(completed_ids), len(cur_info['cbsa_ids'])))
+        if 'cbsa_csv_deltas' not in cur_manifest:
+            raise ValueError('%s was written without per-CBSA progress and cannot be merged' % cur_dir)
+
+    shard_of_cbsa = {}
+    for cur_shard, (cur_info, cur_manifest, cur_trace) in enumerate(shards):
+        for cur_cbsa_id in cur_info['cbsa_ids']:
+            if cur_cbsa_id in shard_of_cbsa:
+                raise ValueError('CBSA %s is in more than one shard: %s and %s' %
+                                 (cur_cbsa_id, shard_dirs[shard_of_cbsa[cur_cbsa_id]], shard_dirs[cur_shard]))
+            shard_of_cbsa[cur_cbsa_id] = cur_shard
+
+    missing_ids = [cur_cbsa_id for cur_cbsa_id in shard_info['all_cbsa_ids'] if cur_cbsa_id not in shard_of_cbsa]
+    if len(missing_ids) > 0:
+        raise ValueError('%s CBSAs are in none of the shards, e.g. %s' % (len(missing_ids), missing_ids[:10]))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    shutil.copy(scenario_trace, output_dir)
+    for shard_dir in shard_dirs:
+        for cur_subdir in ['results', 'traces']:
+            if os.path.exists(os.path.join(shard_dir, cur_subdir)):
+                shutil.copytree(os.path.join(shard_dir, cur_subdir), os.path.join(output_dir, cur_subdir),
+                                dirs_exist_ok=True)
+
+    cbsa_totals = {}
+    for cur_info, cur_manifest, cur_trace in shards:
+        cbsa_totals.update([(cur_cbsa['cbsa_id'], cur_cbsa) for cur_cbsa in cur_manifest['completed']])
+
+    merged_manifest = {'run_key': shard_info['run_key'],
+                       'completed': [cbsa_totals[cur_cbsa_id] for cur_cbsa_id in shard_info['all_cbsa_ids']],
+                       'csv_bytes': {},
+                       'cbsa_csv_deltas': [{} for cur_cbsa_id in shard_info['all_cbsa_ids']]}
+
+    for table in result_tables.keys():
+        shard_csvs = [os.path.join(shard_dir, '%s.csv' % result_tables[table]) for shard_dir in shard_dirs]
+        if not any([os.path.exists(csv_path) for csv_path in shard_csvs]):
+            continue
+
+        headers = set()
+        cbsa_rows = {}
+        for csv_path, (cur_info, cur_manifest, cur_trace) in zip(shard_csvs, shards):
+            if os.path.exists(csv_path):
+                cur_header, cur_rows = split_csv_by_cbsa(csv_path, cur_manifest, table)
+                headers.add(cur_header)
+                cbsa_rows.update(cur_rows)
+        if len(headers) > 1:
+            raise ValueError('The shards wrote %s with different columns' % result_tables[table])
+
+        merged_path = os.path.join(output_dir, '%s.csv' % result_tables[table])
+        with open(merged_path, 'wb') as outfile:
+            outfile.write(headers.pop())
+            for cur_ix, cur_cbsa_id in enumerate(shard_info['all_cbsa_ids']):
+                cur_start = outfile.tell() if cur_ix > 0 else 0
+                outfile.write(cbsa_rows.get(cur_cbsa_id, b''))
+                merged_manifest['cbsa_csv_deltas'][cur_ix][table] = outfile.tell() - cur_start
+        merged_manifest['csv_bytes'][table] = os.path.getsize(merged_path)
+
+    with open(os.path.join(output_dir, manifest_file), 'w') as outfile:
+        json.dump(merged_manifest, outfile)
+
+    return merged_manifest
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description='EVI-OnDemand: merge the outputs of a run split into shards')
+    parser.add_argument('shard_dirs', nargs='+', help='output directories of the shards')
+    parser.add_argument('--output-dir', help='directory of the merged outputs, by default a new run directory '
+                                             'named after the scenario')
+    args = parser.parse_args()
+
+    shard_dirs = [shard_dir.rstrip('/') for shard_dir in args.shard_dirs]
+    for shard_dir in shard_dirs:
+        if not os.path.exists(os.path.join(shard_dir, shard_file)):
+            parser.error('%s is not the output directory of a shard (no %s)' % (shard_dir, shard_file))
+
+    global_inputs = import_scenario_vars(read_shard(shard_dirs[0])[2])
+    scenario = global_inputs['scenario_name']
+    if args.output_dir is not None:
+        output_dir = args.output_dir
+    else:
+        output_dir = directory_handling(global_inputs, scenario)
+
+    try:
+        merged_manifest = merge_shards(shard_dirs, output_dir)
+    except ValueError as merge_error:
+        print('Shards cannot be merged: %s' % merge_error)
+        sys.exit(1)
+
+    print('\nMerged %s shards, %s CBSAs, into %s' % (len(shard_dirs), len(merged_manifest['completed']), output_dir))
+    print_scenario_totals(summarize_scenario(pd.DataFrame(merged_manifest['completed'])))
+
+    if global_inputs['replicates'] > 0:
+        completed_replicates = dict(list(read_results(output_dir, 'replicates', scenario).groupby('cbsa_id')))
+        national_replicates = None
+        for cur_cbsa in merged_manifest['completed']:
+            national_replicates = add_national_replicates(national_replicates, completed_replicates[cur_cbsa['cbsa_id']])
+        write_national_replicate_summary(national_replicates, global_inputs, output_dir)
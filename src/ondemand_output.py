@@ -0,0 +1,179 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+result_tables = {'permutations': 'permutation_results', 'population': 'population_results',
+                 'replicates': 'replicate_results', 'load_profiles': 'load_profiles'}
+
+manifest_file = 'progress_manifest.json'
+
+# Compact parquet column types of the stored results; key is dictionary encoded (read back as a categorical)
+if pyarrow is not None:
+    compact_types = {'permutations': {'home_chg': pyarrow.int8(), 'weight': pyarrow.int16(),
+                                      'sim_days': pyarrow.int32(), 'converged_day': pyarrow.int32(),
+                                      'cbsa_id': pyarrow.int32(),
+                                      'key': pyarrow.dictionary(pyarrow.int32(), pyarrow.string())},
+                     'population': {'cbsa_id': pyarrow.int32(), 'cbsa_hc_access': pyarrow.int16()},
+                     'replicates': {'cbsa_id': pyarrow.int32(), 'replicate': pyarrow.int32()},
+                     'load_profiles': {'cbsa_id': pyarrow.int32(), 'hour': pyarrow.float32(),
+                                       'dcfc_sessions': pyarrow.float32(), 'dcfc_kw': pyarrow.float32(),
+                                       'l2_kw': pyarrow.float32()}}
+
+
+def write_parquet(results, table, path):
+    arrow_table = pyarrow.Table.from_pandas(results, preserve_index=False)
+    schema = pyarrow.schema([field.with_type(compact_types[table].get(field.name, field.type))
+                             for field in arrow_table.schema])
+
+    # Written to a temporary file first so that a killed run never leaves a partial partition behind
+    pyarrow.parquet.write_table(arrow_table.cast(schema), path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+class ResultWriter:
+    # Writes results in chunks of batch_size CBSAs as they complete, so that no more than one chunk of results
+    # accumulates in memory. Parquet output is partitioned by scenario and chunk, one file per table
+    # (results/scenario=<name>/chunk=<first CBSA id of the chunk>/<table>.parquet, with a cbsa_id column); CSV
+    # output is appended to <table>.csv (see result_tables) for every table a CBSA produces.
+    # Progress is recorded in a manifest after every chunk: the CBSAs completed so far (with the totals passed
+    # to write_cbsa), the size of each CSV, and the bytes each CBSA added to it, so that each CBSA's rows can
+    # be located (e.g. to merge shards). With resume=True an existing manifest is picked up, CSV rows of a
+    # chunk that was interrupted mid-write are truncated away, and completed CBSAs can be skipped.
+
+    def __init__(self, output_dir, scenario, output_formats=('parquet', 'csv'), run_key=None, resume=False,
+                 batch_size=1):
+        self.output_dir = output_dir
+        self.scenario = scenario
+        self.output_formats = list(output_formats)
+        self.manifest_path = os.path.join(output_dir, manifest_file)
+        self.batch_size = max(int(batch_size), 1)
+        self.pending = []
+
+        if 'parquet' in self.output_formats and pyarrow is None:
+            print('pyarrow is not installed, parquet output is skipped')
+            self.output_formats.remove('parquet')
+
+        if resume and os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as stream:
+                self.manifest = json.load(stream)
+
+            if self.manifest['run_key'] != run_key:
+                raise ValueError('%s was written with different scenario inputs or model code, '
+                                 'it cannot be resumed' % output_dir)
+
+            for table in result_tables.keys():
+                csv_path = os.path.join(self.output_dir, '%s.csv' % result_tables[table])
+                if os.path.exists(csv_path):
+                    with open(csv_path, 'r+b') as csv_file:
+                        csv_file.truncate(self.manifest['csv_bytes'].get(table, 0))
+
+        else:
+            self.manifest = {'run_key': run_key, 'completed': [], 'csv_bytes': {}, 'cbsa_csv_deltas': []}
+            self.write_manifest()
+
+        self.csv_started = set([table for table in self.manifest['csv_bytes'].keys()
+                                if self.manifest['csv_bytes'][table] > 0])
+
+    def completed_ids(self):
+
+        return [cur_cbsa['cbsa_id'] for cur_cbsa in self.manifest['completed']]
+
+    def completed_totals(self):
+
+        return pd.DataFrame(self.manifest['completed'])
+
+    def write_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as outfile:
+            json.dump(self.manifest, outfile)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+        return
+
+    def partition_dir(self, first_cbsa_id):
+
+        return os.path.join(self.output_dir, 'results', 'scenario=%s' % self.scenario, 'chunk=%s' % first_cbsa_id)
+
+    def write_cbsa(self, cur_cbsa_id, cbsa_results, cbsa_totals=None):
+        # cbsa_results maps tables of result_tables to the CBSA's results; tables that are None are skipped.
+        # The CBSA is written with the rest of its chunk, once batch_size CBSAs are pending
+        self.pending.append((int(cur_cbsa_id), cbsa_results, cbsa_totals))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+        return
+
+    def flush(self):
+        # Writes the pending CBSAs as one chunk; called by write_cbsa, and once more at the end of a run
+        if len(self.pending) == 0:
+            return
+
+        cbsa_csv_deltas = [{} for cur_cbsa in self.pending]
+        for table in result_tables.keys():
+            cbsa_ixs = [cur_ix for cur_ix, (cur_cbsa_id, cbsa_results, cbsa_totals) in enumerate(self.pending)
+                        if cbsa_results.get(table) is not None]
+            if len(cbsa_ixs) == 0:
+                continue
+            chunk_results = pd.concat([self.pending[cur_ix][1][table] for cur_ix in cbsa_ixs], ignore_index=True)
+
+            if 'parquet' in self.output_formats:
+                partition_dir = self.partition_dir(self.pending[0][0])
+                if not os.path.exists(partition_dir):
+                    os.makedirs(partition_dir)
+                write_parquet(chunk_results, table, os.path.join(partition_dir, '%s.parquet' % table))
+
+            if 'csv' in self.output_formats:
+                csv_bytes = chunk_results.to_csv(header=table not in self.csv_started, index=False).encode()
+
+                # Each row is one line, so a CBSA's rows end after the line of its last row; the header (if
+                # any) goes with the first CBSA
+                line_starts = np.concatenate([[0], np.flatnonzero(np.frombuffer(csv_bytes, dtype=np.uint8) ==
+                                                                 ord('\n')) + 1])
+                header_lines = 0 if table in self.csv_started else 1
+                row_counts = [len(self.pending[cur_ix][1][table]) for cur_ix in cbsa_ixs]
+                cbsa_ends = line_starts[header_lines + np.cumsum(row_counts)]
+                for cur_ix, cur_delta in zip(cbsa_ixs, np.diff(np.concatenate([[0], cbsa_ends]))):
+                    cbsa_csv_deltas[cur_ix][table] = int(cur_delta)
+
+                csv_path = os.path.join(self.output_dir, '%s.csv' % result_tables[table])
+                with open(csv_path, 'ab' if table in self.csv_started else 'wb') as outfile:
+                    outfile.write(csv_bytes)
+                self.manifest['csv_bytes'][table] = os.path.getsize(csv_path)
+                self.csv_started.add(table)
+
+        for (cur_cbsa_id, cbsa_results, cbsa_totals), cur_deltas in zip(self.pending, cbsa_csv_deltas):
+            cur_cbsa = {'cbsa_id': cur_cbsa_id}
+            cur_cbsa.update(cbsa_totals or {})
+            self.manifest['completed'].append(cur_cbsa)
+            self.manifest['cbsa_csv_deltas'].append(cur_deltas)
+        self.write_manifest()
+        self.pending = []
+
+        return
+
+
+def read_results(output_dir, table, scenario=None):
+    # Reads one results table ('permutations' or 'population') of a run back into memory, from the
+    # parquet partitions if they were written, otherwise from the CSV export
+    partition_root = os.path.join(output_dir, 'results')
+    if scenario is not None:
+        partition_root = os.path.join(partition_root, 'scenario=%s' % scenario)
+
+    if pyarrow is None or not os.path.exists(partition_root):
+        return pd.read_csv(os.path.join(output_dir, '%s.csv' % result_tables[table]))
+
+    partition_files = []
+    for dir_path, dir_names, file_names in os.walk(partition_root):
+        if '%s.parquet' % table in file_names:
+            partition_files.append(os.path.join(dir_path, '%s.parquet' % table))
+
+    results = pd.concat([pd.read_parquet(partition_file) for partition_file in partition_files], ignore_index=True)
+
+    return results.sort_values('cbsa_id', kind='stable').reset_index(drop=True)
@@ -0,0 +1,114 @@
+import time
+import json
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def max_rss_mb():
+    # High-water mark of this process's resident memory (MB), where the platform reports it
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed_call(fn, *args):
+    # Calls fn(*args) and returns its result with the elapsed wall time (s). Module level, so that it
+    # can be sent to worker processes
+    start = time.perf_counter()
+    result = fn(*args)
+
+    return result, time.perf_counter() - start
+
+
+class RunProfiler:
+    # Wall time, call counts and peak memory of each stage of a run, with each stage's time also broken
+    # down per CBSA. Stages that simulate discrete events also count them, and report their event rate.
+    # Stage peak memory is traced with tracemalloc if trace_memory is set (which slows the
+    # run down); otherwise stages record no peak memory (None), since the process's peak resident memory
+    # only ever grows and says nothing about a single stage. It is reported once for the run as max_rss_mb.
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.cbsa_seconds = {}
+        self.start_time = time.perf_counter()
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add(self, stage, seconds, cbsa_ids=(), cbsa_shares=None, calls=1, peak_mb=None, events=None):
+        # Adds a timed call of stage. Its time is split over cbsa_ids, by cbsa_shares or evenly
+        cur_stage = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'peak_mb': None})
+        cur_stage['seconds'] = cur_stage['seconds'] + seconds
+        cur_stage['calls'] = cur_stage['calls'] + calls
+        if peak_mb is not None:
+            cur_stage['peak_mb'] = max(cur_stage['peak_mb'] or 0, peak_mb)
+        if events is not None:
+            cur_stage['events'] = cur_stage.get('events', 0) + int(events)
+            cur_stage['events_per_second'] = cur_stage['events'] / cur_stage['seconds'] if cur_stage['seconds'] > 0 else None
+
+        if cbsa_shares is None:
+            cbsa_shares = [1.0 / len(cbsa_ids)] * len(cbsa_ids) if len(cbsa_ids) > 0 else []
+
+        for cur_cbsa_id, cur_share in zip(cbsa_ids, cbsa_shares):
+            cbsa_stages = self.cbsa_seconds.setdefault(int(cur_cbsa_id), {})
+            cbsa_stages[stage] = cbsa_stages.get(stage, 0.0) + seconds * cur_share
+
+        return
+
+    @contextmanager
+    def stage(self, stage, cbsa_ids=(), cbsa_shares=None):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+
+        yield
+
+        seconds = time.perf_counter() - start
+        if self.trace_memory:
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1024**2
+        else:
+            peak_mb = None
+
+        self.add(stage, seconds, cbsa_ids, cbsa_shares, peak_mb=peak_mb)
+
+    def slowest_cbsas(self, num_cbsas=5):
+
+        return sorted(self.cbsa_seconds.keys(), key=lambda cbsa_id: -sum(self.cbsa_seconds[cbsa_id].values()))[:num_cbsas]
+
+    def report(self):
+
+        return {'total_seconds': time.perf_counter() - self.start_time,
+                'max_rss_mb': max_rss_mb(),
+                'memory': 'tracemalloc' if self.trace_memory else 'max_rss',
+                'stages': self.stages,
+                'cbsas': [dict([('cbsa_id', cbsa_id), ('seconds', sum(self.cbsa_seconds[cbsa_id].values()))] +
+                               list(self.cbsa_seconds[cbsa_id].items())) for cbsa_id in self.cbsa_seconds.keys()]}
+
+    def write(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.report(), outfile, indent=2)
+
+        return
+
+    def print_summary(self, cbsa_names=None, num_cbsas=5):
+        report = self.report()
+
+        print('\nRun time by stage (%.1f s total):' % report['total_seconds'])
+        for stage in self.stages.keys():
+            print('  %-36s %9.2f s %8s calls' % (stage, self.stages[stage]['seconds'], self.stages[stage]['calls']) +
+                  ('  %12.0f events/s' % self.stages[stage]['events_per_second']
+                   if self.stages[stage].get('events_per_second') is not None else ''))
+
+        print('Slowest CBSAs:')
+        for cbsa_id in self.slowest_cbsas(num_cbsas):
+            cbsa_name = cbsa_names.get(cbsa_id, '') if cbsa_names is not None else ''
+            print('  %-8s %-45s %7.3f s' % (cbsa_id, cbsa_name[:45], sum(self.cbsa_seconds[cbsa_id].values())))
+
+        return
@@ -0,0 +1,156 @@
+import heapq
+import numpy as np
+from ondemand_utils import row_daily_factors
+from ondemand_loads import simulate_permutation_sessions
+
+
+# Arrivals simulated between checks of the running wait against the target, when sizing plugs
+wait_check_interval = 4096
+
+
+def fleet_dcfc_arrivals(cbsa_permutations, vehicle_counts, global_inputs, rng, daily_factors=None):
+    # DCFC arrivals of every vehicle of a fleet with vehicle_counts[i] vehicles of permutation i, during the
+    # last queue_days days of the simulation plus a preceding day to warm up the queue. Each vehicle starts
+    # its first shift at an hour drawn from shift_start_dist, plus a uniform offset within that hour.
+    # Returns the sorted arrival times (h), the plug time of each session (h) and the time from which
+    # arrivals are measured (after the warm-up day). daily_factors are those of the permutations, with daily
+    # variation (see daily_variation_factors)
+    shift_start_hours = np.array(list(global_inputs['shift_start_dist'].keys()), dtype=float)
+    shift_start_prob = np.array(list(global_inputs['shift_start_dist'].values()), dtype=float)
+    shift_start_prob = shift_start_prob / shift_start_prob.sum()
+
+    window_end = global_inputs['sim_days'] * 24.0
+    measure_from = window_end - global_inputs['queue_days'] * 24.0
+    window_start = measure_from - 24.0
+    if window_start < 0:
+        raise ValueError('queue_days must be less than sim_days, got %s' % global_inputs['queue_days'])
+
+    arrivals = []
+    plug_times = []
+    for cur_ix, (cur_row, cur_count) in enumerate(zip(cbsa_permutations.itertuples(), vehicle_counts)):
+        if cur_count <= 0:
+            continue
+
+        dcfc_start, dcfc_end, l2_start, l2_end = simulate_permutation_sessions(cur_row, global_inputs,
+                                                                               row_daily_factors(daily_factors, cur_ix))
+        veh_start = shift_start_hours[rng.choice(shift_start_prob.size, size=cur_count, p=shift_start_prob)] + \
+            rng.random(cur_count)
+
+        # Only the sessions that can fall in the window, once offset by up to a day
+        in_reach = (dcfc_start >= window_start - 25.0) & (dcfc_start < window_end)
+        veh_arrivals = np.add.outer(veh_start, dcfc_start[in_reach]).ravel()
+        veh_plug_times = np.tile(dcfc_end[in_reach] - dcfc_start[in_reach], cur_count)
+        in_window = (veh_arrivals >= window_start) & (veh_arrivals < window_end)
+
+        arrivals.append(veh_arrivals[in_window])
+        plug_times.append(veh_plug_times[in_window])
+
+    if len(arrivals) == 0:
+        return np.zeros(0), np.zeros(0), measure_from
+
+    arrivals = np.concatenate(arrivals)
+    plug_times = np.concatenate(plug_times)
+    order = np.argsort(arrivals, kind='stable')
+
+    return arrivals[order], plug_times[order], measure_from
+
+
+def simulate_plug_queue(arrivals, plug_times, num_plugs, measure_ix=0, max_total_wait=None):
+    # First-come first-served queue of sorted arrivals at a pool of num_plugs plugs. The event heap holds the
+    # time at which each plug is next freed by a departure; each arrival takes the plug freed first, waiting
+    # for it if needed, and schedules its own departure. Returns the waits (h) of the arrivals from
+    # measure_ix on and the number of events simulated (arrivals and departures). If the summed measured
+    # wait exceeds max_total_wait the simulation stops early and the waits are None
+    if num_plugs <= 0:
+        return None, 0
+
+    plug_free = [-np.inf] * num_plugs
+    arrivals = arrivals.tolist()
+    plug_times = plug_times.tolist()
+    waits = []
+    total_wait = 0.0
+
+    for chunk_start in range(0, len(arrivals), wait_check_interval):
+        chunk_end = min(chunk_start + wait_check_interval, len(arrivals))
+        chunk_waits = []
+        for cur_arrival, cur_plug_time in zip(arrivals[chunk_start:chunk_end], plug_times[chunk_start:chunk_end]):
+            cur_start = plug_free[0]
+            if cur_start < cur_arrival:
+                cur_start = cur_arrival
+            heapq.heapreplace(plug_free, cur_start + cur_plug_time)
+            chunk_waits.append(cur_start - cur_arrival)
+
+        if chunk_end > measure_ix:
+            chunk_waits = chunk_waits[max(measure_ix - chunk_start, 0):]
+            waits.extend(chunk_waits)
+            total_wait = total_wait + sum(chunk_waits)
+            if max_total_wait is not None and total_wait > max_total_wait:
+                return None, 2 * chunk_end
+
+    return np.array(waits), 2 * len(arrivals)
+
+
+def peak_simultaneous_sessions(arrivals, plug_times):
+    # Most sessions plugged in at once, the number of plugs at which no arrival ever waits
+    if arrivals.size == 0:
+        return 0
+
+    event_times = np.concatenate([arrivals, arrivals + plug_times])
+    event_steps = np.concatenate([np.ones(arrivals.size), -np.ones(arrivals.size)])
+    # Departures sort before arrivals at the same time, a plug freed at t can be taken at t
+    order = np.lexsort([event_steps, event_times])
+
+    return int(np.cumsum(event_steps[order]).max())
+
+
+def size_plugs_for_wait(arrivals, plug_times, measure_from, target_wait_h):
+    # Fewest plugs at which the mean wait of the measured arrivals is at most target_wait_h, by bisection
+    # between no plugs and the peak simultaneous sessions (at which nobody waits). Waits never grow with
+    # more plugs under first-come first-served, so the bisection is exact; plug counts that miss the
+    # target are abandoned as soon as their running wait exceeds it.
+    # Returns the plugs, the waits (h) of the measured arrivals at that count, and the events simulated
+    measure_ix = int(np.searchsorted(arrivals, measure_from, side='left'))
+    num_measured = arrivals.size - measure_ix
+    if num_measured == 0:
+        return 0, np.zeros(0), 0
+
+    low_plugs = 0
+    high_plugs = peak_simultaneous_sessions(arrivals, plug_times)
+    high_waits = np.zeros(num_measured)
+    num_events = 0
+
+    while high_plugs - low_plugs > 1:
+        cur_plugs = (low_plugs + high_plugs) // 2
+        cur_waits, cur_events = simulate_plug_queue(arrivals, plug_times, cur_plugs, measure_ix,
+                                                    target_wait_h * num_measured)
+        num_events = num_events + cur_events
+        if cur_waits is None:
+            low_plugs = cur_plugs
+        else:
+            high_plugs = cur_plugs
+            high_waits = cur_waits
+
+    return high_plugs, high_waits, num_events
+
+
+def cbsa_queue_sizing(cbsa_permutations, vehicle_counts, global_inputs, rng, daily_factors=None):
+    # Plugs a CBSA's fleet needs for a mean wait of at most queue_target_wait_mins, with the mean and 95th
+    # percentile wait (mins) and plug utilization at that count over the measured days, and the number of
+    # sessions and events simulated
+    arrivals, plug_times, measure_from = fleet_dcfc_arrivals(cbsa_permutations, vehicle_counts, global_inputs, rng,
+                                                             daily_factors)
+    plugs, waits, num_events = size_plugs_for_wait(arrivals, plug_times, measure_from,
+                                                   global_inputs['queue_target_wait_mins'] / 60.0)
+
+    measured = arrivals >= measure_from
+    if plugs > 0:
+        utilization = plug_times[measured].sum() / (plugs * global_inputs['queue_days'] * 24.0)
+    else:
+        utilization = 0.0
+
+    return {'queue_plugs': plugs,
+            'queue_mean_wait_mins': waits.mean() * 60 if waits.size > 0 else 0.0,
+            'queue_p95_wait_mins': np.percentile(waits, 95) * 60 if waits.size > 0 else 0.0,
+            'queue_utilization': utilization,
+            'queue_sessions': int(measured.sum()),
+            'queue_events': num_events}
@@ -0,0 +1,137 @@
+import os
+import copy
+import itertools
+import argparse
+import warnings
+import yaml
+import pandas as pd
+from tqdm import tqdm
+from ondemand_cache import ResultCache
+from ondemand_fleetsim import import_scenario_vars, apply_scenario_defaults, directory_handling, \
+    import_cbsa_inputs, print_input_report, simulate_scenario, summarize_scenario, summarize_national_replicates
+
+
+def expand_parameter_grid(base_inputs, parameter_grid):
+    # One scenario per combination of the values in parameter_grid ({variable: [values]}), named after
+    # the base scenario and the values it varies
+    grid_variables = list(parameter_grid.keys())
+    sweep_inputs = []
+
+    for grid_values in itertools.product(*[parameter_grid[cur_var] for cur_var in grid_variables]):
+        cur_inputs = copy.deepcopy(base_inputs)
+        cur_inputs.update(zip(grid_variables, copy.deepcopy(grid_values)))
+        cur_inputs['scenario_name'] = base_inputs['scenario_name'] + '--' + \
+            '_'.join(['%s=%s' % (cur_var, cur_val) for cur_var, cur_val in zip(grid_variables, grid_values)])
+        sweep_inputs.append(apply_scenario_defaults(cur_inputs))
+
+    return sweep_inputs
+
+
+def import_sweep_scenarios(scenario_files, grid_file=None):
+
+    if grid_file is not None:
+        if len(scenario_files) != 1:
+            raise ValueError('A parameter grid is applied to exactly one base scenario, got %s' % len(scenario_files))
+
+        with open(grid_file, 'r') as stream:
+            parameter_grid = yaml.safe_load(stream)
+
+        return expand_parameter_grid(import_scenario_vars(scenario_files[0]), parameter_grid)
+
+    sweep_inputs = [import_scenario_vars(scenario_file) for scenario_file in scenario_files]
+    scenario_names = [cur_inputs['scenario_name'] for cur_inputs in sweep_inputs]
+    if len(set(scenario_names)) < len(scenario_names):
+        raise ValueError('Scenario names in a sweep must be unique: %s' % scenario_names)
+
+    return sweep_inputs
+
+
+def find_varied_inputs(sweep_inputs):
+    # Scenario variables that take more than one value across the sweep
+    all_keys = list(dict.fromkeys([cur_key for cur_inputs in sweep_inputs for cur_key in cur_inputs.keys()]))
+
+    return [cur_key for cur_key in all_keys if cur_key != 'scenario_name' and
+            len(set([repr(cur_inputs.get(cur_key)) for cur_inputs in sweep_inputs])) > 1]
+
+
+def run_sweep(sweep_inputs,
+              cbsa_table,
+              cbsa_ids,
+              workers=1,
+              show_progress=False,
+              result_cache=None):
+    # Runs every scenario against the same CBSA inputs. Vehicle simulations are shared between scenarios
+    # through one simulation cache, so only sampling and plug sizing are repeated for variables (e.g.
+    # tnc_share, utilization_perc, hc_scenario) that do not change simulate_n_days inputs
+    sim_cache = {}
+    varied_inputs = find_varied_inputs(sweep_inputs)
+    sweep_population_results = []
+    sweep_summary = []
+
+    for cur_inputs in tqdm(sweep_inputs, disable=not show_progress):
+        scenario_results = simulate_scenario(cur_inputs,
+                                             cbsa_table,
+                                             cbsa_ids,
+                                             workers,
+                                             sim_cache,
+                                             result_cache=result_cache)
+        tnc_population_results = scenario_results['population']
+        replicate_results = scenario_results['replicates']
+
+        tnc_population_results.insert(0, 'scenario_name', cur_inputs['scenario_name'])
+        sweep_population_results.append(tnc_population_results)
+
+        scenario_summary = {'scenario_name': cur_inputs['scenario_name']}
+        scenario_summary.update([(cur_key, cur_inputs.get(cur_key)) for cur_key in varied_inputs])
+        scenario_summary.update(summarize_scenario(tnc_population_results))
+        if replicate_results is not None:
+            scenario_summary.update(summarize_national_replicates(replicate_results, cur_inputs['replicate_percentiles']))
+        sweep_summary.append(scenario_summary)
+
+    return pd.concat(sweep_population_results, ignore_index=True), pd.DataFrame(sweep_summary), len(sim_cache)
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description='EVI-OnDemand scenario sweep')
+    parser.add_argument('scenarios', nargs='+', help='scenario .yaml files, or a single base scenario when --grid is given')
+    parser.add_argument('--grid', help='.yaml file mapping scenario variables to lists of values to sweep over')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to simulate CBSA fleets')
+    parser.add_argument('--cache-dir', help='directory of the per-CBSA result cache, reused across runs')
+    parser.add_argument('--cache-max-mb', type=float, default=1024, help='size above which the result cache evicts old entries')
+    args = parser.parse_args()
+
+    sweep_inputs = import_sweep_scenarios(args.scenarios, args.grid)
+    sweep_name = os.path.splitext(os.path.basename(args.grid or args.scenarios[0]))[0] + '_sweep'
+
+    output_dir = directory_handling(sweep_inputs[0], sweep_name)
+    with open(output_dir + '/' + '%s_sim_inputs.yaml' % sweep_name, 'w') as outfile:
+        yaml.dump(sweep_inputs, outfile, default_flow_style=False)
+
+    cbsa_table, cbsa_ids, input_report = import_cbsa_inputs()
+    print_input_report(input_report)
+
+    if args.cache_dir is not None:
+        result_cache = ResultCache(args.cache_dir, args.cache_max_mb * 1024**2)
+    else:
+        result_cache = None
+
+    print("\nRunning %s scenarios...\n" % len(sweep_inputs))
+
+    sweep_population_results, sweep_summary, num_simulated = run_sweep(sweep_inputs,
+                                                                       cbsa_table,
+                                                                       cbsa_ids,
+                                                                       args.workers,
+                                                                       show_progress=True,
+                                                                       result_cache=result_cache)
+
+    sweep_population_results.to_csv('%s/sweep_population_results.csv' % output_dir, index=False)
+    sweep_summary.to_csv('%s/sweep_summary.csv' % output_dir, index=False)
+
+    print('\n\nSweep finished! %s unique vehicle simulations across %s scenarios\n' % (num_simulated, len(sweep_inputs)))
+    print(sweep_summary.to_string(index=False))
+
+    if result_cache is not None:
+        print('\nResult cache: %s' % result_cache.report())
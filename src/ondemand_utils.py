@@ -1,43 +1,203 @@
-import yaml
+import os
+import numpy as np
 import pandas as pd
 
 
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+power_curve_path = os.path.join(data_dir, 'normalized_power_curve.csv')
+
+# SOC points (evenly spaced from 0 to 1) of the cumulative charge time tables used for variable DCFC sessions
+chg_table_points = 1001
+
+# Day-to-day multipliers that daily_variation can set a coefficient of variation for, in the order of the
+# daily factors passed to the vehicle simulation
+daily_variation_keys = ['shift_h', 'speed', 'whmi']
+
+
+class ChargeCurve:
+    # DCFC charge curve built from a normalized (relative power vs. SOC) power acceptance curve, which
+    # is read once. Between curve points the accepted power is linear in SOC, so the charge time over
+    # each segment is integrated exactly rather than stepped through. Results are memoized.
+
+    def __init__(self, curve_path=power_curve_path):
+        veh_power_curve = pd.read_csv(curve_path)
+        self.curve_soc = veh_power_curve.soc.values.astype(float)
+        self.curve_rel_power = veh_power_curve.rel_power.values.astype(float)
+        self.chg_time_cache = {}
+
+    def power_breakpoints(self, veh_max_kw, dcfc_max_kw, soc_low, soc_high):
+        # SOC values between soc_low and soc_high at which the charging power changes slope, and the power
+        # (kW) at each of them. Charging may be limited by the battery or the charger, so points where the
+        # vehicle's acceptance crosses dcfc_max_kw are included as well.
+        inner_soc = self.curve_soc[(self.curve_soc > soc_low) & (self.curve_soc < soc_high)]
+        soc = np.concatenate([[soc_low], inner_soc, [soc_high]])
+        excess_kw = np.interp(soc, self.curve_soc, self.curve_rel_power) * veh_max_kw - dcfc_max_kw
+
+        cross_ix = np.flatnonzero(excess_kw[:-1] * excess_kw[1:] < 0)
+        cross_soc = soc[cross_ix] + (soc[cross_ix + 1] - soc[cross_ix]) * \
+            excess_kw[cross_ix] / (excess_kw[cross_ix] - excess_kw[cross_ix + 1])
+        soc = np.sort(np.concatenate([soc, cross_soc]))
+
+        power = np.minimum(np.interp(soc, self.curve_soc, self.curve_rel_power) * veh_max_kw, dcfc_max_kw)
+
+        return soc, power
+
+    def charge_time(self, veh_kwh, veh_max_kw, dcfc_max_kw, soc_low, soc_high):
+        # Returns the time (h) to charge from soc_low to soc_high, along with the elapsed time (s), power (kW)
+        # and SOC at each power breakpoint
+        cache_key = (veh_kwh, veh_max_kw, dcfc_max_kw, soc_low, soc_high)
+        if cache_key in self.chg_time_cache:
+            return self.chg_time_cache[cache_key]
+
+        soc, power = self.power_breakpoints(veh_max_kw, dcfc_max_kw, soc_low, soc_high)
+        if np.any(power <= 0):
+            raise ValueError('Charging power reaches 0 kW between SOC %s and %s, charge never completes' % (soc_low, soc_high))
+
+        time_s = np.concatenate([[0.0], np.cumsum(self.segment_times(soc, power, veh_kwh)) * 3600])
+        dcfc_chg_time_h = time_s[-1] / 3600
+
+        for arr in (time_s, power, soc):
+            arr.setflags(write=False)
+
+        self.chg_time_cache[cache_key] = (dcfc_chg_time_h, time_s, power, soc)
+
+        return self.chg_time_cache[cache_key]
+
+    def segment_times(self, soc, power, veh_kwh):
+        # Time (h) to charge across each segment between consecutive breakpoints. With power linear in SOC
+        # over a segment, dt = veh_kwh * dsoc / (p2 - p1) * ln(p2 / p1)
+        seg_kwh = np.diff(soc) * veh_kwh
+        power_start = power[:-1]
+        power_end = power[1:]
+        flat = np.isclose(power_start, power_end, rtol=1e-12, atol=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            seg_time_h = np.where(flat,
+                                  seg_kwh / power_start,
+                                  seg_kwh / (power_end - power_start) * np.log(power_end / power_start))
+
+        return seg_time_h
+
+    def time_table(self, veh_kwh, veh_max_kw, dcfc_max_kw):
+        # Cumulative time (h) to charge from 0 to each of chg_table_points evenly spaced SOCs. The table
+        # points are added to the power breakpoints, so every entry is integrated exactly; the time between
+        # any two SOCs is then a difference of two (interpolated) entries. Entries from a SOC at which the
+        # power reaches 0 kW on are infinite. Built once per vehicle and charger
+        cache_key = ('table', veh_kwh, veh_max_kw, dcfc_max_kw)
+        if cache_key in self.chg_time_cache:
+            return self.chg_time_cache[cache_key]
+
+        table_soc = np.linspace(0, 1, chg_table_points)
+        soc, power = self.power_breakpoints(veh_max_kw, dcfc_max_kw, 0.0, 1.0)
+        soc = np.union1d(soc, table_soc)
+        power = np.minimum(np.interp(soc, self.curve_soc, self.curve_rel_power) * veh_max_kw, dcfc_max_kw)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            time_h = np.concatenate([[0.0], np.cumsum(self.segment_times(soc, power, veh_kwh))])
+        chg_table = time_h[np.searchsorted(soc, table_soc)]
+        chg_table.setflags(write=False)
+        self.chg_time_cache[cache_key] = chg_table
+
+        return chg_table
+
+
+default_charge_curve = None
+
+
+def get_charge_curve():
+    # Charge curve from data/normalized_power_curve.csv, loaded on first use
+    global default_charge_curve
+    if default_charge_curve is None:
+        default_charge_curve = ChargeCurve()
+
+    return default_charge_curve
+
+
 def calc_chg_time(veh_kwh,
                   veh_max_kw,
                   dcfc_max_kw,
                   soc_low,
                   soc_high):
-    veh_power_curve = pd.read_csv('/home/mmoniot/github/EVI-OnDemand/data/normalized_power_curve.csv')
-    veh_power_curve['chg_acceptance'] = veh_power_curve.rel_power * veh_max_kw
 
-    cur_soc = soc_low
-    cur_kwh = cur_soc * veh_kwh
-    timestep_duration = 60  # seconds
-    running_time = [0]
-    running_soc = [cur_soc]
-    running_power = [0]
+    dcfc_chg_time_h, running_time, running_power, running_soc = get_charge_curve().charge_time(veh_kwh,
+                                                                                             veh_max_kw,
+                                                                                             dcfc_max_kw,
+                                                                                             soc_low,
+                                                                                             soc_high)
 
-    while cur_soc <= soc_high:
-        # Linear interpolation
-        nearest_soc_low = veh_power_curve[veh_power_curve.soc <= cur_soc].soc.iloc[-1]
-        nearest_soc_high = veh_power_curve[veh_power_curve.soc > cur_soc].soc.iloc[0]
-        interp_perc = (cur_soc - nearest_soc_low) / (nearest_soc_high - nearest_soc_low)
+    return dcfc_chg_time_h, running_time, running_power, running_soc
 
-        nearest_power_low = veh_power_curve[veh_power_curve.soc <= cur_soc].chg_acceptance.iloc[-1]
-        nearest_power_high = veh_power_curve[veh_power_curve.soc >= cur_soc].chg_acceptance.iloc[0]
-        veh_acceptance_power = nearest_power_low + interp_perc * (nearest_power_high - nearest_power_low)
 
-        # Charging may be limited by the battery or the charger. Finding bottleneck
-        cur_timestep_power = min(veh_acceptance_power, dcfc_max_kw)
+def calc_chg_time_table(veh_kwh,
+                        veh_max_kw,
+                        dcfc_max_kw,
+                        charge_taper):
+    # Cumulative DCFC charge time table (see ChargeCurve.time_table), with the tapered charge curve or, without
+    # taper, at a constant dcfc_max_kw
+    if charge_taper == 1:
+        return get_charge_curve().time_table(veh_kwh, veh_max_kw, dcfc_max_kw)
 
-        cur_timestep_kwh = cur_timestep_power * timestep_duration / 3600
-        cur_kwh = cur_kwh + cur_timestep_kwh
-        cur_soc = cur_kwh / veh_kwh
+    return np.linspace(0, 1, chg_table_points) * veh_kwh / dcfc_max_kw
 
-        running_time.extend([running_time[-1] + timestep_duration])
-        running_soc.extend([cur_soc])
-        running_power.extend([cur_timestep_power])
 
-    dcfc_chg_time_h = running_time[-1] / 3600
+def scenario_chg_time_table(veh_kwh, global_inputs):
+    # Charge time table of a vehicle at the scenario's chargers when DCFC stops are top-ups (dcfc_top_up),
+    # otherwise None. Raises if soc_high cannot be reached
+    if not global_inputs['dcfc_top_up']:
+        return None
 
-    return dcfc_chg_time_h, running_time, running_power, running_soc
+    chg_table = calc_chg_time_table(float(veh_kwh), global_inputs['veh_max_kw'], global_inputs['dcfc_max_kw'],
+                                    global_inputs['charge_taper'])
+    if not np.isfinite(chg_table[int(np.ceil(global_inputs['soc_high'] * (chg_table_points - 1)))]):
+        raise ValueError('Charging power reaches 0 kW below SOC %s, charge never completes' % global_inputs['soc_high'])
+
+    return chg_table
+
+
+def stacked_chg_time_tables(veh_kwh, global_inputs):
+    # Charge time tables of the distinct battery sizes in veh_kwh stacked into one array, and the row of
+    # each entry of veh_kwh, for the batched vehicle simulation. (None, 0) when DCFC stops are not top-ups
+    if not global_inputs['dcfc_top_up']:
+        return None, 0
+
+    veh_kwh_values, table_ix = np.unique(veh_kwh, return_inverse=True)
+    chg_tables = np.array([scenario_chg_time_table(cur_veh_kwh, global_inputs) for cur_veh_kwh in veh_kwh_values])
+
+    return chg_tables, table_ix
+
+
+def daily_variation_factors(stream_ix, global_inputs, rng):
+    # Random multipliers of the shift length, speed and Wh/mi of every simulated day (daily_variation) of the
+    # permutations at positions stream_ix of a CBSA's permutation table, or None without daily variation: one
+    # (sim_days, permutations) array per entry of daily_variation_keys. Factors are lognormal with mean 1 and
+    # the configured coefficient of variation. All days are drawn up front in one call from rng, the CBSA's
+    # daily variation stream; position i takes the i-th block of draws, so a permutation gets the same days
+    # whichever other permutations of its CBSA are drawn with it
+    if global_inputs['daily_variation'] is None:
+        return None
+
+    unknown_keys = [cur_key for cur_key in global_inputs['daily_variation'].keys() if cur_key not in daily_variation_keys]
+    if len(unknown_keys) > 0:
+        raise ValueError('daily_variation can only set %s, got %s' % (daily_variation_keys, unknown_keys))
+
+    stream_ix = np.asarray(stream_ix, dtype=np.int64)
+    stream_blocks = int(stream_ix.max()) + 1 if stream_ix.size > 0 else 0
+    normals = rng.standard_normal((stream_blocks, len(daily_variation_keys), global_inputs['sim_days']))[stream_ix]
+
+    daily_factors = []
+    for key_ix, cur_key in enumerate(daily_variation_keys):
+        cur_cv = float(global_inputs['daily_variation'].get(cur_key, 0))
+        if cur_cv < 0:
+            raise ValueError('daily_variation of %s must not be negative, got %s' % (cur_key, cur_cv))
+        sigma = np.sqrt(np.log(1 + cur_cv**2))
+        daily_factors.append(np.exp(sigma * normals[:, key_ix].T - sigma**2 / 2))
+
+    return daily_factors
+
+
+def row_daily_factors(daily_factors, row_ix):
+    # Daily factors of the row_ix-th permutation out of those of daily_variation_factors, one array of sim_days
+    # entries per factor, or None without daily variation
+    if daily_factors is None:
+        return None
+
+    return [cur_factor[:, row_ix] for cur_factor in daily_factors]
@@ -1,7 +1,75 @@
 import pandas as pd
+import numpy as np
 
-def simulate_day(veh_soc,
-                 time_absolute,
+
+class SimTrace:
+    # Time (h) and SOC trace of one simulated vehicle. Points are recorded into preallocated, compactly
+    # typed arrays, which grow by doubling if the reserved size runs out.
+    event_names = ['start', 'shift_end', 'dcfc_arrive', 'dcfc_depart', 'l2_end', 'day_start']
+
+    def __init__(self, capacity=1024):
+        self.time_h = np.empty(capacity, dtype=np.float64)
+        self.soc = np.empty(capacity, dtype=np.float32)
+        self.event = np.empty(capacity, dtype=np.int8)
+        self.size = 0
+
+    def reserve(self, capacity):
+        if capacity > self.time_h.size:
+            self.time_h = np.resize(self.time_h, capacity)
+            self.soc = np.resize(self.soc, capacity)
+            self.event = np.resize(self.event, capacity)
+
+    def record(self, time_h, soc, event):
+        if self.size == self.time_h.size:
+            self.reserve(2 * self.size)
+        self.time_h[self.size] = time_h
+        self.soc[self.size] = soc
+        self.event[self.size] = self.event_names.index(event)
+        self.size = self.size + 1
+
+    def last_time(self):
+        return self.time_h[self.size - 1]
+
+    def to_frame(self):
+        return pd.DataFrame({'time_h': self.time_h[:self.size],
+                             'soc': self.soc[:self.size],
+                             'event': pd.Categorical.from_codes(self.event[:self.size], self.event_names)})
+
+    def export(self, path):
+        # .npz files keep the compact arrays, anything else is written as .csv
+        if path.endswith('.npz'):
+            np.savez_compressed(path,
+                                time_h=self.time_h[:self.size],
+                                soc=self.soc[:self.size],
+                                event=self.event[:self.size],
+                                event_names=np.array(self.event_names))
+        else:
+            self.to_frame().to_csv(path, index=False)
+
+
+def lookup_chg_time(chg_tables, table_ix, soc):
+    # Cumulative charge time (h) at soc from rows table_ix of stacked charge time tables (see
+    # ChargeCurve.time_table), interpolated between the two table points around it. O(1) per lookup, for
+    # arrays of vehicles
+    points = chg_tables.shape[-1]
+    table_pos = np.clip(soc, 0.0, 1.0) * (points - 1)
+    grid_ix = np.minimum(table_pos.astype(int), points - 2)
+    time_low = chg_tables[table_ix, grid_ix]
+    time_high = chg_tables[table_ix, grid_ix + 1]
+
+    return time_low + (table_pos - grid_ix) * (time_high - time_low)
+
+
+def table_chg_time(chg_table, soc):
+    # Scalar counterpart of lookup_chg_time for a single table, without the overhead of numpy on scalars
+    table_pos = min(max(soc, 0.0), 1.0) * (len(chg_table) - 1)
+    grid_ix = min(int(table_pos), len(chg_table) - 2)
+    time_low = chg_table[grid_ix]
+
+    return time_low + (table_pos - grid_ix) * (chg_table[grid_ix + 1] - time_low)
+
+
+def simulate_day(day_start_soc,
                  dcfc_ct,
                  shift_length_h,
                  veh_kwh,
@@ -10,12 +78,23 @@ def simulate_day(veh_soc,
                  seek_charge_kwh,
                  chg_time,
                  day_start_time,
-                 dcfc_soc_high):
-    
+                 dcfc_soc_high,
+                 trace=None,
+                 chg_table=None,
+                 plug_in_h=0.0):
+    # Only scalar state is carried; if a SimTrace is given, every event of the day is recorded to it.
+    # Every DCFC stop takes chg_time (h) and charges to dcfc_soc_high, unless a charge time table (see
+    # ChargeCurve.time_table) is given: stops then top up to the SOC that lets the vehicle drive the rest
+    # of its shift (as of arrival) and still hold seek_charge_kwh, at most dcfc_soc_high, and take
+    # plug_in_h plus the table's time from the arrival to that target SOC.
+    # Also returns the DCFC energy (kWh) and plugged-in time (h) of the day
+
     shift_remain_time = shift_length_h
     cur_time_shift = 0
-    cur_kwh = veh_soc[-1] * veh_kwh
+    cur_kwh = day_start_soc * veh_kwh
     cum_mi = 0
+    dcfc_kwh = 0
+    dcfc_plug_h = 0
 
     while shift_remain_time > 0:
 
@@ -28,82 +107,107 @@ def simulate_day(veh_soc,
             cur_time_shift = cur_time_shift + shift_remain_time
             cum_mi = cum_mi + avg_speed_mph*shift_remain_time
             shift_remain_time = 0
-            time_absolute.extend([day_start_time + cur_time_shift])
-            veh_soc.extend([cur_kwh / veh_kwh])
+            if trace is not None:
+                trace.record(day_start_time + cur_time_shift, cur_kwh / veh_kwh, 'shift_end')
 
         else:  # charging event needed
             # Elapsed time is the time before charging
             # If this is the first charge event of the shift, this is the elapsed time since the start of the shift
             # If this is not the first charge event of the shift, this is the elapsed time since the end of the previous charge
             elapsed_time = avail_kwh / (avg_speed_mph * climate_wh_mi) * 1000
-            
+
             cum_mi = cum_mi + avg_speed_mph*elapsed_time
-            time_absolute.extend([time_absolute[-1] + elapsed_time])
-            veh_soc.extend([seek_charge_kwh / veh_kwh])
-            cur_kwh = veh_kwh * dcfc_soc_high
-            veh_soc.extend([cur_kwh / veh_kwh])
-            time_absolute.extend([time_absolute[-1] + chg_time])
+            if trace is not None:
+                trace.record(trace.last_time() + elapsed_time, seek_charge_kwh / veh_kwh, 'dcfc_arrive')
+            if chg_table is None:
+                cur_kwh = veh_kwh * dcfc_soc_high
+            else:
+                arrive_soc = seek_charge_kwh / veh_kwh
+                depart_soc = min((seek_charge_kwh + shift_remain_kwh - avail_kwh) / veh_kwh, dcfc_soc_high)
+                chg_time = plug_in_h + table_chg_time(chg_table, depart_soc) - table_chg_time(chg_table, arrive_soc)
+                cur_kwh = veh_kwh * depart_soc
+            if trace is not None:
+                trace.record(trace.last_time() + chg_time, cur_kwh / veh_kwh, 'dcfc_depart')
+            dcfc_kwh = dcfc_kwh + cur_kwh - seek_charge_kwh
+            dcfc_plug_h = dcfc_plug_h + chg_time
             cur_time_shift = cur_time_shift + elapsed_time + chg_time
             shift_remain_time = shift_length_h - cur_time_shift
             dcfc_ct = dcfc_ct + 1
-            
-            
+
+
     # If a charge event is occurring as a shift ends, it is assumed to continue to completion
     # This can lead to extra time until the vehicle unplugs. Accounting for that here to use later
     # when aligning the shift start
     shift_spillover = cur_time_shift - shift_length_h
-    # time_absolute.extend([day_start_time + cur_time_shift])
-    # veh_soc.extend([cur_kwh / veh_kwh])
+    day_end_soc = cur_kwh / veh_kwh
 
-    return veh_soc, time_absolute, dcfc_ct, shift_spillover, cum_mi
+    return day_end_soc, dcfc_ct, shift_spillover, cum_mi, dcfc_kwh, dcfc_plug_h
 
 
-def simulate_night(veh_soc,
-                   time_absolute,
+def simulate_night(day_end_soc,
+                   day_start_time,
                    home_charging,
                    shift_length_h,
                    shift_spillover,
                    veh_kwh,
-                   l2_max_kw):
+                   l2_max_kw,
+                   trace=None):
+    # A shift whose spillover runs past 24 h leaves no time for the night: the next day starts as soon as
+    # the vehicle unplugs, so the overflow carries into it rather than being charged for
     elapsed_time_overnight_h = 24 - shift_length_h - shift_spillover
-    end_shift_time = time_absolute[-1]
-    
-    end_of_shift_soc = veh_soc[-1]
-    
+    if elapsed_time_overnight_h < 0:
+        elapsed_time_overnight_h = 0
+    end_shift_time = day_start_time + shift_length_h + shift_spillover
+    if trace is not None:
+        end_shift_time = trace.last_time()
+
+    end_of_shift_soc = day_end_soc
+
     if home_charging == 1:
-        cur_kwh = veh_kwh * veh_soc[-1]
+        cur_kwh = veh_kwh * day_end_soc
         kwh_to_charge_l2 = veh_kwh - cur_kwh
         chg_time_to_full = kwh_to_charge_l2 / (l2_max_kw * 0.9)
-        elapsed_time_overnight_h = 24 - shift_length_h - shift_spillover
 
         # Checking if enough time to L2 to 100%, or if the charge will be incomplete
         if chg_time_to_full <= elapsed_time_overnight_h:
-            end_of_chg_soc = 1
-            end_of_chg_time = time_absolute[-1] + chg_time_to_full            
-            veh_soc.extend([end_of_chg_soc])
-            time_absolute.extend([end_of_chg_time])
-            
-            
+            end_of_night_soc = 1
+            if trace is not None:
+                trace.record(end_shift_time + chg_time_to_full, end_of_night_soc, 'l2_end')
+
         else:
             cur_kwh = cur_kwh + elapsed_time_overnight_h * (l2_max_kw * 0.9)
-            end_of_chg_soc = cur_kwh / veh_kwh
-            end_of_chg_time = [time_absolute[-1] + elapsed_time_overnight_h]
-
-        veh_soc.extend([end_of_chg_soc])
-        time_absolute.extend([end_shift_time + elapsed_time_overnight_h])
-        day_start_time = time_absolute[-1]
-        
-        end_of_night_soc = veh_soc[-1]
+            end_of_night_soc = cur_kwh / veh_kwh
+
         l2_kwh = (end_of_night_soc - end_of_shift_soc) * veh_kwh
+        if l2_kwh < 0:
+            raise ValueError('Negative overnight L2 energy: %s kWh' % l2_kwh)
 
     else:
-        day_start_soc = veh_soc[-1]
-        veh_soc.extend([day_start_soc])
-        time_absolute.extend([end_shift_time + elapsed_time_overnight_h])
-        day_start_time = time_absolute[-1]
+        end_of_night_soc = day_end_soc
         l2_kwh = 0
 
-    return veh_soc, time_absolute, day_start_time, l2_kwh
+    day_start_time = end_shift_time + elapsed_time_overnight_h
+    if trace is not None:
+        trace.record(day_start_time, end_of_night_soc, 'day_start')
+
+    return end_of_night_soc, day_start_time, l2_kwh
+
+
+# Longest shift (h) a day's random variation can stretch a shift to, leaving time for the night
+max_daily_shift_h = 23.0
+
+
+def day_variation_inputs(shift_length_h, avg_speed_mph, climate_wh_mi, daily_factors, day):
+    # Shift length, speed and Wh/mi of one simulated day: the vehicle's own, or scaled by the day's row of
+    # each of daily_factors (shift length, speed, Wh/mi multipliers)
+    if daily_factors is None:
+        return shift_length_h, avg_speed_mph, climate_wh_mi
+
+    shift_factor, speed_factor, wh_mi_factor = daily_factors
+
+    return (np.minimum(shift_length_h * shift_factor[day], max_daily_shift_h),
+            avg_speed_mph * speed_factor[day],
+            climate_wh_mi * wh_mi_factor[day])
 
 
 def simulate_n_days(
@@ -117,63 +221,376 @@ def simulate_n_days(
         chg_time_h,
         l2_max_kw,
         climate_wh_mi,
-        dcfc_soc_high):
-    
-    
+        dcfc_soc_high,
+        steady_state_tol=None,
+        max_cycle_days=7,
+        trace=None,
+        chg_table=None,
+        plug_in_h=0.0,
+        daily_factors=None):
+    # Each simulated day is a shift followed by the night after it. The start-of-day SOC fully determines
+    # a day, so once it repeats (within steady_state_tol, over a cycle of up to max_cycle_days days) the
+    # remaining days are extrapolated from the repeating cycle. converged_day is the day on which the
+    # repeating SOC was reached, or 0 if the simulation ran for all sim_days.
+    # Only summary results are returned. Passing a SimTrace records the SOC/time trace of every simulated
+    # (not extrapolated) day into it. With a chg_table, DCFC stops are top-ups (see simulate_day).
+    # daily_factors are the (shift length, speed, Wh/mi) multipliers of each day (see day_variation_inputs);
+    # days then differ, so they are all simulated. total_dcfc_ct_sq sums the squared daily DCFC counts
+
+    if daily_factors is not None:
+        steady_state_tol = None
+
+    # Without a chg_table every stop charges the same energy for the same time, so the DCFC energy and
+    # plugged-in time follow from dcfc_ct at the end and are not kept per day
+    track_dcfc = chg_table is not None
+
     dcfc_ct = 0
-    time_absolute = [0]
-    veh_soc = [initial_soc]
+    total_dcfc_ct_sq = 0
+    veh_soc = initial_soc
     day_start_time = 0
     total_mi = 0
     total_l2_kwh = 0
-    
-    # Simulation of ay 1
-    veh_soc, time_absolute, dcfc_ct, shift_spillover, shift_mi = simulate_day(veh_soc,
-                                                                    time_absolute,
-                                                                    dcfc_ct,
-                                                                    shift_length_h,
-                                                                    veh_kwh,
-                                                                    avg_speed_mph,
-                                                                    climate_wh_mi,
-                                                                    seek_charge_kwh,
-                                                                    chg_time_h,
-                                                                    day_start_time,
-                                                                    dcfc_soc_high)
-    total_mi = total_mi + shift_mi
-    
-    # Simulation of remainder days
-    for day in range(sim_days - 1):
-        veh_soc, time_absolute, day_start_time, l2_kwh = simulate_night(veh_soc,
-                                                                time_absolute,
-                                                                home_charging,
-                                                                shift_length_h,
-                                                                shift_spillover,
-                                                                veh_kwh,
-                                                                l2_max_kw)
-
-        veh_soc, time_absolute, dcfc_ct, shift_spillover, shift_mi = simulate_day(veh_soc,
-                                                                        time_absolute,
-                                                                        dcfc_ct,
-                                                                        shift_length_h,
-                                                                        veh_kwh,
-                                                                        avg_speed_mph,
-                                                                        climate_wh_mi,
-                                                                        seek_charge_kwh,
-                                                                        chg_time_h,
-                                                                        day_start_time,
-                                                                        dcfc_soc_high)
+    converged_day = 0
+
+    if trace is not None:
+        trace.reserve(trace.size + 1 + sim_days * 6)
+        trace.record(day_start_time, veh_soc, 'start')
+
+    total_dcfc_kwh = 0
+    total_dcfc_plug_h = 0
+
+    day_start_soc = [initial_soc]
+    day_dcfc_ct = []
+    day_mi = []
+    day_l2_kwh = []
+    day_dcfc_kwh = []
+    day_dcfc_plug_h = []
+
+    day_shift_h, day_speed_mph, day_wh_mi = shift_length_h, avg_speed_mph, climate_wh_mi
+    for day in range(sim_days):
+        if daily_factors is not None:
+            day_shift_h, day_speed_mph, day_wh_mi = day_variation_inputs(shift_length_h, avg_speed_mph,
+                                                                         climate_wh_mi, daily_factors, day)
+        prev_dcfc_ct = dcfc_ct
+        veh_soc, dcfc_ct, shift_spillover, shift_mi, dcfc_kwh, dcfc_plug_h = simulate_day(veh_soc,
+                                                                   dcfc_ct,
+                                                                   day_shift_h,
+                                                                   veh_kwh,
+                                                                   day_speed_mph,
+                                                                   day_wh_mi,
+                                                                   seek_charge_kwh,
+                                                                   chg_time_h,
+                                                                   day_start_time,
+                                                                   dcfc_soc_high,
+                                                                   trace,
+                                                                   chg_table,
+                                                                   plug_in_h)
+
+        veh_soc, day_start_time, l2_kwh = simulate_night(veh_soc,
+                                                         day_start_time,
+                                                         home_charging,
+                                                         day_shift_h,
+                                                         shift_spillover,
+                                                         veh_kwh,
+                                                         l2_max_kw,
+                                                         trace)
         total_mi = total_mi + shift_mi
         total_l2_kwh = total_l2_kwh + l2_kwh
-        
-    veh_soc, time_absolute, day_start_time, l2_kwh = simulate_night(veh_soc,
-                                                            time_absolute,
-                                                            home_charging,
-                                                            shift_length_h,
-                                                            shift_spillover,
-                                                            veh_kwh,
-                                                            l2_max_kw)
-    
-    total_l2_kwh = total_l2_kwh + l2_kwh
-    total_dcfc_kwh = dcfc_ct * (veh_kwh*dcfc_soc_high - seek_charge_kwh)
-
-    return veh_soc, time_absolute, dcfc_ct, total_mi, total_dcfc_kwh, total_l2_kwh
\ No newline at end of file
+        day_dcfc = dcfc_ct - prev_dcfc_ct
+        total_dcfc_ct_sq = total_dcfc_ct_sq + day_dcfc * day_dcfc
+
+        day_start_soc.extend([veh_soc])
+        day_dcfc_ct.extend([day_dcfc])
+        day_mi.extend([shift_mi])
+        day_l2_kwh.extend([l2_kwh])
+        if track_dcfc:
+            total_dcfc_kwh = total_dcfc_kwh + dcfc_kwh
+            total_dcfc_plug_h = total_dcfc_plug_h + dcfc_plug_h
+            day_dcfc_kwh.extend([dcfc_kwh])
+            day_dcfc_plug_h.extend([dcfc_plug_h])
+
+        remaining_days = sim_days - 1 - day
+        if steady_state_tol is None or remaining_days == 0:
+            continue
+
+        for period in range(1, min(max_cycle_days, day + 1) + 1):
+            if abs(day_start_soc[-1] - day_start_soc[-1 - period]) <= steady_state_tol:
+                # Days in the cycle repeat n_cycles times, and the first n_extra of them once more
+                n_cycles, n_extra = divmod(remaining_days, period)
+                dcfc_ct = dcfc_ct + n_cycles * sum(day_dcfc_ct[-period:]) + sum(day_dcfc_ct[-period:][:n_extra])
+                total_dcfc_ct_sq = total_dcfc_ct_sq + n_cycles * sum([ct**2 for ct in day_dcfc_ct[-period:]]) + \
+                    sum([ct**2 for ct in day_dcfc_ct[-period:][:n_extra]])
+                total_mi = total_mi + n_cycles * sum(day_mi[-period:]) + sum(day_mi[-period:][:n_extra])
+                total_l2_kwh = total_l2_kwh + n_cycles * sum(day_l2_kwh[-period:]) + sum(day_l2_kwh[-period:][:n_extra])
+                total_dcfc_kwh = total_dcfc_kwh + n_cycles * sum(day_dcfc_kwh[-period:]) + \
+                    sum(day_dcfc_kwh[-period:][:n_extra])
+                total_dcfc_plug_h = total_dcfc_plug_h + n_cycles * sum(day_dcfc_plug_h[-period:]) + \
+                    sum(day_dcfc_plug_h[-period:][:n_extra])
+                converged_day = day + 2
+                break
+
+        if converged_day > 0:
+            break
+
+    if chg_table is None:
+        # Every stop charges the same energy for the same time
+        total_dcfc_kwh = dcfc_ct * (veh_kwh*dcfc_soc_high - seek_charge_kwh)
+        total_dcfc_plug_h = dcfc_ct * chg_time_h
+
+    return dcfc_ct, total_mi, total_dcfc_kwh, total_l2_kwh, converged_day, total_dcfc_plug_h, total_dcfc_ct_sq
+
+
+def simulate_day_batch(day_start_soc,
+                       dcfc_ct,
+                       shift_length_h,
+                       veh_kwh,
+                       avg_speed_mph,
+                       climate_wh_mi,
+                       seek_charge_kwh,
+                       chg_time,
+                       dcfc_soc_high,
+                       chg_tables=None,
+                       chg_table_ix=None,
+                       plug_in_h=0.0,
+                       track_dcfc=True):
+    # Vectorized counterpart of simulate_day: every argument is an array with one entry per vehicle,
+    # and all vehicles step through their charge events in lockstep. Vehicles that have finished
+    # their shift drop out of the active set. With stacked chg_tables, DCFC stops are top-ups and each
+    # vehicle's charge time comes from its row chg_table_ix (see simulate_day). Without track_dcfc the
+    # DCFC energy and plugged-in time are not summed, and None is returned for them
+    shift_remain_time = shift_length_h.copy()
+    cur_time_shift = np.zeros_like(shift_remain_time)
+    cur_kwh = day_start_soc * veh_kwh
+    cum_mi = np.zeros_like(shift_remain_time)
+    dcfc_ct = dcfc_ct.copy()
+    dcfc_kwh = np.zeros_like(shift_remain_time) if track_dcfc else None
+    dcfc_plug_h = np.zeros_like(shift_remain_time) if track_dcfc else None
+
+    active = np.flatnonzero(shift_remain_time > 0)
+
+    while active.size > 0:
+
+        remain = shift_remain_time[active]
+        speed = avg_speed_mph[active]
+        wh_mi = climate_wh_mi[active]
+
+        shift_remain_mi = remain * speed
+        shift_remain_kwh = shift_remain_mi * wh_mi / 1000  # energy to complete remainder of shift
+        avail_kwh = cur_kwh[active] - seek_charge_kwh[active]
+
+        no_chg = avail_kwh > shift_remain_kwh  # no charging needed for the remainder of the shift
+        done = active[no_chg]
+        cur_kwh[done] = cur_kwh[done] - shift_remain_kwh[no_chg]
+        cur_time_shift[done] = cur_time_shift[done] + remain[no_chg]
+        cum_mi[done] = cum_mi[done] + speed[no_chg] * remain[no_chg]
+        shift_remain_time[done] = 0
+
+        # Charging event needed, see simulate_day for the definition of elapsed time
+        chg = ~no_chg
+        chg_ix = active[chg]
+        elapsed_time = avail_kwh[chg] / (speed[chg] * wh_mi[chg]) * 1000
+        cum_mi[chg_ix] = cum_mi[chg_ix] + speed[chg] * elapsed_time
+        if chg_tables is None:
+            cur_kwh[chg_ix] = veh_kwh[chg_ix] * dcfc_soc_high[chg_ix]
+            stop_time = chg_time[chg_ix]
+        else:
+            arrive_soc = seek_charge_kwh[chg_ix] / veh_kwh[chg_ix]
+            depart_soc = np.minimum((seek_charge_kwh[chg_ix] + shift_remain_kwh[chg] - avail_kwh[chg]) / veh_kwh[chg_ix],
+                                    dcfc_soc_high[chg_ix])
+            stop_time = plug_in_h + lookup_chg_time(chg_tables, chg_table_ix[chg_ix], depart_soc) - \
+                lookup_chg_time(chg_tables, chg_table_ix[chg_ix], arrive_soc)
+            cur_kwh[chg_ix] = veh_kwh[chg_ix] * depart_soc
+        if track_dcfc:
+            dcfc_kwh[chg_ix] = dcfc_kwh[chg_ix] + cur_kwh[chg_ix] - seek_charge_kwh[chg_ix]
+            dcfc_plug_h[chg_ix] = dcfc_plug_h[chg_ix] + stop_time
+        cur_time_shift[chg_ix] = cur_time_shift[chg_ix] + elapsed_time + stop_time
+        shift_remain_time[chg_ix] = shift_length_h[chg_ix] - cur_time_shift[chg_ix]
+        dcfc_ct[chg_ix] = dcfc_ct[chg_ix] + 1
+
+        active = chg_ix[shift_remain_time[chg_ix] > 0]
+
+    shift_spillover = cur_time_shift - shift_length_h
+    day_end_soc = cur_kwh / veh_kwh
+
+    return day_end_soc, dcfc_ct, shift_spillover, cum_mi, dcfc_kwh, dcfc_plug_h
+
+
+def simulate_night_batch(day_end_soc,
+                         home_charging,
+                         shift_length_h,
+                         shift_spillover,
+                         veh_kwh,
+                         l2_max_kw):
+    # Vectorized counterpart of simulate_night
+    elapsed_time_overnight_h = np.maximum(24 - shift_length_h - shift_spillover, 0)
+
+    cur_kwh = veh_kwh * day_end_soc
+    kwh_to_charge_l2 = veh_kwh - cur_kwh
+    chg_time_to_full = kwh_to_charge_l2 / (l2_max_kw * 0.9)
+
+    # Checking if enough time to L2 to 100%, or if the charge will be incomplete
+    end_of_chg_soc = np.where(chg_time_to_full <= elapsed_time_overnight_h,
+                              1.0,
+                              (cur_kwh + elapsed_time_overnight_h * (l2_max_kw * 0.9)) / veh_kwh)
+
+    home_chg_mask = home_charging == 1
+    end_of_night_soc = np.where(home_chg_mask, end_of_chg_soc, day_end_soc)
+    l2_kwh = np.where(home_chg_mask, (end_of_night_soc - day_end_soc) * veh_kwh, 0.0)
+    if (l2_kwh < 0).any():
+        raise ValueError('Negative overnight L2 energy: %s kWh' % l2_kwh.min())
+
+    return end_of_night_soc, l2_kwh
+
+
+def simulate_n_days_batch(
+        veh_kwh,
+        initial_soc,
+        home_charging,
+        shift_length_h,
+        avg_speed_mph,
+        sim_days,
+        seek_charge_kwh,
+        chg_time_h,
+        l2_max_kw,
+        climate_wh_mi,
+        dcfc_soc_high,
+        steady_state_tol=None,
+        max_cycle_days=7,
+        chg_tables=None,
+        chg_table_ix=0,
+        plug_in_h=0.0,
+        daily_factors=None):
+    # Batched version of simulate_n_days. All vehicle arguments may be scalars or arrays (broadcast
+    # against each other), so any number of driver permutations, including those of several CBSAs
+    # stacked together, can be simulated at once. Returns one entry per vehicle for dcfc_ct, total_mi,
+    # total_dcfc_kwh, total_l2_kwh, converged_day, total_dcfc_plug_h and total_dcfc_ct_sq; SOC and time traces
+    # are not tracked. Vehicles whose start-of-day SOC repeats are extrapolated as in simulate_n_days and drop
+    # out of the batch. With stacked chg_tables, DCFC stops are top-ups timed from each vehicle's row
+    # chg_table_ix. daily_factors hold (sim_days, vehicles) arrays of each day's multipliers, drawn up front
+    params = np.broadcast_arrays(veh_kwh, initial_soc, home_charging, shift_length_h, avg_speed_mph,
+                                 seek_charge_kwh, chg_time_h, l2_max_kw, climate_wh_mi, dcfc_soc_high)
+    out_shape = params[0].shape
+    params = [np.array(arr, dtype=float).ravel() for arr in params]
+    n_veh = params[0].size
+    chg_table_ix = np.broadcast_to(chg_table_ix, out_shape).ravel()
+    if daily_factors is not None:
+        steady_state_tol = None
+        daily_factors = [np.broadcast_to(cur_factor, (sim_days,) + out_shape).reshape(sim_days, n_veh)
+                         for cur_factor in daily_factors]
+
+    # Without chg_tables the DCFC energy and plugged-in time follow from dcfc_ct at the end (see
+    # simulate_n_days), so they are not kept per day
+    track_dcfc = chg_tables is not None
+
+    dcfc_ct = np.zeros(n_veh, dtype=int)
+    total_dcfc_ct_sq = np.zeros(n_veh, dtype=int)
+    total_mi = np.zeros(n_veh)
+    total_l2_kwh = np.zeros(n_veh)
+    converged_day = np.zeros(n_veh, dtype=int)
+
+    # Ring buffers holding the start-of-day SOC and daily results of the last max_cycle_days days
+    hist_soc = np.empty((max_cycle_days + 1, n_veh))
+    hist_dcfc_ct = np.zeros((max_cycle_days, n_veh), dtype=int)
+    hist_mi = np.zeros((max_cycle_days, n_veh))
+    hist_l2_kwh = np.zeros((max_cycle_days, n_veh))
+    hist_soc[0] = params[1]
+    if track_dcfc:
+        total_dcfc_kwh = np.zeros(n_veh)
+        total_dcfc_plug_h = np.zeros(n_veh)
+        hist_dcfc_kwh = np.zeros((max_cycle_days, n_veh))
+        hist_dcfc_plug_h = np.zeros((max_cycle_days, n_veh))
+
+    live = np.arange(n_veh)
+    (veh_kwh, veh_soc, home_charging, shift_length_h, avg_speed_mph, seek_charge_kwh,
+     chg_time_h, l2_max_kw, climate_wh_mi, dcfc_soc_high) = params
+
+    for day in range(sim_days):
+        # Without cycle extrapolation (as with daily_factors) every vehicle stays live
+        day_shift_h, day_speed_mph, day_wh_mi = day_variation_inputs(shift_length_h, avg_speed_mph, climate_wh_mi,
+                                                                     daily_factors, day)
+        veh_soc, day_dcfc_ct, shift_spillover, shift_mi, dcfc_kwh, dcfc_plug_h = simulate_day_batch(veh_soc,
+                                                                             np.zeros(live.size, dtype=int),
+                                                                             day_shift_h,
+                                                                             veh_kwh,
+                                                                             day_speed_mph,
+                                                                             day_wh_mi,
+                                                                             seek_charge_kwh,
+                                                                             chg_time_h,
+                                                                             dcfc_soc_high,
+                                                                             chg_tables,
+                                                                             chg_table_ix,
+                                                                             plug_in_h,
+                                                                             track_dcfc)
+
+        veh_soc, l2_kwh = simulate_night_batch(veh_soc,
+                                               home_charging,
+                                               day_shift_h,
+                                               shift_spillover,
+                                               veh_kwh,
+                                               l2_max_kw)
+
+        dcfc_ct[live] = dcfc_ct[live] + day_dcfc_ct
+        total_dcfc_ct_sq[live] = total_dcfc_ct_sq[live] + day_dcfc_ct**2
+        total_mi[live] = total_mi[live] + shift_mi
+        total_l2_kwh[live] = total_l2_kwh[live] + l2_kwh
+        if track_dcfc:
+            total_dcfc_kwh[live] = total_dcfc_kwh[live] + dcfc_kwh
+            total_dcfc_plug_h[live] = total_dcfc_plug_h[live] + dcfc_plug_h
+
+        remaining_days = sim_days - 1 - day
+        if steady_state_tol is None or remaining_days == 0:
+            continue
+
+        hist_soc[(day + 1) % (max_cycle_days + 1), live] = veh_soc
+        hist_dcfc_ct[day % max_cycle_days, live] = day_dcfc_ct
+        hist_mi[day % max_cycle_days, live] = shift_mi
+        hist_l2_kwh[day % max_cycle_days, live] = l2_kwh
+        if track_dcfc:
+            hist_dcfc_kwh[day % max_cycle_days, live] = dcfc_kwh
+            hist_dcfc_plug_h[day % max_cycle_days, live] = dcfc_plug_h
+
+        cycle_period = np.zeros(live.size, dtype=int)
+        for period in range(min(max_cycle_days, day + 1), 0, -1):  # shortest matching period wins
+            prev_soc = hist_soc[(day + 1 - period) % (max_cycle_days + 1), live]
+            cycle_period[np.abs(veh_soc - prev_soc) <= steady_state_tol] = period
+
+        converged = cycle_period > 0
+        if not converged.any():
+            continue
+
+        for period in np.unique(cycle_period[converged]):
+            rows = live[cycle_period == period]
+            n_cycles, n_extra = divmod(remaining_days, period)
+            for cycle_ix in range(period):
+                cycle_slot = (day - period + 1 + cycle_ix) % max_cycle_days
+                repeats = n_cycles + (cycle_ix < n_extra)
+                dcfc_ct[rows] = dcfc_ct[rows] + repeats * hist_dcfc_ct[cycle_slot, rows]
+                total_dcfc_ct_sq[rows] = total_dcfc_ct_sq[rows] + repeats * hist_dcfc_ct[cycle_slot, rows]**2
+                total_mi[rows] = total_mi[rows] + repeats * hist_mi[cycle_slot, rows]
+                total_l2_kwh[rows] = total_l2_kwh[rows] + repeats * hist_l2_kwh[cycle_slot, rows]
+                if track_dcfc:
+                    total_dcfc_kwh[rows] = total_dcfc_kwh[rows] + repeats * hist_dcfc_kwh[cycle_slot, rows]
+                    total_dcfc_plug_h[rows] = total_dcfc_plug_h[rows] + repeats * hist_dcfc_plug_h[cycle_slot, rows]
+
+        converged_day[live[converged]] = day + 2
+
+        still_live = ~converged
+        live = live[still_live]
+        veh_soc = veh_soc[still_live]
+        (veh_kwh, home_charging, shift_length_h, avg_speed_mph, seek_charge_kwh,
+         chg_time_h, l2_max_kw, climate_wh_mi, dcfc_soc_high, chg_table_ix) = [
+            arr[still_live] for arr in (veh_kwh, home_charging, shift_length_h, avg_speed_mph, seek_charge_kwh,
+                                        chg_time_h, l2_max_kw, climate_wh_mi, dcfc_soc_high, chg_table_ix)]
+
+        if live.size == 0:
+            break
+
+    if chg_tables is None:
+        # Every stop charges the same energy for the same time
+        veh_kwh, seek_charge_kwh, chg_time_h, dcfc_soc_high = params[0], params[5], params[6], params[9]
+        total_dcfc_kwh = dcfc_ct * (veh_kwh*dcfc_soc_high - seek_charge_kwh)
+        total_dcfc_plug_h = dcfc_ct * chg_time_h
+
+    return (dcfc_ct.reshape(out_shape), total_mi.reshape(out_shape), total_dcfc_kwh.reshape(out_shape),
+            total_l2_kwh.reshape(out_shape), converged_day.reshape(out_shape), total_dcfc_plug_h.reshape(out_shape),
+            total_dcfc_ct_sq.reshape(out_shape))
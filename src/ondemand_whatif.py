@@ -0,0 +1,185 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import warnings
+import yaml
+import numpy as np
+import pandas as pd
+from ondemand_cache import hash_inputs, get_code_version
+from ondemand_output import manifest_file, read_results
+from ondemand_fleetsim import import_scenario_vars, directory_handling, import_cbsa_inputs, print_input_report, \
+    simulate_scenario, summarize_scenario, replicate_total_columns
+
+
+# Per-CBSA inputs a what-if can override. hc_access is the share of drivers with home charging (0-1), or the
+# name of an access column of overnight_chg_access_by_cbsa.csv (e.g. scen_5_access) whose value the CBSA
+# takes. cbsa_dvmt is the CBSA's daily VMT before tnc_share, median_mph its speed and whmi its Wh/mi
+# (otherwise base_wh_mi times its ambient conditions penalty)
+override_keys = ['hc_access', 'cbsa_dvmt', 'median_mph', 'whmi']
+
+# Population results compared against the baseline, and patched into its national totals
+diff_columns = replicate_total_columns
+
+
+def baseline_from_results(global_inputs, tnc_population_results):
+    # What-if baseline from a run's scenario inputs (with defaults applied) and population results, e.g. those
+    # of run_scenario. The national totals are summed once here, and then patched by each what-if
+    population = tnc_population_results.reset_index(drop=True)
+
+    return {'global_inputs': global_inputs,
+            'population': population,
+            'national_totals': population[diff_columns].sum(),
+            'sim_cache': {}}
+
+
+def load_baseline(output_dir):
+    # What-if baseline from the output directory of a completed run. The run must have been written by the
+    # current model code, so that untouched CBSAs would come out of a rerun exactly as they are
+    scenario_traces = glob.glob(os.path.join(output_dir, '*_sim_inputs.yaml'))
+    if len(scenario_traces) != 1:
+        raise ValueError('%s does not contain exactly one *_sim_inputs.yaml file' % output_dir)
+    global_inputs = import_scenario_vars(scenario_traces[0])
+
+    with open(os.path.join(output_dir, manifest_file), 'r') as stream:
+        manifest = json.load(stream)
+    if manifest['run_key'] != hash_inputs(global_inputs, get_code_version()):
+        raise ValueError('%s was written with different model code or scenario inputs, rerun it as the baseline'
+                         % output_dir)
+
+    return baseline_from_results(global_inputs, read_results(output_dir, 'population',
+                                                             global_inputs['scenario_name']))
+
+
+def apply_cbsa_overrides(global_inputs, cbsa_table, cbsa_overrides):
+    # Rows of cbsa_table of the CBSAs in cbsa_overrides ({cbsa_id: {override key: value}}), with their
+    # overrides applied to the columns the scenario reads (see retrieve_cbsa_inputs)
+    unknown_ids = [cur_cbsa_id for cur_cbsa_id in cbsa_overrides.keys() if cur_cbsa_id not in cbsa_table.index]
+    if len(unknown_ids) > 0:
+        raise ValueError('No CBSA inputs for %s' % unknown_ids)
+
+    efficiency_label = str(global_inputs['percentile_ambient_conditions']) + '_perc_penalty'
+    edited_table = cbsa_table.loc[list(cbsa_overrides.keys())].copy()
+    for cur_cbsa_id, cur_overrides in cbsa_overrides.items():
+        unknown_keys = [cur_key for cur_key in cur_overrides.keys() if cur_key not in override_keys]
+        if len(unknown_keys) > 0:
+            raise ValueError('CBSA %s: overrides can only set %s, got %s' % (cur_cbsa_id, override_keys, unknown_keys))
+
+        for cur_key, cur_value in cur_overrides.items():
+            if cur_key == 'hc_access':
+                if isinstance(cur_value, str):
+                    if cur_value not in cbsa_table.columns:
+                        raise ValueError('CBSA %s: no home charging access column %s' % (cur_cbsa_id, cur_value))
+                    cur_value = cbsa_table.loc[cur_cbsa_id, cur_value]
+                if not 0 <= cur_value <= 1:
+                    raise ValueError('CBSA %s: hc_access must be between 0 and 1, got %s' % (cur_cbsa_id, cur_value))
+                edited_table.loc[cur_cbsa_id, global_inputs['hc_scenario']] = cur_value
+            elif cur_key == 'whmi':
+                edited_table.loc[cur_cbsa_id, efficiency_label] = cur_value / global_inputs['base_wh_mi']
+            else:
+                edited_table.loc[cur_cbsa_id, cur_key] = cur_value
+
+    return edited_table
+
+
+def run_what_if(baseline, cbsa_overrides, data=None, workers=1):
+    # Baseline run with per-CBSA input overrides ({cbsa_id: {override key: value}}, see override_keys). Only
+    # the overridden CBSAs are simulated and sampled, from the same per-CBSA random streams as the baseline,
+    # and the national totals are patched by their change. Vehicle simulations are kept in the baseline's
+    # simulation cache, so repeated what-ifs on the same baseline only simulate permutations they have not
+    # seen. data are the CBSA inputs, as for run_scenario. Returns a dict of:
+    # 'cbsa_diff' - baseline, what-if and change of each of diff_columns, per overridden CBSA
+    # 'national_diff' - the same for the national totals, and for the headline numbers of summarize_scenario
+    # 'population' - the baseline's population results with the overridden CBSAs replaced
+    # 'cbsa_results' - all result tables of the overridden CBSAs, as returned by simulate_scenario
+    global_inputs = baseline['global_inputs']
+    base_population = baseline['population']
+    cbsa_overrides = dict([(int(cur_cbsa_id), cur_overrides) for cur_cbsa_id, cur_overrides in cbsa_overrides.items()])
+    cbsa_ids = list(cbsa_overrides.keys())
+
+    missing_ids = [cur_cbsa_id for cur_cbsa_id in cbsa_ids if cur_cbsa_id not in set(base_population.cbsa_id)]
+    if len(missing_ids) > 0:
+        raise ValueError('CBSAs %s are not part of the baseline run' % missing_ids)
+
+    if data is None:
+        data = import_cbsa_inputs()
+    elif isinstance(data, str):
+        data = import_cbsa_inputs(data)
+    edited_table = apply_cbsa_overrides(global_inputs, data[0], cbsa_overrides)
+
+    cbsa_results = simulate_scenario(global_inputs, edited_table, cbsa_ids, workers, baseline['sim_cache'])
+    new_population = cbsa_results['population']
+
+    touched = base_population.cbsa_id.isin(cbsa_ids)
+    old_population = base_population[touched].set_index('cbsa_id').loc[cbsa_ids]
+    national_totals = baseline['national_totals'] - old_population[diff_columns].sum() + \
+        new_population[diff_columns].sum()
+
+    # Overridden CBSAs take the place of their baseline rows
+    population = pd.concat([base_population[~touched], new_population], ignore_index=True)
+    baseline_order = pd.Index(base_population.cbsa_id).get_indexer(population.cbsa_id)
+    population = population.iloc[np.argsort(baseline_order, kind='stable')].reset_index(drop=True)
+
+    cbsa_diff = []
+    for cur_col in diff_columns:
+        cbsa_diff.append(pd.DataFrame({'cbsa_id': cbsa_ids,
+                                       'metric': cur_col,
+                                       'baseline': old_population[cur_col].values,
+                                       'what_if': new_population[cur_col].values}))
+    cbsa_diff = pd.concat(cbsa_diff, ignore_index=True).sort_values('cbsa_id', kind='stable').reset_index(drop=True)
+    cbsa_diff['change'] = cbsa_diff.what_if - cbsa_diff.baseline
+
+    base_summary = summarize_scenario(pd.DataFrame([baseline['national_totals']]))
+    what_if_summary = summarize_scenario(pd.DataFrame([national_totals]))
+    headline_metrics = [cur_metric for cur_metric in base_summary.keys() if cur_metric not in diff_columns]
+    national_diff = pd.DataFrame({'metric': diff_columns + headline_metrics,
+                                  'baseline': baseline['national_totals'][diff_columns].tolist() +
+                                  [base_summary[cur_metric] for cur_metric in headline_metrics],
+                                  'what_if': national_totals[diff_columns].tolist() +
+                                  [what_if_summary[cur_metric] for cur_metric in headline_metrics]})
+    national_diff['change'] = national_diff.what_if - national_diff.baseline
+
+    return {'cbsa_diff': cbsa_diff,
+            'national_diff': national_diff,
+            'population': population,
+            'cbsa_results': cbsa_results}
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description='EVI-OnDemand what-if: rerun only the CBSAs whose inputs are '
+                                                 'overridden, against a completed run')
+    parser.add_argument('baseline_dir', help='output directory of the completed baseline run')
+    parser.add_argument('overrides', help='.yaml file of per-CBSA overrides, e.g. 31080: {hc_access: scen_5_access}')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to simulate CBSA fleets')
+    args = parser.parse_args()
+
+    with open(args.overrides, 'r') as stream:
+        cbsa_overrides = yaml.safe_load(stream)
+
+    data = import_cbsa_inputs()
+    print_input_report(data[2])
+
+    try:
+        baseline = load_baseline(args.baseline_dir.rstrip('/'))
+        what_if_start = time.perf_counter()
+        what_if_results = run_what_if(baseline, cbsa_overrides, data, args.workers)
+    except ValueError as what_if_error:
+        print('What-if failed: %s' % what_if_error)
+        sys.exit(1)
+    what_if_seconds = time.perf_counter() - what_if_start
+
+    scenario = baseline['global_inputs']['scenario_name']
+    output_dir = directory_handling(baseline['global_inputs'], '%s--what_if' % scenario)
+    with open('%s/what_if_overrides.yaml' % output_dir, 'w') as outfile:
+        yaml.dump(cbsa_overrides, outfile, default_flow_style=False)
+    what_if_results['cbsa_diff'].to_csv('%s/what_if_cbsa_diff.csv' % output_dir, index=False)
+    what_if_results['national_diff'].to_csv('%s/what_if_national_diff.csv' % output_dir, index=False)
+    what_if_results['population'].to_csv('%s/population_results.csv' % output_dir, index=False)
+
+    print('\nWhat-if of %s CBSAs against %s (%.2f s):' % (len(cbsa_overrides), args.baseline_dir, what_if_seconds))
+    print(what_if_results['national_diff'].to_string(index=False))
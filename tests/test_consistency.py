@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import itertools
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ondemand_vehsim import simulate_n_days, simulate_n_days_batch
+from ondemand_utils import calc_chg_time_table, row_daily_factors
+from ondemand_output import ResultWriter, result_tables, manifest_file
+from ondemand_merge import merge_shards
+from ondemand_cache import get_code_version
+from ondemand_benchmark import build_synthetic_cbsa_table
+from ondemand_fleetsim import import_scenario_vars, import_cbsa_inputs, iterate_scenario, shard_cbsa_ids, \
+    hash_inputs, write_scenario_trace, shard_file
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# dcfc_ct, total_mi, total_dcfc_kwh, total_l2_kwh, converged_day, total_dcfc_plug_h, total_dcfc_ct_sq
+sim_outputs = ['dcfc_ct', 'total_mi', 'total_dcfc_kwh', 'total_l2_kwh', 'converged_day', 'total_dcfc_plug_h',
+               'total_dcfc_ct_sq']
+
+
+def vehicle_grid():
+    # Vehicle parameters of every combination of battery size, DCFC power, home charging, shift length, speed
+    # and Wh/mi, one array per parameter. A DCFC stop at the end of a 23 h shift at 40 kW runs past midnight,
+    # leaving no time overnight
+    grid = np.array(list(itertools.product([40.0, 75.0], [40.0, 150.0], [0, 1], [2.0, 6.5, 10.0, 23.0],
+                                           [12.0, 30.0], [250.0, 400.0]))).T
+    veh_kwh, dcfc_kw, home_chg, shift_h, speed, wh_mi = grid
+
+    return {'veh_kwh': veh_kwh, 'dcfc_kw': dcfc_kw, 'home_chg': home_chg, 'shift_h': shift_h, 'speed': speed,
+            'wh_mi': wh_mi, 'seek_charge_kwh': 0.15 * veh_kwh, 'chg_time_h': 0.65 * veh_kwh / dcfc_kw}
+
+
+def assert_batch_matches_scalar(sim_days, steady_state_tol, top_up=False, daily_factors=None):
+    vehs = vehicle_grid()
+    chg_tables = None
+    chg_table_ix = 0
+    if top_up:
+        table_keys = sorted(set(zip(vehs['veh_kwh'], vehs['dcfc_kw'])))
+        chg_tables = np.stack([calc_chg_time_table(veh_kwh, dcfc_kw, dcfc_kw, 1) for veh_kwh, dcfc_kw in table_keys])
+        chg_table_ix = np.array([table_keys.index(cur_key) for cur_key in zip(vehs['veh_kwh'], vehs['dcfc_kw'])])
+
+    batch_results = simulate_n_days_batch(vehs['veh_kwh'], 1, vehs['home_chg'], vehs['shift_h'], vehs['speed'],
+                                          sim_days, vehs['seek_charge_kwh'], vehs['chg_time_h'], 7.2, vehs['wh_mi'],
+                                          0.8, steady_state_tol=steady_state_tol, chg_tables=chg_tables,
+                                          chg_table_ix=chg_table_ix, plug_in_h=5 / 60.0 if top_up else 0.0,
+                                          daily_factors=daily_factors)
+
+    for cur_ix in range(vehs['veh_kwh'].size):
+        scalar_results = simulate_n_days(vehs['veh_kwh'][cur_ix], 1, vehs['home_chg'][cur_ix], vehs['shift_h'][cur_ix],
+                                         vehs['speed'][cur_ix], sim_days, vehs['seek_charge_kwh'][cur_ix],
+                                         vehs['chg_time_h'][cur_ix], 7.2, vehs['wh_mi'][cur_ix], 0.8,
+                                         steady_state_tol=steady_state_tol,
+                                         chg_table=chg_tables[chg_table_ix[cur_ix]] if top_up else None,
+                                         plug_in_h=5 / 60.0 if top_up else 0.0,
+                                         daily_factors=row_daily_factors(daily_factors, cur_ix))
+
+        for cur_output, cur_scalar, cur_batch in zip(sim_outputs, scalar_results, batch_results):
+            np.testing.assert_allclose(cur_batch[cur_ix], cur_scalar, rtol=1e-9, atol=1e-9,
+                                       err_msg='%s of vehicle %s' % (cur_output, cur_ix))
+
+
+@pytest.mark.parametrize('steady_state_tol', [None, 1e-9, 1e-3])
+@pytest.mark.parametrize('sim_days', [1, 30, 150])
+def test_batch_matches_scalar(sim_days, steady_state_tol):
+    assert_batch_matches_scalar(sim_days, steady_state_tol)
+
+
+@pytest.mark.parametrize('steady_state_tol', [None, 1e-9])
+def test_batch_matches_scalar_top_up(steady_state_tol):
+    assert_batch_matches_scalar(60, steady_state_tol, top_up=True)
+
+
+@pytest.mark.parametrize('top_up', [False, True])
+def test_batch_matches_scalar_daily_variation(top_up):
+    # Shift factors well above 1 push the long shifts to max_daily_shift_h, past the end of the night
+    rng = np.random.default_rng(0)
+    num_vehs = vehicle_grid()['veh_kwh'].size
+    daily_factors = [rng.lognormal(0.3, 0.5, size=(45, num_vehs)), rng.lognormal(0, 0.2, size=(45, num_vehs)),
+                     rng.lognormal(0, 0.1, size=(45, num_vehs))]
+    assert_batch_matches_scalar(45, 1e-9, top_up=top_up, daily_factors=daily_factors)
+
+
+@pytest.fixture(scope='module')
+def synthetic_run():
+    # Scenario inputs, a 10-CBSA synthetic CBSA table and its CBSA ids
+    global_inputs = import_scenario_vars(os.path.join(repo_dir, 'scenarios', 'bau_baseline.yaml'))
+    global_inputs.update({'sim_days': 30, 'cbsa_batch_size': 3, 'replicates': 4})
+    cbsa_table, cbsa_ids, input_report = import_cbsa_inputs()
+    cbsa_table, cbsa_ids = build_synthetic_cbsa_table(cbsa_table, cbsa_ids, 10)
+
+    return global_inputs, cbsa_table, cbsa_ids
+
+
+def run_cbsas(output_dir, global_inputs, cbsa_table, cbsa_ids, resume=False, max_cbsas=None, shard_info=None):
+    # Writes the results of cbsa_ids to output_dir as the command line run does, skipping the CBSAs a resumed
+    # run already completed and stopping after max_cbsas CBSAs. shard_info is written to the shard file
+    run_key = hash_inputs(global_inputs, get_code_version())
+    if not resume:
+        os.makedirs(output_dir)
+        write_scenario_trace(output_dir, global_inputs['scenario_name'], global_inputs)
+        if shard_info is not None:
+            with open(os.path.join(output_dir, shard_file), 'w') as outfile:
+                json.dump(dict(shard_info, run_key=run_key, cbsa_ids=cbsa_ids), outfile)
+
+    result_writer = ResultWriter(output_dir, global_inputs['scenario_name'], global_inputs['output_formats'],
+                                 run_key=run_key, resume=resume, batch_size=global_inputs['cbsa_batch_size'])
+    completed_ids = set(result_writer.completed_ids())
+    remaining_ids = [cur_cbsa_id for cur_cbsa_id in cbsa_ids if cur_cbsa_id not in completed_ids]
+
+    for cur_t, (cur_cbsa_id, cbsa_results) in enumerate(iterate_scenario(global_inputs, cbsa_table, remaining_ids)):
+        if max_cbsas is not None and cur_t == max_cbsas:
+            return
+        result_writer.write_cbsa(cur_cbsa_id, cbsa_results, {'num_vehs': float(cbsa_results['population'].num_vehs.sum())})
+    result_writer.flush()
+
+
+def read_csvs(output_dir):
+
+    csvs = {}
+    for table in result_tables.values():
+        if os.path.exists(os.path.join(output_dir, '%s.csv' % table)):
+            with open(os.path.join(output_dir, '%s.csv' % table), 'rb') as csv_file:
+                csvs[table] = csv_file.read()
+
+    return csvs
+
+
+def test_resume_matches_single_run(synthetic_run, tmp_path):
+    global_inputs, cbsa_table, cbsa_ids = synthetic_run
+    run_cbsas(str(tmp_path / 'full'), global_inputs, cbsa_table, cbsa_ids)
+
+    # Interrupted after 7 CBSAs (two chunks written, one pending), with a partly written chunk at the end of
+    # every CSV that the manifest does not cover
+    resumed_dir = str(tmp_path / 'resumed')
+    run_cbsas(resumed_dir, global_inputs, cbsa_table, cbsa_ids, max_cbsas=7)
+    with open(os.path.join(resumed_dir, manifest_file), 'r') as stream:
+        assert len(json.load(stream)['completed']) == 6
+    for table in read_csvs(resumed_dir).keys():
+        with open(os.path.join(resumed_dir, '%s.csv' % table), 'ab') as outfile:
+            outfile.write(b'7,partial row')
+    run_cbsas(resumed_dir, global_inputs, cbsa_table, cbsa_ids, resume=True)
+
+    full_csvs = read_csvs(str(tmp_path / 'full'))
+    assert sorted(full_csvs.keys()) == ['permutation_results', 'population_results', 'replicate_results']
+    assert read_csvs(resumed_dir) == full_csvs
+
+
+def test_merged_shards_match_single_run(synthetic_run, tmp_path):
+    global_inputs, cbsa_table, cbsa_ids = synthetic_run
+    run_cbsas(str(tmp_path / 'full'), global_inputs, cbsa_table, cbsa_ids)
+
+    shard_dirs = []
+    for shard in [1, 2, 3]:
+        shard_ids, shard_vmt = shard_cbsa_ids(global_inputs, cbsa_table, cbsa_ids, shard, 3)
+        shard_dirs.append(str(tmp_path / ('shard%s' % shard)))
+        run_cbsas(shard_dirs[-1], global_inputs, cbsa_table, shard_ids,
+                  shard_info={'shard': shard, 'num_shards': 3, 'all_cbsa_ids': cbsa_ids})
+
+    merged_manifest = merge_shards(shard_dirs, str(tmp_path / 'merged'))
+
+    assert [cur_cbsa['cbsa_id'] for cur_cbsa in merged_manifest['completed']] == cbsa_ids
+    assert read_csvs(str(tmp_path / 'merged')) == read_csvs(str(tmp_path / 'full'))